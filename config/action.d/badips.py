@@ -268,16 +268,48 @@ class BadIPsAction(ActionBase): # pragma: no cover - may be unavailable
 		else:
 			raise ValueError("Update period must be integer greater than 0")
 
+	@staticmethod
+	def _aInfo(ip):
+		return {
+			'ip': ip,
+			'failures': 0,
+			'matches': "",
+			'ipmatches': "",
+			'ipjailmatches': "",
+		}
+
+	def _executeMany(self, method, ips):
+		"""Executes batch method of `banaction` (`ban_many` or `unban_many`).
+
+		Returns False if not supported or failed, so the IPs should be
+		processed each separately.
+		"""
+		if len(ips) < 2:
+			return False
+		action = self._jail.actions[self.banaction]
+		batch = getattr(action, method, None)
+		if batch is None:
+			return False
+		try:
+			return batch([self._aInfo(ip) for ip in ips]) is not False
+		except Exception as e:
+			self._logSys.error(
+				"Error executing %s for %i IPs for jail '%s' with action '%s': %s",
+				method, len(ips), self._jail.name, self.banaction, e,
+				exc_info=self._logSys.getEffectiveLevel()<=logging.DEBUG)
+		return False
+
 	def _banIPs(self, ips):
+		ips = list(ips)
+		if self._executeMany('ban_many', ips):
+			self._bannedips.update(ips)
+			self._logSys.info(
+				"Banned %i IPs for jail '%s' with action '%s'",
+				len(ips), self._jail.name, self.banaction)
+			return
 		for ip in ips:
 			try:
-				self._jail.actions[self.banaction].ban({
-					'ip': ip,
-					'failures': 0,
-					'matches': "",
-					'ipmatches': "",
-					'ipjailmatches': "",
-				})
+				self._jail.actions[self.banaction].ban(self._aInfo(ip))
 			except Exception as e:
 				self._logSys.error(
 					"Error banning IP %s for jail '%s' with action '%s': %s",
@@ -290,15 +322,16 @@ class BadIPsAction(ActionBase): # pragma: no cover - may be unavailable
 					ip, self._jail.name, self.banaction)
 
 	def _unbanIPs(self, ips):
+		ips = list(ips)
+		if self._executeMany('unban_many', ips):
+			self._bannedips.difference_update(ips)
+			self._logSys.info(
+				"Unbanned %i IPs for jail '%s' with action '%s'",
+				len(ips), self._jail.name, self.banaction)
+			return
 		for ip in ips:
 			try:
-				self._jail.actions[self.banaction].unban({
-					'ip': ip,
-					'failures': 0,
-					'matches': "",
-					'ipmatches': "",
-					'ipjailmatches': "",
-				})
+				self._jail.actions[self.banaction].unban(self._aInfo(ip))
 			except Exception as e:
 				self._logSys.info(
 					"Error unbanning IP %s for jail '%s' with action '%s': %s",
@@ -19,10 +19,12 @@
 
 import socket
 import smtplib
+import threading
+import time
 from email.mime.text import MIMEText
 from email.utils import formatdate, formataddr
 
-from fail2ban.server.actions import ActionBase, CallingMap
+from fail2ban.server.action import ActionBase, CallingMap
 
 messages = {}
 messages['start'] = \
@@ -68,6 +70,18 @@ Matches for %(ip)s for jail %(jailname)s:
 %(ipjailmatches)s
 """
 
+messages['ban_many'] = {}
+messages['ban_many']['head'] = \
+"""Hi,
+
+The following %(ipcount)i IPs have just been banned for %(bantime)i seconds
+by Fail2Ban against %(jailname)s.
+"""
+messages['ban_many']['ip'] = \
+"""
+The IP %(ip)s after %(failures)i attempts.
+"""
+
 
 class SMTPAction(ActionBase):
 	"""Fail2Ban action which sends emails to inform on jail starting,
@@ -76,7 +90,8 @@ class SMTPAction(ActionBase):
 
 	def __init__(
 		self, jail, name, host="localhost", user=None, password=None,
-		sendername="Fail2Ban", sender="fail2ban", dest="root", matches=None):
+		sendername="Fail2Ban", sender="fail2ban", dest="root", matches=None,
+		idletimeout=60, digest=0):
 		"""Initialise action.
 
 		Parameters
@@ -104,6 +119,14 @@ class SMTPAction(ActionBase):
 			Type of matches to be included from ban in email. Can be one
 			of "matches", "ipmatches" or "ipjailmatches". Default None
 			(see man jail.conf.5).
+		idletimeout : int, optional
+			Seconds the connection to SMTP server is kept open after last
+			email, to be reused by next emails. 0 closes the connection
+			after each email. Default 60.
+		digest : int, optional
+			Seconds the bans are collected in order to send them together in
+			single email. Default 0 (email for each ban resp. each batch of
+			bans).
 		"""
 
 		super(SMTPAction, self).__init__(jail, name)
@@ -120,6 +143,20 @@ class SMTPAction(ActionBase):
 
 		self.matches = matches
 
+		self.idletimeout = int(idletimeout)
+		self.digest = int(digest)
+
+		# pooled connection (closed if idle):
+		self._lock = threading.Lock()
+		self._smtp = None
+		self._lastUsed = 0
+		self._idleTimer = None
+		self._idleDeadline = 0
+		# collected bans (digest mode):
+		self._digestLock = threading.Lock()
+		self._digestBans = []
+		self._digestTimer = None
+
 		self.message_values = CallingMap(
 			jailname = self._jail.name,
 			hostname = socket.gethostname,
@@ -152,39 +189,111 @@ class SMTPAction(ActionBase):
 		msg['To'] = self.toaddr
 		msg['Date'] = formatdate()
 
+		with self._lock:
+			# reuse pooled connection if available:
+			smtp, self._smtp = self._smtp, None
+			try:
+				if smtp is None:
+					smtp = self._connect()
+					failed_recipients = self._sendmail(smtp, msg)
+				else:
+					try:
+						failed_recipients = self._sendmail(smtp, msg)
+					except (smtplib.SMTPServerDisconnected, socket.error) as e:
+						# pooled connection closed by server meanwhile - reconnect:
+						self._logSys.debug(
+							"Connection to '%s' lost (%s), reconnect", self.host, e)
+						self._disconnect(smtp)
+						smtp = self._connect()
+						failed_recipients = self._sendmail(smtp, msg)
+			except smtplib.SMTPConnectError:
+				self._logSys.error("Error connecting to host '%s'", self.host)
+				raise
+			except smtplib.SMTPAuthenticationError:
+				self._logSys.error(
+					"Failed to authenticate with host '%s' user '%s'",
+					self.host, self.user)
+				raise
+			except smtplib.SMTPException:
+				self._logSys.error(
+					"Error sending mail to host '%s' from '%s' to '%s'",
+					self.host, self.fromaddr, self.toaddr)
+				raise
+			else:
+				if failed_recipients:
+					self._logSys.warning(
+						"Email to '%s' failed to following recipients: %r",
+						self.toaddr, failed_recipients)
+				self._logSys.debug("Email '%s' successfully sent", subject)
+				# keep connection for next emails:
+				if self.idletimeout > 0:
+					self._smtp, smtp = smtp, None
+					self._lastUsed = time.time()
+					self._startIdleTimer(self.idletimeout)
+			finally:
+				if smtp is not None:
+					self._disconnect(smtp)
+
+	def _connect(self):
 		smtp = smtplib.SMTP()
 		try:
 			self._logSys.debug("Connected to SMTP '%s', response: %i: %s",
 				self.host, *smtp.connect(self.host))
 			if self.user and self.password:
 				smtp.login(self.user, self.password)
-			failed_recipients = smtp.sendmail(
-				self.fromaddr, self.toaddr.split(", "), msg.as_string())
-		except smtplib.SMTPConnectError:
-			self._logSys.error("Error connecting to host '%s'", self.host)
-			raise
-		except smtplib.SMTPAuthenticationError:
-			self._logSys.error(
-				"Failed to authenticate with host '%s' user '%s'",
-				self.host, self.user)
-			raise
-		except smtplib.SMTPException:
-			self._logSys.error(
-				"Error sending mail to host '%s' from '%s' to '%s'",
-				self.host, self.fromaddr, self.toaddr)
+		except Exception:
+			self._disconnect(smtp)
 			raise
-		else:
-			if failed_recipients:
-				self._logSys.warning(
-					"Email to '%s' failed to following recipients: %r",
-					self.toaddr, failed_recipients)
-			self._logSys.debug("Email '%s' successfully sent", subject)
-		finally:
-			try:
-				self._logSys.debug("Disconnected from '%s', response %i: %s",
-					self.host, *smtp.quit())
-			except smtplib.SMTPServerDisconnected:
-				pass # Not connected
+		return smtp
+
+	def _sendmail(self, smtp, msg):
+		return smtp.sendmail(
+			self.fromaddr, self.toaddr.split(", "), msg.as_string())
+
+	def _disconnect(self, smtp):
+		try:
+			self._logSys.debug("Disconnected from '%s', response %i: %s",
+				self.host, *smtp.quit())
+		except (smtplib.SMTPServerDisconnected, socket.error):
+			smtp.close() # Not connected
+
+	def _startIdleTimer(self, timeout):
+		deadline = time.time() + timeout
+		if self._idleTimer is not None:
+			# already scheduled early enough (rescheduled by check if still used):
+			if self._idleDeadline <= deadline:
+				return
+			self._idleTimer.cancel()
+		self._idleTimer = threading.Timer(timeout, self._checkIdle)
+		self._idleDeadline = deadline
+		self._idleTimer.daemon = True
+		self._idleTimer.start()
+
+	def _checkIdle(self):
+		"""Closes the pooled connection if idle longer than `idletimeout`.
+		"""
+		with self._lock:
+			if self._idleTimer is threading.current_thread():
+				self._idleTimer = None
+			if self._smtp is None:
+				return
+			idle = time.time() - self._lastUsed
+			if idle < self.idletimeout:
+				self._startIdleTimer(self.idletimeout - idle)
+				return
+			smtp, self._smtp = self._smtp, None
+			self._disconnect(smtp)
+
+	def _close(self):
+		"""Closes the pooled connection.
+		"""
+		with self._lock:
+			if self._idleTimer is not None:
+				self._idleTimer.cancel()
+				self._idleTimer = None
+			smtp, self._smtp = self._smtp, None
+			if smtp is not None:
+				self._disconnect(smtp)
 
 	def start(self):
 		"""Sends email to recipients informing that the jail has started.
@@ -196,11 +305,17 @@ class SMTPAction(ActionBase):
 
 	def stop(self):
 		"""Sends email to recipients informing that the jail has stopped.
+
+		The bans collected for digest are sent before.
 		"""
-		self._sendMessage(
-			"[Fail2Ban] %(jailname)s: stopped on %(hostname)s" %
-				self.message_values,
-			messages['stop'] % self.message_values)
+		try:
+			self._sendDigest()
+			self._sendMessage(
+				"[Fail2Ban] %(jailname)s: stopped on %(hostname)s" %
+					self.message_values,
+				messages['stop'] % self.message_values)
+		finally:
+			self._close()
 
 	def ban(self, aInfo):
 		"""Sends email to recipients informing that ban has occurred.
@@ -211,15 +326,95 @@ class SMTPAction(ActionBase):
 			Dictionary which includes information in relation to
 			the ban.
 		"""
+		subject, message = self._banMessage(aInfo)
+		if self.digest > 0:
+			self._addDigest([(subject, message, self._banEntry(aInfo))])
+			return
+		self._sendMessage(subject, message)
+
+	def ban_many(self, aInfos):
+		"""Sends single email to recipients informing that many bans have
+		occurred.
+
+		Parameters
+		----------
+		aInfos : list
+			List of dictionaries which include information in relation to
+			each ban.
+		"""
+		entries = [self._banEntry(aInfo) for aInfo in aInfos]
+		if self.digest > 0:
+			self._addDigest([(None, None, entry) for entry in entries])
+			return
+		self._sendMessage(*self._banManyMessage(entries))
+
+	def _banMessage(self, aInfo):
 		aInfo.update(self.message_values)
 		message = "".join([
 			messages['ban']['head'],
 			messages['ban'].get(self.matches, ""),
 			messages['ban']['tail']
 			])
-		self._sendMessage(
+		return (
 			"[Fail2Ban] %(jailname)s: banned %(ip)s from %(hostname)s" %
 				aInfo,
 			message % aInfo)
 
+	def _banEntry(self, aInfo):
+		"""Part of email informing on many bans, describing single ban.
+		"""
+		aInfo.update(self.message_values)
+		return "".join([
+			messages['ban_many']['ip'],
+			messages['ban'].get(self.matches, ""),
+			]) % aInfo
+
+	def _banManyMessage(self, entries):
+		values = dict(self.message_values)
+		values['ipcount'] = len(entries)
+		return (
+			"[Fail2Ban] %(jailname)s: banned %(ipcount)i IPs from %(hostname)s" %
+				values,
+			"".join([messages['ban_many']['head'] % values] + entries +
+				[messages['ban']['tail']]))
+
+	def _addDigest(self, bans):
+		"""Collects bans, to be sent together after `digest` seconds.
+		"""
+		with self._digestLock:
+			self._digestBans.extend(bans)
+			self._scheduleDigest()
+
+	def _scheduleDigest(self):
+		# (called under digest lock)
+		if self._digestTimer is None:
+			self._digestTimer = threading.Timer(self.digest, self._sendDigest)
+			self._digestTimer.daemon = True
+			self._digestTimer.start()
+
+	def _sendDigest(self):
+		"""Sends the collected bans (single email).
+
+		If sending fails, the bans are kept (in front of bans collected meanwhile)
+		and sent with the next digest.
+		"""
+		with self._digestLock:
+			bans, self._digestBans = self._digestBans, []
+			if self._digestTimer is not None:
+				self._digestTimer.cancel()
+				self._digestTimer = None
+		if not bans:
+			return
+		try:
+			if len(bans) == 1 and bans[0][0] is not None:
+				self._sendMessage(*bans[0][:2])
+			else:
+				self._sendMessage(*self._banManyMessage([entry for _, _, entry in bans]))
+		except Exception as e:
+			self._logSys.error("Failed to send digest of %i bans, retry in %s seconds: %s",
+				len(bans), self.digest, e)
+			with self._digestLock:
+				self._digestBans[:0] = bans
+				self._scheduleDigest()
+
 Action = SMTPAction
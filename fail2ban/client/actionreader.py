@@ -43,6 +43,8 @@ class ActionReader(DefinitionInitConfigReader):
 		"actionrepair": ["string", None],
 		"actionban": ["string", None],
 		"actionunban": ["string", None],
+		"actionban_batch": ["string", None],
+		"actionunban_batch": ["string", None],
 	}
 
 	def __init__(self, file_, jailName, initOpts, **kwargs):
@@ -55,6 +55,12 @@ class Fail2banReader(ConfigReader):
 				["string", "syslogsocket", "auto"],
 				["string", "dbfile", "/var/lib/fail2ban/fail2ban.sqlite3"],
 				["string", "dbpurgeage", "1d"]]
+		for cache in ("ipaddr", "dnstoip", "iptodns"):
+			opts.append(["int", "cache.%s.maxcount" % cache, None])
+			opts.append(["string", "cache.%s.maxtime" % cache, None])
+		opts += [["int", "dns.threads", None],
+				["string", "dns.timeout", None],
+				["string", "dns.negtime", None]]
 		self.__opts = ConfigReader.getOptions(self, "Definition", opts)
 		if updateMainOpt:
 			self.__opts.update(updateMainOpt)
@@ -71,5 +77,7 @@ class Fail2banReader(ConfigReader):
 		for opt in self.__opts:
 			if opt in order:
 				stream.append((order[opt], ["set", opt, self.__opts[opt]]))
+			elif opt.startswith(("cache.", "dns.")):
+				stream.append((60, ["set", opt, self.__opts[opt]]))
 		return [opt[1] for opt in sorted(stream)]
 	
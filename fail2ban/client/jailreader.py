@@ -104,6 +104,9 @@ class JailReader(ConfigReader):
 				["string", "logencoding", None],
 				["string", "backend", "auto"],
 				["int",    "maxretry", None],
+				["int",    "maxfailures", None],
+				["string", "evictpolicy", None],
+				["string", "countmode", None],
 				["string", "findtime", None],
 				["string", "bantime", None],
 				["bool",   "bantime.increment", None],
@@ -113,10 +116,15 @@ class JailReader(ConfigReader):
 				["string", "bantime.maxtime", None],
 				["string", "bantime.rndtime", None],
 				["bool",   "bantime.overalljails", None],
+				["int",    "actionthreads", None],
 				["string", "usedns", None], # be sure usedns is before all regex(s) in stream
 				["string", "failregex", None],
 				["string", "ignoreregex", None],
 				["string", "ignorecommand", None],
+				["string", "ignorecache.maxcount", None],
+				["string", "ignorecache.maxtime", None],
+				["string", "ignorecache.negtime", None],
+				["bool",   "ignorecache.async", None],
 				["string", "ignoreip", None],
 				["string", "filter", ""],
 				["string", "action", ""]]
@@ -223,8 +231,8 @@ class JailReader(ConfigReader):
 				stream.append(["set", self.__name, "logencoding", value])
 			elif opt == "backend":
 				backend = value
-			elif opt == "maxretry":
-				stream.append(["set", self.__name, "maxretry", value])
+			elif opt in ("maxretry", "maxfailures", "evictpolicy", "countmode"):
+				stream.append(["set", self.__name, opt, value])
 			elif opt == "ignoreip":
 				for ip in splitwords(value):
 					stream.append(["set", self.__name, "addignoreip", ip])
@@ -234,6 +242,8 @@ class JailReader(ConfigReader):
 				stream.append(["set", self.__name, "bantime", value])
 			elif opt.startswith("bantime."):
 				stream.append(["set", self.__name, opt, self.__opts[opt]])
+			elif opt == "actionthreads":
+				stream.append(["set", self.__name, "actionthreads", value])
 			elif opt == "usedns":
 				stream.append(["set", self.__name, "usedns", value])
 			elif opt in ("failregex", "ignoreregex"):
@@ -248,6 +258,8 @@ class JailReader(ConfigReader):
 					stream.append(["set", self.__name, "add" + opt, multi[0]])
 			elif opt == "ignorecommand":
 				stream.append(["set", self.__name, "ignorecommand", value])
+			elif opt.startswith("ignorecache."):
+				stream.append(["set", self.__name, opt, value])
 		if self.__filter:
 			stream.extend(self.__filter.convert())
 		for action in self.__actions:
@@ -73,7 +73,19 @@ protocol = [
 ["set dbfile <FILE>", "set the location of fail2ban persistent datastore. Set to \"None\" to disable"], 
 ["get dbfile", "get the location of fail2ban persistent datastore"], 
 ["set dbpurgeage <SECONDS>", "sets the max age in <SECONDS> that history of bans will be kept"], 
-["get dbpurgeage", "gets the max age in seconds that history of bans will be kept"], 
+["get dbpurgeage", "gets the max age in seconds that history of bans will be kept"],
+["set cache.<CACHE>.maxcount <COUNT>", "sets the max <COUNT> of entries of <CACHE> (ipaddr, dnstoip or iptodns)"], 
+["set cache.<CACHE>.maxtime <TIME>", "sets the <TIME> to live of entries of <CACHE> (ipaddr, dnstoip or iptodns)"], 
+["get cache.<CACHE>.maxcount", "gets the max count of entries of <CACHE>"], 
+["get cache.<CACHE>.maxtime", "gets the time to live of entries of <CACHE>"], 
+["get cache.<CACHE>.stats", "gets the hits, misses and count of entries of <CACHE>"],
+["set dns.threads <COUNT>", "sets the <COUNT> of threads resolving DNS names in background (0 - resolve synchronously)"], 
+["set dns.timeout <TIME>", "sets the deadline <TIME> of resolving of DNS name in background"], 
+["set dns.negtime <TIME>", "sets the <TIME> to live of not resolved DNS names in cache"], 
+["get dns.threads", "gets the count of threads resolving DNS names in background"], 
+["get dns.timeout", "gets the deadline of resolving of DNS name in background"], 
+["get dns.negtime", "gets the time to live of not resolved DNS names in cache"], 
+["get cmdlocks", "gets the statistic of locks serializing action commands (resource, limit, count, waits, wait time and max wait time)"], 
 ['', "JAIL CONTROL", ""],
 ["add <JAIL> <BACKEND>", "creates <JAIL> using <BACKEND>"], 
 ["start <JAIL>", "starts the jail <JAIL>"], 
@@ -91,6 +103,7 @@ protocol = [
 ["set <JAIL> addfailregex <REGEX>", "adds the regular expression <REGEX> which must match failures for <JAIL>"], 
 ["set <JAIL> delfailregex <INDEX>", "removes the regular expression at <INDEX> for failregex"], 
 ["set <JAIL> ignorecommand <VALUE>", "sets ignorecommand of <JAIL>"],
+["set <JAIL> ignorecache.<OPT> <VALUE>", "sets option <OPT> (maxcount, maxtime, negtime or async) of the cache for verdicts of ignorecommand of <JAIL>"],
 ["set <JAIL> addignoreregex <REGEX>", "adds the regular expression <REGEX> which should match pattern to exclude for <JAIL>"],
 ["set <JAIL> delignoreregex <INDEX>", "removes the regular expression at <INDEX> for ignoreregex"], 
 ["set <JAIL> findtime <TIME>", "sets the number of seconds <TIME> for which the filter will look back for <JAIL>"], 
@@ -100,7 +113,11 @@ protocol = [
 ["set <JAIL> banip <IP>", "manually Ban <IP> for <JAIL>"], 
 ["set <JAIL> unbanip <IP>", "manually Unban <IP> in <JAIL>"], 
 ["set <JAIL> maxretry <RETRY>", "sets the number of failures <RETRY> before banning the host for <JAIL>"], 
+["set <JAIL> maxfailures <COUNT>", "sets the max <COUNT> of tracked failures for <JAIL> (0 - unlimited)"], 
+["set <JAIL> evictpolicy <POLICY>", "sets the eviction <POLICY> (retry or oldest) if max count of tracked failures reached for <JAIL>"], 
+["set <JAIL> countmode <MODE>", "sets the counting <MODE> (exact or sketch) of failures for <JAIL>"], 
 ["set <JAIL> maxlines <LINES>", "sets the number of <LINES> to buffer for regex search for <JAIL>"], 
+["set <JAIL> actionthreads <COUNT>", "sets the <COUNT> of threads executing the actions of <JAIL> (0 - synchronously)"], 
 ["set <JAIL> addaction <ACT>[ <PYTHONFILE> <JSONKWARGS>]", "adds a new action named <ACT> for <JAIL>. Optionally for a Python based action, a <PYTHONFILE> and <JSONKWARGS> can be specified, else will be a Command Action"], 
 ["set <JAIL> delaction <ACT>", "removes the action <ACT> from <JAIL>"], 
 ["", "COMMAND ACTION CONFIGURATION", ""],
@@ -110,6 +127,8 @@ protocol = [
 ["set <JAIL> action <ACT> actionban <CMD>", "sets the ban command <CMD> of the action <ACT> for <JAIL>"],
 ["set <JAIL> action <ACT> actionunban <CMD>", "sets the unban command <CMD> of the action <ACT> for <JAIL>"], 
 ["set <JAIL> action <ACT> timeout <TIMEOUT>", "sets <TIMEOUT> as the command timeout in seconds for the action <ACT> for <JAIL>"],
+["set <JAIL> action <ACT> lock <RESOURCES>", "sets the <RESOURCES> serializing the commands of the action <ACT> for <JAIL> (empty - firewall tools used in command, none - not serialized)"],
+["set <JAIL> action <ACT> concurrency <COUNT>", "sets the <COUNT> of commands allowed to run concurrently on the lock resources of the action <ACT> for <JAIL>"],
 ["", "GENERAL ACTION CONFIGURATION", ""],
 ["set <JAIL> action <ACT> <PROPERTY> <VALUE>", "sets the <VALUE> of <PROPERTY> for the action <ACT> for <JAIL>"],
 ["set <JAIL> action <ACT> <METHOD>[ <JSONKWARGS>]", "calls the <METHOD> with <JSONKWARGS> for the action <ACT> for <JAIL>"],
@@ -119,6 +138,7 @@ protocol = [
 ["get <JAIL> journalmatch", "gets the journal filter match for <JAIL>"],
 ["get <JAIL> ignoreip", "gets the list of ignored IP addresses for <JAIL>"],
 ["get <JAIL> ignorecommand", "gets ignorecommand of <JAIL>"],
+["get <JAIL> ignorecache.<OPT>", "gets option <OPT> of the cache for verdicts of ignorecommand of <JAIL>"],
 ["get <JAIL> failregex", "gets the list of regular expressions which matches the failures for <JAIL>"],
 ["get <JAIL> ignoreregex", "gets the list of regular expressions which matches patterns to ignore for <JAIL>"],
 ["get <JAIL> findtime", "gets the time for which the filter will look back for failures for <JAIL>"],
@@ -126,7 +146,12 @@ protocol = [
 ["get <JAIL> datepattern", "gets the patern used to match date/times for <JAIL>"],
 ["get <JAIL> usedns", "gets the usedns setting for <JAIL>"],
 ["get <JAIL> maxretry", "gets the number of failures allowed for <JAIL>"],
+["get <JAIL> maxfailures", "gets the max count of tracked failures for <JAIL>"],
+["get <JAIL> evictpolicy", "gets the eviction policy for <JAIL>"],
+["get <JAIL> countmode", "gets the counting mode of failures for <JAIL>"],
 ["get <JAIL> maxlines", "gets the number of lines to buffer for <JAIL>"],
+["get <JAIL> actionthreads", "gets the count of threads executing the actions of <JAIL>"],
+["get <JAIL> actionstats", "gets the statistic of actions (ban latency count, average and max time, queued tasks, failed executions waiting for retry, count of failures and given up executions) of <JAIL>"],
 ["get <JAIL> actions", "gets a list of actions for <JAIL>"],
 ["", "COMMAND ACTION INFORMATION",""],
 ["get <JAIL> action <ACT> actionstart", "gets the start command for the action <ACT> for <JAIL>"],
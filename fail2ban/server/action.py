@@ -40,18 +40,182 @@ from ..helpers import getLogger
 # Gets the instance of the logger.
 logSys = getLogger(__name__)
 
-# Create a lock for running system commands
-_cmd_lock = threading.Lock()
-
 # Todo: make it configurable resp. automatically set, ex.: `[ -f /proc/net/if_inet6 ] && echo 'yes' || echo 'no'`:
 allowed_ipv6 = True
 
 # max tag replacement count:
 MAX_TAG_REPLACE_COUNT = 10
 
+# max count of IPs substituted in single batch command (tag <ips>):
+MAX_BATCH_COUNT = 500
+
 # compiled RE for tag name (replacement name) 
 TAG_CRE = re.compile(r'<([^ <>]+)>')
 
+# compiled RE to find firewall tools in the command (resources serialized by default, see CmdLock):
+CMD_TOOLS_CRE = re.compile(
+	r'(?:^|[\s;|&(/`])(iptables|ip6tables|ipset|nft|firewall-cmd|ebtables|ipfw|pfctl|npfctl|shorewall|ufw)'
+	r'(?:-(?:restore|save|multi|legacy|nft))?(?=[\s;|&)`]|$)')
+
+
+class CmdLock(object):
+	"""Limits the count of concurrently executed commands using the same resource.
+
+	The locks are named by resource (e.g. firewall tool like "iptables") and shared
+	process-wide (see `get`), so the commands of different actions resp. jails
+	touching the same resource are serialized (resp. limited to `limit` parallel
+	commands), and all other commands are executed in parallel.
+	The limit is a property of the resource: set by the first action configuring
+	it, a different limit of other actions is ignored (with a warning).
+	Collects statistic of waiting for the lock.
+	"""
+
+	_locks = {}
+	_locksLock = threading.Lock()
+
+	def __init__(self, name, limit=None):
+		self.name = name
+		self.limit = max(1, int(limit or 1))
+		## whether the limit is configured (otherwise default 1 of lock found by command):
+		self.limitSet = limit is not None
+		self._cond = threading.Condition()
+		self._active = 0
+		## count of acquires, count of waits, sum and max of wait time:
+		self.count = 0
+		self.waits = 0
+		self.waitTime = 0
+		self.maxWaitTime = 0
+
+	@classmethod
+	def get(cls, name, limit=None):
+		"""Returns the lock of the resource `name` (created if not yet exists)
+
+		The `limit` is applied if the lock has no configured limit yet,
+		otherwise a different limit is ignored with a warning.
+		"""
+		with cls._locksLock:
+			lock = cls._locks.get(name)
+			if lock is None:
+				lock = cls._locks[name] = cls(name, limit)
+			elif limit is not None:
+				if not lock.limitSet:
+					lock.setLimit(limit)
+				elif lock.limit != max(1, int(limit)):
+					logSys.warning("Concurrency %s for resource %r ignored, it is already limited to %s",
+						limit, name, lock.limit)
+			return lock
+
+	@classmethod
+	def forCommand(cls, realCmd):
+		"""Returns (sorted) list of locks of the firewall tools used in the command"""
+		names = set(CMD_TOOLS_CRE.findall(realCmd))
+		return [cls.get(name) for name in sorted(names)]
+
+	@classmethod
+	def getStats(cls):
+		"""Returns statistic of all locks (name, limit, count, waits, wait time, max wait time)"""
+		with cls._locksLock:
+			locks = sorted(cls._locks.itervalues(), key=lambda l: l.name)
+		return [(l.name, l.limit, l.count, l.waits, round(l.waitTime, 3), round(l.maxWaitTime, 3))
+			for l in locks]
+
+	def setLimit(self, limit):
+		with self._cond:
+			self.limit = max(1, int(limit))
+			self.limitSet = True
+			self._cond.notify_all()
+
+	def acquire(self):
+		with self._cond:
+			if self._active >= self.limit:
+				stime = time.time()
+				while self._active >= self.limit:
+					self._cond.wait()
+				wtime = time.time() - stime
+				self.waits += 1
+				self.waitTime += wtime
+				if self.maxWaitTime < wtime:
+					self.maxWaitTime = wtime
+			self._active += 1
+			self.count += 1
+
+	def release(self):
+		with self._cond:
+			self._active -= 1
+			self._cond.notify()
+
+	def __enter__(self):
+		self.acquire()
+		return self
+
+	def __exit__(self, *args):
+		self.release()
+
+
+class CommandTemplate(object):
+	"""A command compiled into static parts and slots of dynamic tags.
+
+	The static tags (properties of action) should be already replaced in the
+	command, so the remaining tags (like `<ip>`, `<failures>`, `<matches>`)
+	are the slots filled on `render` with the ban information. The command
+	is compiled once, so rendering is a single join of parts, and only the
+	values of slots are escaped (see `CommandAction.escapeTag`).
+
+	Parameters
+	----------
+	cmd : str
+		Command with static tags already replaced.
+	conditional : str
+		Conditional of tags (e.g. "family=inet6").
+	escapedTags : set
+		Tags those values should be escaped.
+	"""
+
+	__slots__ = ('cmd', 'conditional', '_parts', '_slots')
+
+	def __init__(self, cmd, conditional='', escapedTags=()):
+		self.cmd = cmd
+		self.conditional = conditional
+		# split gives static parts at even and tag names at odd positions:
+		parts = TAG_CRE.split(cmd)
+		slots = []
+		for i in xrange(1, len(parts), 2):
+			tag = parts[i]
+			slots.append((i, tag, tag + '?' + conditional if conditional else None, tag in escapedTags))
+			# missing tags remain unchanged (can be valid shell constructs like <STDIN>):
+			parts[i] = '<' + tag + '>'
+		self._parts = parts
+		self._slots = tuple(slots)
+
+	def render(self, aInfo):
+		"""Fills the slots with values of `aInfo`.
+
+		Returns
+		-------
+		str
+			The command, or None if some (not escaped) value contains further
+			tags to interpolate, so the command should be substituted using
+			`CommandAction.replaceTag`.
+		"""
+		if not self._slots:
+			return self.cmd
+		parts = self._parts[:]
+		for i, tag, ctag, escape in self._slots:
+			value = None
+			if ctag is not None:
+				value = aInfo.get(ctag)
+			if value is None:
+				value = aInfo.get(tag)
+				if value is None:
+					continue
+			value = str(value)
+			if escape:
+				value = CommandAction.escapeTag(value)
+			elif '<' in value and TAG_CRE.search(value):
+				return None
+			parts[i] = value
+		return ''.join(parts)
+
 
 class CallingMap(MutableMapping):
 	"""A Mapping type which returns the result of callable values.
@@ -99,6 +263,41 @@ class CallingMap(MutableMapping):
 		return self.__class__(self.data.copy())
 
 
+class BanInfo(CallingMap):
+	"""Immutable ban information, shared by all actions of the ban.
+
+	The callable values (e.g. the joined matches) are evaluated lazily by
+	first access and remembered, so they are evaluated at most once, and
+	only if some action reads them. The actions modifying the ban
+	information should work with a `copy` (mutable `CallingMap`).
+	"""
+
+	def __init__(self, *args, **kwargs):
+		CallingMap.__init__(self, *args, **kwargs)
+		self._values = {}
+
+	def __getitem__(self, key):
+		value = self.data[key]
+		if not callable(value):
+			return value
+		try:
+			return self._values[key]
+		except KeyError:
+			value = self._values[key] = value()
+			return value
+
+	def __setitem__(self, key, value):
+		raise TypeError("%s is immutable" % self.__class__.__name__)
+
+	def __delitem__(self, key):
+		raise TypeError("%s is immutable" % self.__class__.__name__)
+
+	def copy(self):
+		data = self.data.copy()
+		data.update(self._values)
+		return CallingMap(data)
+
+
 class ActionBase(object):
 	"""An abstract base class for actions in Fail2Ban.
 
@@ -113,6 +312,11 @@ class ActionBase(object):
 	- ban(aInfo)
 	- unban(aInfo)
 
+	Optional methods (processing many tickets at once):
+
+	- ban_many(aInfos)
+	- unban_many(aInfos)
+
 	Called when action is created, but before the jail/actions is
 	started. This should carry out necessary methods to initialise
 	the action but not "start" the action.
@@ -181,6 +385,45 @@ class ActionBase(object):
 		"""
 		pass
 
+	def ban_many(self, aInfos):
+		"""Executed when many bans occur together (e.g. within the same
+		cycle of the jail, or restored at start of jail).
+
+		Default implementation does nothing and returns False, so `ban`
+		gets executed for each ticket.
+
+		Parameters
+		----------
+		aInfos : list
+			List of dictionaries with ban information of each ticket.
+
+		Returns
+		-------
+		bool
+			False if not supported, so `ban` should be executed for each
+			ticket separately.
+		"""
+		return False
+
+	def unban_many(self, aInfos):
+		"""Executed when many bans expire together (or get flushed by stop
+		or reload of the jail).
+
+		Same as `ban_many`, but for unban.
+
+		Parameters
+		----------
+		aInfos : list
+			List of dictionaries with ban information of each ticket.
+
+		Returns
+		-------
+		bool
+			False if not supported, so `unban` should be executed for each
+			ticket separately.
+		"""
+		return False
+
 
 class CommandAction(ActionBase):
 	"""A action which executes OS shell commands.
@@ -200,12 +443,17 @@ class CommandAction(ActionBase):
 	Attributes
 	----------
 	actionban
+	actionban_batch
 	actioncheck
+	actioncheck_interval
 	actionreload
 	actionrepair
 	actionstart
 	actionstop
 	actionunban
+	actionunban_batch
+	concurrency
+	lock
 	timeout
 	"""
 
@@ -217,12 +465,22 @@ class CommandAction(ActionBase):
 		self.__init = 1
 		try:
 			self.timeout = 60
+			## Interval (seconds) a successful "actioncheck" is valid (0 - check before each command).
+			self.actioncheck_interval = 0
+			## Resource(s) to serialize the commands on (empty - firewall tools used in command, "none" - no lock).
+			self.lock = ''
+			## Count of commands allowed to run concurrently on the resource(s) given in `lock`.
+			self.concurrency = 1
 			## Command executed in order to initialize the system.
 			self.actionstart = ''
 			## Command executed when an IP address gets banned.
 			self.actionban = ''
 			## Command executed when an IP address gets removed.
 			self.actionunban = ''
+			## Command executed when many IP addresses get banned together (tag <ips>).
+			self.actionban_batch = ''
+			## Command executed when many IP addresses get removed together (tag <ips>).
+			self.actionunban_batch = ''
 			## Command executed in order to check requirements.
 			self.actioncheck = ''
 			## Command executed in order to restore sane environment in error case.
@@ -238,7 +496,10 @@ class CommandAction(ActionBase):
 		super(CommandAction, self).__init__(jail, name)
 		self.__init = 1
 		self.__properties = None
+		self.__locks = None
 		self.__substCache = {}
+		self.__templates = {}
+		self.__checked = {}
 		self.clearAllParams()
 		self._logSys.debug("Created %s" % self.__class__)
 
@@ -249,11 +510,14 @@ class CommandAction(ActionBase):
 	def __setattr__(self, name, value):
 		if not name.startswith('_') and not self.__init and not callable(value):
 			# special case for some pasrameters:
-			if name in ('timeout', 'bantime'):
+			if name in ('timeout', 'bantime', 'actioncheck_interval'):
 				value = str(MyTime.str2seconds(value))
-			# parameters changed - clear properties and substitution cache:
+			# parameters changed - clear properties, locks and substitution cache:
 			self.__properties = None
+			self.__locks = None
 			self.__substCache.clear()
+			self.__templates.clear()
+			self.__checked.clear()
 			#self._logSys.debug("Set action %r %s = %r", self._name, name, value)
 			self._logSys.debug("  Set %s = %r", name, value)
 		# set:
@@ -280,6 +544,25 @@ class CommandAction(ActionBase):
 	def _substCache(self):
 		return self.__substCache
 
+	@property
+	def _locks(self):
+		"""The locks of the commands of this action (see CmdLock).
+
+		None if the locks should be found by the firewall tools used in the command.
+		"""
+		locks = self.__locks
+		if locks is None:
+			lock = str(self.lock).strip()
+			if not lock:
+				return None
+			if lock.lower() == 'none':
+				locks = []
+			else:
+				limit = int(self.concurrency)
+				locks = [CmdLock.get(name, limit) for name in sorted(set(lock.split()))]
+			self.__locks = locks
+		return locks
+
 	def _executeOperation(self, tag, operation):
 		"""Executes the operation commands (like "actionstart", "actionstop", etc).
 
@@ -293,13 +576,13 @@ class CommandAction(ActionBase):
 			startCmd = self.replaceTag(tag, self._properties, 
 				conditional='family=inet4', cache=self.__substCache)
 			if startCmd:
-				res &= self.executeCmd(startCmd, self.timeout)
+				res &= self.executeCmd(startCmd, self.timeout, locks=self._locks)
 			# start ipv6 actions if available:
 			if allowed_ipv6:
 				startCmd6 = self.replaceTag(tag, self._properties, 
 					conditional='family=inet6', cache=self.__substCache)
 				if startCmd6 and startCmd6 != startCmd:
-					res &= self.executeCmd(startCmd6, self.timeout)
+					res &= self.executeCmd(startCmd6, self.timeout, locks=self._locks)
 			if not res:
 				raise RuntimeError("Error %s action %s/%s" % (operation, self._jail, self._name,))
 		except ValueError as e:
@@ -311,6 +594,7 @@ class CommandAction(ActionBase):
 		Replace the tags in the action command with actions properties
 		and executes the resulting command.
 		"""
+		self.__checked.clear()
 		return self._executeOperation('<actionstart>', 'starting')
 
 	def ban(self, aInfo):
@@ -343,12 +627,52 @@ class CommandAction(ActionBase):
 		if not self._processCmd('<actionunban>', aInfo):
 			raise RuntimeError("Error unbanning %(ip)s" % aInfo)
 
+	def ban_many(self, aInfos):
+		"""Executes the "actionban_batch" command for many tickets at once.
+
+		Replaces the tags in the action command with actions properties
+		and the tag `<ips>` with space separated list of IPs to ban.
+		The command is executed once per address family (and per
+		`MAX_BATCH_COUNT` IPs).
+
+		Parameters
+		----------
+		aInfos : list
+			List of dictionaries with ban information of each ticket.
+
+		Returns
+		-------
+		bool
+			False if no "actionban_batch" defined, so the tickets should
+			be banned each separately.
+		"""
+		return self._processBatch('<actionban_batch>', aInfos, 'banning')
+
+	def unban_many(self, aInfos):
+		"""Executes the "actionunban_batch" command for many tickets at once.
+
+		Same as `ban_many`, but for unban.
+
+		Parameters
+		----------
+		aInfos : list
+			List of dictionaries with ban information of each ticket.
+
+		Returns
+		-------
+		bool
+			False if no "actionunban_batch" defined, so the tickets should
+			be unbanned each separately.
+		"""
+		return self._processBatch('<actionunban_batch>', aInfos, 'unbanning')
+
 	def stop(self):
 		"""Executes the "actionstop" command.
 
 		Replaces the tags in the action command with actions properties
 		and executes the resulting command.
 		"""
+		self.__checked.clear()
 		return self._executeOperation('<actionstop>', 'stopping')
 
 	def reload(self, **kwargs):
@@ -362,6 +686,7 @@ class CommandAction(ActionBase):
 		Replaces the tags in the action command with actions properties
 		and executes the resulting command.
 		"""
+		self.__checked.clear()
 		return self._executeOperation('<actionreload>', 'reloading')
 
 	@classmethod
@@ -511,6 +836,29 @@ class CommandAction(ActionBase):
 		#
 		return string
 
+	def _processBatch(self, cmd, aInfos, operation):
+		"""Executes a batch command (tag <ips>) grouped by address family.
+		"""
+		if not self._properties.get(cmd[1:-1]):
+			return False
+		# group by family (the command may differ, see conditional):
+		groups = {}
+		for aInfo in aInfos:
+			ip = aInfo["ip"]
+			conditional = 'family=inet4'
+			if allowed_ipv6 and ip and asip(ip).isIPv6:
+				conditional = 'family=inet6'
+			groups.setdefault(conditional, []).append(str(ip))
+		failed = []
+		for conditional, ips in sorted(groups.iteritems()):
+			for i in xrange(0, len(ips), MAX_BATCH_COUNT):
+				ips4cmd = ips[i:i+MAX_BATCH_COUNT]
+				if not self._processCmd(cmd, {"ips": " ".join(ips4cmd)}, conditional=conditional):
+					failed += ips4cmd
+		if failed:
+			raise RuntimeError("Error %s %s" % (operation, " ".join(failed)))
+		return True
+
 	def _processCmd(self, cmd, aInfo=None, conditional=''):
 		"""Executes a command with preliminary checks and substitutions.
 
@@ -548,51 +896,102 @@ class CommandAction(ActionBase):
 
 		checkCmd = self.replaceTag('<actioncheck>', self._properties, 
 			conditional=conditional, cache=self.__substCache)
-		if checkCmd:
-			if not self.executeCmd(checkCmd, self.timeout):
-				self._logSys.error(
-					"Invariant check failed. Trying to restore a sane environment")
-				# try to find repair command, if exists - exec it:
-				repairCmd = self.replaceTag('<actionrepair>', self._properties, 
-					conditional=conditional, cache=self.__substCache)
-				if repairCmd:
-					if not self.executeCmd(repairCmd, self.timeout):
-						self._logSys.critical("Unable to restore environment")
-						return False
-				else:
-					# no repair command, try to restart action...
-					# [WARNING] TODO: be sure all banactions get a repair command, because
-					#    otherwise stop/start will theoretically remove all the bans,
-					#    but the tickets are still in BanManager, so in case of new failures
-					#    it will not be banned, because "already banned" will happen.
-					self.stop()
-					self.start()
-				if not self.executeCmd(checkCmd, self.timeout):
-					self._logSys.critical("Unable to restore environment")
-					return False
-
-		# Replace static fields
-		realCmd = self.replaceTag(cmd, self._properties, 
-			conditional=conditional, cache=self.__substCache)
+		# successful check is cached within "actioncheck_interval":
+		if checkCmd and not self.__isChecked(checkCmd):
+			if not self.__check(checkCmd, conditional):
+				return False
 
 		# Replace tags
 		if aInfo is not None:
-			realCmd = self.replaceTag(realCmd, aInfo, conditional=conditional)
+			# command with replaced static fields compiled once, rendered with dynamic tags:
+			tpl = self._compileCmd(cmd, conditional)
+			realCmd = tpl.render(aInfo)
+			if realCmd is None:
+				# embedded tags in ban info - substitute recursive:
+				realCmd = self.replaceTag(tpl.cmd, aInfo, conditional=conditional)
 		else:
 			realCmd = cmd
 
-		return self.executeCmd(realCmd, self.timeout)
+		ret = self.__executeRealCmd(realCmd)
+		if not ret and checkCmd:
+			# command failed - invalidate cached check, so the next command (resp. the
+			# retry of this one by the actions) verifies the environment again:
+			self.__checked.pop(checkCmd, None)
+		return ret
 
-	@staticmethod
-	def executeCmd(realCmd, timeout=60):
+	def _compileCmd(self, cmd, conditional=''):
+		"""Returns the command compiled to the template (see CommandTemplate).
+
+		The static fields (properties) are replaced once, the templates are
+		cached until the parameters of the action get changed.
+		"""
+		ckey = (cmd, conditional)
+		tpl = self.__templates.get(ckey)
+		if tpl is None:
+			tpl = CommandTemplate(
+				self.replaceTag(cmd, self._properties, 
+					conditional=conditional, cache=self.__substCache), 
+				conditional, self._escapedTags)
+			self.__templates[ckey] = tpl
+		return tpl
+
+	def __executeRealCmd(self, realCmd):
+		return self.executeCmd(realCmd, self.timeout, locks=self._locks)
+
+	def __isChecked(self, checkCmd):
+		"""True if the check command succeeded within "actioncheck_interval" seconds.
+		"""
+		interval = float(self.actioncheck_interval)
+		if interval <= 0:
+			return False
+		checked = self.__checked.get(checkCmd)
+		return checked is not None and MyTime.time() < checked + interval
+
+	def __check(self, checkCmd, conditional):
+		"""Executes the check command, in error case tries to restore a sane environment.
+		"""
+		if not self.executeCmd(checkCmd, self.timeout, locks=self._locks):
+			self._logSys.error(
+				"Invariant check failed. Trying to restore a sane environment")
+			# try to find repair command, if exists - exec it:
+			repairCmd = self.replaceTag('<actionrepair>', self._properties, 
+				conditional=conditional, cache=self.__substCache)
+			if repairCmd:
+				if not self.executeCmd(repairCmd, self.timeout, locks=self._locks):
+					self._logSys.critical("Unable to restore environment")
+					return False
+			else:
+				# no repair command, try to restart action...
+				# [WARNING] TODO: be sure all banactions get a repair command, because
+				#    otherwise stop/start will theoretically remove all the bans,
+				#    but the tickets are still in BanManager, so in case of new failures
+				#    it will not be banned, because "already banned" will happen.
+				self.stop()
+				self.start()
+			if not self.executeCmd(checkCmd, self.timeout, locks=self._locks):
+				self._logSys.critical("Unable to restore environment")
+				return False
+		# remember successful check (if cache enabled):
+		if float(self.actioncheck_interval) > 0:
+			self.__checked[checkCmd] = MyTime.time()
+		return True
+
+	@classmethod
+	def executeCmd(cls, realCmd, timeout=60, locks=None):
 		"""Executes a command.
 
+		The commands using the same resource (firewall tool) are serialized,
+		all other commands are executed in parallel.
+
 		Parameters
 		----------
 		realCmd : str
 			The command to execute.
 		timeout : int
 			The time out in seconds for the command.
+		locks : list of CmdLock, optional
+			Locks to acquire during execution, default None - the locks
+			of firewall tools found in the command (see `CmdLock.forCommand`).
 
 		Returns
 		-------
@@ -611,5 +1010,12 @@ class CommandAction(ActionBase):
 			logSys.debug("Nothing to do")
 			return True
 
-		with _cmd_lock:
+		if locks is None:
+			locks = CmdLock.forCommand(realCmd)
+		for lock in locks:
+			lock.acquire()
+		try:
 			return Utils.executeCmd(realCmd, timeout, shell=True, output=False)
+		finally:
+			for lock in reversed(locks):
+				lock.release()
@@ -24,11 +24,14 @@ __author__ = "Cyril Jaquier"
 __copyright__ = "Copyright (c) 2004 Cyril Jaquier"
 __license__ = "GPL"
 
+import heapq
+import itertools
 import logging
 import os
 import sys
 import time
-from collections import Mapping
+from collections import Mapping, deque
+from threading import Condition, Lock, Thread
 try:
 	from collections import OrderedDict
 except ImportError:
@@ -37,7 +40,7 @@ except ImportError:
 from .banmanager import BanManager
 from .observer import Observers
 from .jailthread import JailThread
-from .action import ActionBase, CommandAction, CallingMap
+from .action import ActionBase, CommandAction, BanInfo, CmdLock
 from .mytime import MyTime
 from .utils import Utils
 from ..helpers import getLogger
@@ -46,6 +49,120 @@ from ..helpers import getLogger
 logSys = getLogger(__name__)
 
 
+class ActionExecutor(object):
+	"""Executes the tasks of actions in background threads.
+
+	Each action has own queue of tasks, processed in order by at most one
+	thread at a time (so e.g. the unban is never executed before the ban
+	by the same action). The count of threads is bounded, the queues with
+	lower priority value (firewall actions) are processed first, so slow
+	actions (mail, whois, etc.) do not stall the bans.
+
+	Parameters
+	----------
+	name : str
+		Name used for the threads (jail name).
+	threads : int
+		Max count of threads.
+	"""
+
+	def __init__(self, name, threads=1):
+		self.name = name
+		self.threads = threads
+		self._cond = Condition()
+		## action name -> queue of tasks:
+		self._queues = {}
+		## action name -> priority:
+		self._prio = {}
+		## names of actions currently processed:
+		self._busy = set()
+		self._workers = 0
+		self._active = True
+
+	def __len__(self):
+		"""Count of queued (and currently executed) tasks"""
+		with self._cond:
+			return sum(len(q) for q in self._queues.itervalues()) + len(self._busy)
+
+	def put(self, name, prio, task):
+		"""Adds task (callable) to the queue of action `name`"""
+		with self._cond:
+			q = self._queues.get(name)
+			if q is None:
+				q = self._queues[name] = deque()
+			q.append(task)
+			self._prio[name] = prio
+			if self._workers < self.threads:
+				self._workers += 1
+				th = Thread(target=self._run, name="f2b/a.%s-%d" % (self.name, self._workers))
+				th.daemon = True
+				th.start()
+			self._cond.notify()
+
+	def _next(self):
+		best = None
+		for name, q in self._queues.iteritems():
+			if q and name not in self._busy and (best is None or self._prio[name] < self._prio[best]):
+				best = name
+		return best
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while True:
+					# exit if stopped (and all processed) or count of threads decreased:
+					if self._workers > self.threads:
+						self._workers -= 1
+						self._cond.notify_all()
+						return
+					name = self._next()
+					if name is not None:
+						break
+					if not self._active:
+						self._workers -= 1
+						self._cond.notify_all()
+						return
+					# idle - sleep until notified (new task, task done, setThreads or stop):
+					self._cond.wait()
+				task = self._queues[name].popleft()
+				self._busy.add(name)
+			try:
+				task()
+			except Exception as e: # pragma: no cover
+				logSys.error("Failed to execute task of action %r: %s", name, e,
+					exc_info=logSys.getEffectiveLevel()<=logging.DEBUG)
+			finally:
+				with self._cond:
+					self._busy.discard(name)
+					self._cond.notify_all()
+
+	def setThreads(self, threads):
+		with self._cond:
+			self.threads = threads
+			self._cond.notify_all()
+
+	def wait_empty(self, timeout=None):
+		"""Waits until all queued tasks are processed"""
+		endtime = (time.time() + timeout) if timeout is not None else None
+		with self._cond:
+			while any(self._queues.itervalues()) or self._busy:
+				if not self._workers:
+					return False
+				if endtime is not None:
+					if time.time() >= endtime:
+						return False
+					self._cond.wait(min(1, endtime - time.time()))
+				else:
+					self._cond.wait(1)
+		return True
+
+	def stop(self):
+		"""Stops the threads (after all queued tasks are processed)"""
+		with self._cond:
+			self._active = False
+			self._cond.notify_all()
+
+
 class Actions(JailThread, Mapping):
 	"""Handles jail actions.
 
@@ -74,6 +191,11 @@ class Actions(JailThread, Mapping):
 		The time the thread sleeps for in the loop.
 	"""
 
+	## Count of retries of failed ban/unban of an action:
+	retryAttempts = 6
+	## Delay (seconds) before first retry, doubled by each further attempt:
+	retryDelay = 5
+
 	def __init__(self, jail):
 		JailThread.__init__(self)
 		## The jail which contains this action.
@@ -81,6 +203,19 @@ class Actions(JailThread, Mapping):
 		self._actions = OrderedDict()
 		## The ban manager.
 		self.__banManager = BanManager()
+		## Restored tickets (banned in bulk, see restoreBans):
+		self.__restored = deque()
+		## Executor of the actions (None - executed synchronously in actions thread):
+		self.__executor = None
+		## Ban latency statistic (count, sum, max), time from failure up to ban by all actions:
+		self.__banLatency = [0, 0, 0]
+		self.__banLatencyLock = Lock()
+		## Failed ban/unban executions to retry (heap by time of next attempt):
+		self.__retries = []
+		self.__retrySeq = itertools.count()
+		self.__retryLock = Lock()
+		## Statistic of failed executions (failures, given up after all retries):
+		self.__failures = [0, 0]
 
 	@staticmethod
 	def _load_python_module(pythonModule):
@@ -204,6 +339,56 @@ class Actions(JailThread, Mapping):
 	def getBanTime(self):
 		return self.__banManager.getBanTime()
 
+	def setActionThreads(self, value):
+		"""Sets count of threads executing the actions (0 - synchronously in actions thread)
+		"""
+		value = int(value)
+		if value < 0:
+			raise ValueError("invalid count of action threads %r" % value)
+		executor = self.__executor
+		if value:
+			if executor is None:
+				self.__executor = ActionExecutor(self._jail.name, value)
+			else:
+				executor.setThreads(value)
+		elif executor is not None:
+			self.__executor = None
+			executor.stop()
+		logSys.info("Set actionThreads = %s", value)
+
+	def getActionThreads(self):
+		executor = self.__executor
+		return executor.threads if executor is not None else 0
+
+	def getStats(self):
+		"""Statistic of actions: ban latency (count, avg, max), count of queued tasks,
+		count of failed executions waiting for retry, failures and given up executions
+		"""
+		with self.__banLatencyLock:
+			cnt, tsum, tmax = self.__banLatency
+		executor = self.__executor
+		return [
+			("Ban latency", (cnt, round(float(tsum) / cnt, 3) if cnt else 0, round(tmax, 3))),
+			("Queued tasks", len(executor) if executor is not None else 0),
+			("Retry queue", len(self.__retries)),
+			("Failures", tuple(self.__failures)),
+		]
+
+	def restoreBans(self, tickets):
+		"""Restores bans (tickets from database) in bulk.
+
+		The tickets are banned by the actions thread within a single cycle
+		(not limited by the count of tickets per cycle), so each action gets
+		all of them with single invocation of its batch method `ban_many`,
+		if supported.
+
+		Parameters
+		----------
+		tickets : list
+			The tickets to ban (marked as restored).
+		"""
+		self.__restored.extend(tickets)
+
 	def removeBannedIP(self, ip=None, db=True, ifexists=False):
 		"""Removes banned IP calling actions' unban method
 
@@ -244,6 +429,9 @@ class Actions(JailThread, Mapping):
 		"""
 		if actions is None:
 			actions = self._actions
+		# wait for all queued tasks:
+		if self.__executor is not None:
+			self.__executor.wait_empty()
 		revactions = actions.items()
 		revactions.reverse()
 		for name, action in revactions:
@@ -282,9 +470,18 @@ class Actions(JailThread, Mapping):
 				continue
 			if not Utils.wait_for(lambda: not self.active or self.__checkBan(), self.sleeptime):
 				self.__checkUnBan()
+			self.__checkRetry()
 		
 		self.__flushBan()
+		# the ban list is flushed, so pending retries are obsolete:
+		with self.__retryLock:
+			if self.__retries:
+				logSys.info("[%s] Drop %s failed execution(s) waiting for retry", 
+					self._jail.name, len(self.__retries))
+				self.__retries = []
 		self.stopActions()
+		if self.__executor is not None:
+			self.__executor.stop()
 		return True
 
 	def __getBansMerged(self, mi, overalljails=False):
@@ -330,7 +527,9 @@ class Actions(JailThread, Mapping):
 		"""Check for IP address to ban.
 
 		Look in the jail queue for FailTicket. If a ticket is available,
-		it executes the "ban" command and adds a ticket to the BanManager.
+		it adds a ticket to the BanManager. The tickets banned in this
+		cycle are hereafter executed via the actions (together, using
+		batch method `ban_many` of action if supported).
 
 		Returns
 		-------
@@ -338,11 +537,16 @@ class Actions(JailThread, Mapping):
 			True if an IP address get banned.
 		"""
 		cnt = 0
-		while cnt < 100:
-			ticket = self._jail.getFailTicket()
-			if not ticket:
-				break
-			aInfo = CallingMap()
+		bans = []
+		restored = self.__restored
+		while restored or cnt < 100:
+			# restored tickets all at once, hereafter new tickets from the jail:
+			if restored:
+				ticket = restored.popleft()
+			else:
+				ticket = self._jail.getFailTicket()
+				if not ticket:
+					break
 			bTicket = BanManager.createBanTicket(ticket)
 			btime = ticket.getBanTime()
 			if btime is not None:
@@ -353,10 +557,13 @@ class Actions(JailThread, Mapping):
 			if ticket.restored:
 				bTicket.restored = True
 			ip = bTicket.getIP()
-			aInfo["ip"] = ip
-			aInfo["failures"] = bTicket.getAttempt()
-			aInfo["time"] = bTicket.getTime()
-			aInfo["matches"] = "\n".join(bTicket.getMatches())
+			# ban info shared by all actions, matches joined only if used:
+			aInfo = {
+				"ip": ip,
+				"failures": bTicket.getAttempt(),
+				"time": bTicket.getTime(),
+				"matches": lambda bTicket=bTicket: "\n".join(bTicket.getMatches()),
+			}
 			# retarded merge info via twice lambdas : once for merge, once for matches/failures:
 			if self._jail.database is not None:
 				mi4ip = lambda overalljails=False, self=self, \
@@ -365,6 +572,7 @@ class Actions(JailThread, Mapping):
 				aInfo["ipjailmatches"]  = lambda: "\n".join(mi4ip().getMatches())
 				aInfo["ipfailures"]     = lambda: mi4ip(True).getAttempt()
 				aInfo["ipjailfailures"] = lambda: mi4ip().getAttempt()
+			aInfo = BanInfo(aInfo)
 			reason = {}
 			if self.__banManager.addBanTicket(bTicket, reason=reason):
 				cnt += 1
@@ -372,18 +580,7 @@ class Actions(JailThread, Mapping):
 				if Observers.Main is not None and not bTicket.restored:
 					Observers.Main.add('banFound', bTicket, self._jail, btime)
 				logSys.notice("[%s] %sBan %s", self._jail.name, ('' if not bTicket.restored else 'Restore '), ip)
-				# do actions :
-				for name, action in self._actions.iteritems():
-					try:
-						action.ban(aInfo.copy())
-					except Exception as e:
-						logSys.error(
-							"Failed to execute ban jail '%s' action '%s' "
-							"info '%r': %s",
-							self._jail.name, name, aInfo, e,
-							exc_info=logSys.getEffectiveLevel()<=logging.DEBUG)
-				# after all actions are processed set banned flag:
-				bTicket.banned = True
+				bans.append((bTicket, aInfo))
 			else:
 				if reason.get('expired', 0):
 					logSys.info('[%s] Ignore %s, expired bantime', self._jail.name, ip)
@@ -401,19 +598,196 @@ class Actions(JailThread, Mapping):
 					else logging.NOTICE  if diftm < 60 \
 					else logging.WARNING
 					logSys.log(ll, "[%s] %s already banned", self._jail.name, ip)
+		# do actions :
+		if bans:
+			self.__executeBans(bans)
 		if cnt:
 			logSys.debug("Banned %s / %s, %s ticket(s) in %r", cnt, 
 				self.__banManager.getBanTotal(), self.__banManager.size(), self._jail.name)
 		return cnt
 
+	def __getPriority(self, name, action):
+		"""Priority of the action (firewall actions first, hereafter all others)
+		"""
+		if isinstance(action, CommandAction):
+			try:
+				cmd = action.replaceTag('<actionban>', action._properties, 
+					conditional='family=inet4', cache=action._substCache)
+				if CmdLock.forCommand(cmd):
+					return 0
+			except Exception: # pragma: no cover
+				pass
+		return 1
+
+	def __submit(self, name, action, task, *args):
+		"""Executes task of the action (in executor if enabled, otherwise synchronously)
+		"""
+		executor = self.__executor
+		if executor is None:
+			task(name, action, *args)
+		else:
+			executor.put(name, self.__getPriority(name, action), 
+				lambda: task(name, action, *args))
+
+	def __executeBans(self, bans):
+		"""Executes ban of the tickets by all actions.
+
+		The tickets get banned flag if all actions are processed.
+		"""
+		actions = self._actions.items()
+		if not actions:
+			return self.__bansDone(bans)
+		pending = [len(actions)]
+		lock = Lock()
+		def done():
+			with lock:
+				pending[0] -= 1
+				if pending[0]:
+					return
+			self.__bansDone(bans)
+		for name, action in actions:
+			self.__submit(name, action, self.__banAction, bans, done)
+
+	def __banAction(self, name, action, bans, done):
+		try:
+			if self.__executeMany(name, action, 'ban', bans):
+				return
+			for bTicket, aInfo in bans:
+				try:
+					action.ban(self.__actionInfo(action, aInfo))
+				except Exception as e:
+					logSys.error(
+						"Failed to execute ban jail '%s' action '%s' "
+						"info '%r': %s",
+						self._jail.name, name, aInfo, e,
+						exc_info=logSys.getEffectiveLevel()<=logging.DEBUG)
+					self.__retry(name, 'ban', bTicket, aInfo)
+		finally:
+			done()
+
+	def __bansDone(self, bans):
+		# after all actions are processed set banned flag:
+		tm = MyTime.time()
+		latency = self.__banLatency
+		for bTicket, _ in bans:
+			bTicket.banned = True
+			# ban latency (time of failure up to ban, restored tickets are ignored),
+			# updated by the threads of executor concurrently:
+			if not bTicket.restored:
+				lat = max(0, tm - bTicket.getTime())
+				with self.__banLatencyLock:
+					latency[0] += 1
+					latency[1] += lat
+					if latency[2] < lat:
+						latency[2] = lat
+
+	def __executeMany(self, name, action, op, tickets):
+		"""Executes batch method of the action (`ban_many` or `unban_many`) if supported.
+
+		If the batch fails, each ticket is scheduled for retry separately.
+
+		Parameters
+		----------
+		op : str
+			Operation ("ban" or "unban").
+		tickets : list
+			List of tuples (ticket, aInfo).
+
+		Returns
+		-------
+		bool
+			False if not supported, so the tickets should be processed each separately.
+		"""
+		if len(tickets) < 2:
+			return False
+		method = op + '_many'
+		batch = getattr(action, method, None)
+		if batch is None:
+			return False
+		aInfos = [self.__actionInfo(action, aInfo) for _, aInfo in tickets]
+		try:
+			return batch(aInfos) is not False
+		except Exception as e:
+			logSys.error(
+				"Failed to execute %s jail '%s' action '%s' "
+				"for %s ticket(s): %s",
+				method, self._jail.name, name, len(aInfos), e,
+				exc_info=logSys.getEffectiveLevel()<=logging.DEBUG)
+			for ticket, aInfo in tickets:
+				self.__retry(name, op, ticket, aInfo)
+		return True
+
+	def __retry(self, name, op, ticket, aInfo, attempt=0):
+		"""Schedules retry of failed ban/unban of the action (exponential backoff).
+
+		Gives up after `retryAttempts` retries.
+		"""
+		with self.__retryLock:
+			self.__failures[0] += 1
+			if attempt >= self.retryAttempts:
+				self.__failures[1] += 1
+				logSys.error("[%s] action %r: %s of %s failed, give up after %s retries",
+					self._jail.name, name, op, aInfo["ip"], attempt)
+				return
+			tm = MyTime.time() + self.retryDelay * (2 ** attempt)
+			heapq.heappush(self.__retries, 
+				(tm, next(self.__retrySeq), name, op, ticket, aInfo, attempt + 1))
+
+	def __checkRetry(self):
+		"""Retries failed ban/unban executions which are due.
+
+		The retries of obsolete executions (IP unbanned resp. banned again
+		meanwhile, action removed) are dropped.
+		"""
+		if not self.__retries:
+			return 0
+		tm = MyTime.time()
+		due = []
+		with self.__retryLock:
+			retries = self.__retries
+			while retries and retries[0][0] <= tm:
+				due.append(heapq.heappop(retries))
+		cnt = 0
+		for _, _, name, op, ticket, aInfo, attempt in due:
+			action = self._actions.get(name)
+			if action is None or self.__banManager._inBanList(ticket) != (op == 'ban'):
+				logSys.debug("[%s] action %r: drop obsolete retry of %s %s",
+					self._jail.name, name, op, aInfo["ip"])
+				continue
+			self.__submit(name, action, self.__retryAction, op, ticket, aInfo, attempt)
+			cnt += 1
+		return cnt
+
+	def __retryAction(self, name, action, op, ticket, aInfo, attempt):
+		try:
+			getattr(action, op)(self.__actionInfo(action, aInfo))
+		except Exception as e:
+			logSys.warning("[%s] action %r: retry %s of %s %s failed: %s",
+				self._jail.name, name, attempt, op, aInfo["ip"], e,
+				exc_info=logSys.getEffectiveLevel()<=logging.DEBUG)
+			self.__retry(name, op, ticket, aInfo, attempt)
+			return
+		logSys.notice("[%s] action %r: %s %s succeeded by retry %s",
+			self._jail.name, name, op, aInfo["ip"], attempt)
+
+	@staticmethod
+	def __actionInfo(action, aInfo):
+		"""Ban info for the action: command actions don't modify it, so the shared
+		(immutable) instance is used, other actions get a mutable copy.
+		"""
+		if isinstance(action, CommandAction):
+			return aInfo
+		return aInfo.copy()
+
 	def __checkUnBan(self):
 		"""Check for IP address to unban.
 
-		Unban IP addresses which are outdated.
+		Unban IP addresses which are outdated. The tickets expired together
+		are unbanned together (using batch method `unban_many` of action if
+		supported).
 		"""
 		lst = self.__banManager.unBanList(MyTime.time())
-		for ticket in lst:
-			self.__unBan(ticket)
+		self.__unBanMany(lst)
 		cnt = len(lst)
 		if cnt:
 			logSys.debug("Unbanned %s, %s ticket(s) in %r", 
@@ -433,15 +807,15 @@ class Actions(JailThread, Mapping):
 			lst = self.__banManager.flushBanList()
 		else:
 			lst = iter(self.__banManager)
-		cnt = 0
-		for ticket in lst:
-			# delete ip from database also:
-			if db and self._jail.database is not None:
+		lst = list(lst)
+		# delete ips from database also:
+		if db and self._jail.database is not None:
+			for ticket in lst:
 				ip = str(ticket.getIP())
 				self._jail.database.delBan(self._jail, ip)
-			# unban ip:
-			self.__unBan(ticket, actions=actions)
-			cnt += 1
+		# unban ips (together):
+		self.__unBanMany(lst, actions=actions)
+		cnt = len(lst)
 		logSys.debug("Unbanned %s, %s ticket(s) in %r", 
 			cnt, self.__banManager.size(), self._jail.name)
 		return cnt
@@ -457,27 +831,58 @@ class Actions(JailThread, Mapping):
 		ticket : FailTicket
 			Ticket of failures of which to unban
 		"""
+		self.__unBanMany((ticket,), actions=actions)
+
+	def __unBanMany(self, tickets, actions=None):
+		"""Unbans hosts corresponding to the tickets.
+
+		Executes the actions in order to unban the hosts given in the
+		tickets, using batch method `unban_many` of action if supported.
+
+		Parameters
+		----------
+		tickets : list
+			Tickets of failures of which to unban
+		actions : dict
+			Actions to execute (all actions of jail if None).
+		"""
 		if actions is None:
 			unbactions = self._actions
 		else:
 			unbactions = actions
-		aInfo = dict()
-		aInfo["ip"] = ticket.getIP()
-		aInfo["failures"] = ticket.getAttempt()
-		aInfo["time"] = ticket.getTime()
-		aInfo["matches"] = "".join(ticket.getMatches())
-		if actions is None:
-			logSys.notice("[%s] Unban %s", self._jail.name, aInfo["ip"])
+		unbans = []
+		for ticket in tickets:
+			aInfo = BanInfo(
+				ip=ticket.getIP(),
+				failures=ticket.getAttempt(),
+				time=ticket.getTime(),
+				matches=lambda ticket=ticket: "".join(ticket.getMatches()),
+			)
+			if actions is None:
+				logSys.notice("[%s] Unban %s", self._jail.name, aInfo["ip"])
+			unbans.append((ticket, aInfo))
+		if not unbans:
+			return
 		for name, action in unbactions.iteritems():
-			try:
-				logSys.debug("[%s] action %r: unban %s", self._jail.name, name, aInfo["ip"])
-				action.unban(aInfo.copy())
-			except Exception as e:
-				logSys.error(
-					"Failed to execute unban jail '%s' action '%s' "
-					"info '%r': %s",
-					self._jail.name, name, aInfo, e,
-					exc_info=logSys.getEffectiveLevel()<=logging.DEBUG)
+			self.__submit(name, action, self.__unbanActionMany, unbans)
+
+	def __unbanActionMany(self, name, action, unbans):
+		if self.__executeMany(name, action, 'unban', unbans):
+			return
+		for ticket, aInfo in unbans:
+			self.__unbanAction(name, action, ticket, aInfo)
+
+	def __unbanAction(self, name, action, ticket, aInfo):
+		try:
+			logSys.debug("[%s] action %r: unban %s", self._jail.name, name, aInfo["ip"])
+			action.unban(self.__actionInfo(action, aInfo))
+		except Exception as e:
+			logSys.error(
+				"Failed to execute unban jail '%s' action '%s' "
+				"info '%r': %s",
+				self._jail.name, name, aInfo, e,
+				exc_info=logSys.getEffectiveLevel()<=logging.DEBUG)
+			self.__retry(name, 'unban', ticket, aInfo)
 
 	def status(self, flavor="basic"):
 		"""Status of current and total ban counts and current banned IP list.
@@ -491,7 +896,8 @@ class Actions(JailThread, Mapping):
 			   ("Total banned", self.__banManager.getBanTotal()),
 			   ("Banned IP list", self.__banManager.getBanList())]
 		if flavor == "cymru":
-			cymru_info = self.__banManager.getBanListExtendedCymruInfo()
+			# don't block the client - not yet resolved entries are "pending" (resolved in background):
+			cymru_info = self.__banManager.getBanListExtendedCymruInfo(wait=1)
 			ret += \
 				[("Banned ASN list", self.__banManager.geBanListExtendedASN(cymru_info)),
 				 ("Banned Country list", self.__banManager.geBanListExtendedCountry(cymru_info)),
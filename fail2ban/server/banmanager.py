@@ -24,10 +24,16 @@ __author__ = "Cyril Jaquier"
 __copyright__ = "Copyright (c) 2004 Cyril Jaquier"
 __license__ = "GPL"
 
-from threading import Lock
+from collections import deque
+from threading import Condition, Lock, Thread
+import heapq
+import itertools
+import time
 
+from .ipdns import IPAddr
 from .ticket import BanTicket
 from .mytime import MyTime
+from .utils import Utils
 from ..helpers import getLogger, logging
 
 # Gets the instance of the logger.
@@ -42,6 +48,9 @@ logSys = getLogger(__name__)
 
 class BanManager:
 	
+	## Cymru info resolver (shared by all jails, because cached per prefix):
+	cymru = None
+	
 	##
 	# Constructor.
 	#
@@ -58,6 +67,11 @@ class BanManager:
 		self.__banTotal = 0
 		## The time for next unban process (for performance and load reasons):
 		self.__nextUnbanTime = BanTicket.MAX_TIME
+		## Unban heap of (end of ban, seq, fid), lazy (entries are verified by unBanList):
+		self.__unbanHeap = []
+		self.__unbanSeq = itertools.count()
+		## Whether Cymru info of new banned IPs should be resolved in background:
+		self.__cymruPrefetch = False
 	
 	##
 	# Set the ban time.
@@ -68,6 +82,9 @@ class BanManager:
 	def setBanTime(self, value):
 		with self.__lock:
 			self.__banTime = int(value)
+			# end of ban of tickets without own ban time changed - rebuild unban heap:
+			if self.__banList:
+				self.__rebuildUnbanHeap()
 	
 	##
 	# Get the ban time.
@@ -130,73 +147,24 @@ class BanManager:
 	##
 	# Returns Cymru DNS query information
 	#
+	# The lookups are running concurrently in background and cached per prefix
+	# (see CymruInfo), the call waits at most `wait` seconds for not cached IPs.
+	#
 	# @return {"asn": [], "country": [], "rir": []} dict for self.__banList IPs
 
-	def getBanListExtendedCymruInfo(self, timeout=10):
-		return_dict = {"asn": [], "country": [], "rir": []}
-		if not hasattr(self, 'dnsResolver'):
-			global dns
-			try:
-				import dns.exception
-				import dns.resolver
-				resolver = dns.resolver.Resolver()
-				resolver.lifetime = timeout
-				resolver.timeout = timeout / 2
-				self.dnsResolver = resolver
-			except ImportError as e: # pragma: no cover
-				logSys.error("dnspython package is required but could not be imported")
-				return_dict["error"] = repr(e)
-				return_dict["asn"].append("error")
-				return_dict["country"].append("error")
-				return_dict["rir"].append("error")
-				return return_dict
+	def getBanListExtendedCymruInfo(self, timeout=10, wait=None):
 		# get ips in lock:
 		with self.__lock:
 			banIPs = [banData.getIP() for banData in self.__banList.values()]
-		# get cymru info:
+			# resolve new banned IPs in background from now:
+			self.__cymruPrefetch = True
 		try:
-			for ip in banIPs:
-				# Reference: http://www.team-cymru.org/Services/ip-to-asn.html#dns
-				question = ip.getPTR(
-					"origin.asn.cymru.com" if ip.isIPv4
-					else "origin6.asn.cymru.com"
-				)
-				try:
-					resolver = self.dnsResolver
-					answers = resolver.query(question, "TXT")
-					if not answers:
-						raise ValueError("No data retrieved")
-					for rdata in answers:
-						asn, net, country, rir, changed =\
-							[answer.strip("'\" ") for answer in rdata.to_text().split("|")]
-						asn = self.handleBlankResult(asn)
-						country = self.handleBlankResult(country)
-						rir = self.handleBlankResult(rir)
-						return_dict["asn"].append(self.handleBlankResult(asn))
-						return_dict["country"].append(self.handleBlankResult(country))
-						return_dict["rir"].append(self.handleBlankResult(rir))
-				except dns.resolver.NXDOMAIN:
-					return_dict["asn"].append("nxdomain")
-					return_dict["country"].append("nxdomain")
-					return_dict["rir"].append("nxdomain")
-				except (dns.exception.DNSException, dns.resolver.NoNameservers, dns.exception.Timeout) as dnse: # pragma: no cover
-					logSys.error("DNSException %r querying Cymru for %s TXT", dnse, question)
-					if logSys.level <= logging.DEBUG:
-						logSys.exception(dnse)
-					return_dict["error"] = repr(dnse)
-					break
-				except Exception as e: # pragma: no cover
-					logSys.error("Unhandled Exception %r querying Cymru for %s TXT", e, question)
-					if logSys.level <= logging.DEBUG:
-						logSys.exception(e)
-					return_dict["error"] = repr(e)
-					break
+			return self.cymru.get(banIPs, timeout=timeout, wait=wait)
 		except Exception as e: # pragma: no cover
 			logSys.error("Failure looking up extended Cymru info: %s", e)
 			if logSys.level <= logging.DEBUG:
 				logSys.exception(e)
-			return_dict["error"] = repr(e)
-		return return_dict
+			return {"asn": [], "country": [], "rir": [], "error": repr(e)}
 
 	##
 	# Returns list of Banned ASNs from Cymru info
@@ -291,10 +259,22 @@ class BanManager:
 			# not yet banned - add new one:
 			self.__banList[fid] = ticket
 			self.__banTotal += 1
+			heapq.heappush(self.__unbanHeap, (eob, next(self.__unbanSeq), fid))
 			# correct next unban time:
 			if self.__nextUnbanTime > eob:
 				self.__nextUnbanTime = eob
-			return True
+			prefetch = self.__cymruPrefetch
+		# extended status (cymru) used - resolve info of new IP in background:
+		if prefetch and self.cymru.resolver is not None:
+			self.cymru.submit((ticket.getIP(),))
+		return True
+
+	def __rebuildUnbanHeap(self):
+		self.__unbanHeap = [
+			(ticket.getEndOfBanTime(self.__banTime), next(self.__unbanSeq), fid)
+				for fid, ticket in self.__banList.iteritems()]
+		heapq.heapify(self.__unbanHeap)
+		self.__nextUnbanTime = self.__unbanHeap[0][0] if self.__unbanHeap else BanTicket.MAX_TIME
 
 	##
 	# Get the size of the ban list.
@@ -319,6 +299,9 @@ class BanManager:
 	# Get the list of IP address to unban.
 	#
 	# Return a list of BanTicket which need to be unbanned.
+	# Pops the expired entries from the unban heap (ordered by end of ban), 
+	# entries of prolonged tickets are pushed again, entries of already 
+	# removed tickets are dropped.
 	# @param time the time
 	# @return the list of ticket to unban
 	
@@ -333,29 +316,32 @@ class BanManager:
 				return list()
 
 			# Gets the list of ticket to remove (thereby correct next unban time).
-			unBanList = {}
-			self.__nextUnbanTime = BanTicket.MAX_TIME
-			for fid,ticket in self.__banList.iteritems():
+			unBanList = []
+			heap = self.__unbanHeap
+			banList = self.__banList
+			while heap and heap[0][0] < time:
+				_, _, fid = heapq.heappop(heap)
+				ticket = banList.get(fid)
+				if ticket is None:
+					continue
 				# current time greater as end of ban - timed out:
 				eob = ticket.getEndOfBanTime(self.__banTime)
 				if time > eob:
-					unBanList[fid] = ticket
-				elif self.__nextUnbanTime > eob:
-					self.__nextUnbanTime = eob
-
-			# Removes tickets.
-			if len(unBanList):
-				if len(unBanList) / 2.0 <= len(self.__banList) / 3.0:
-					# few as 2/3 should be removed - remove particular items:
-					for fid in unBanList.iterkeys():
-						del self.__banList[fid]
+					del banList[fid]
+					unBanList.append(ticket)
 				else:
-					# create new dictionary without items to be deleted:
-					self.__banList = dict((fid,ticket) for fid,ticket in self.__banList.iteritems() \
-						if fid not in unBanList)
-						
+					# prolonged - push again with new end of ban:
+					heapq.heappush(heap, (eob, next(self.__unbanSeq), fid))
+			# all removed - new dictionary (release memory):
+			if not banList:
+				self.__banList = dict()
+			# too many obsolete entries (removed via getTicketByID) - rebuild heap:
+			if len(heap) > 2 * len(self.__banList) + 100:
+				self.__rebuildUnbanHeap()
+			self.__nextUnbanTime = self.__unbanHeap[0][0] if self.__unbanHeap else BanTicket.MAX_TIME
+
 			# return list of tickets:
-			return unBanList.values()
+			return unBanList
 
 	##
 	# Flush the ban list.
@@ -367,6 +353,8 @@ class BanManager:
 		with self.__lock:
 			uBList = self.__banList.values()
 			self.__banList = dict()
+			self.__unbanHeap = []
+			self.__nextUnbanTime = BanTicket.MAX_TIME
 			return uBList
 
 	##
@@ -382,3 +370,161 @@ class BanManager:
 			except KeyError:
 				pass
 		return None						  # if none found
+
+
+##
+# Concurrent and cached lookup of Cymru (IP to ASN) info.
+#
+class CymruInfo(object):
+	"""Resolves Cymru info of banned IPs in up to `threads` background threads
+
+	The results are cached per prefix (/24 for IPv4, /48 for IPv6) for `maxTime`
+	seconds, so the lookup of further IPs from the same network (and the repeated
+	status requests) are served from the cache. Lookups that failed (DNS error,
+	timeout) are not cached and will be repeated by the next request.
+	"""
+
+	def __init__(self, threads=8, maxCount=10000, maxTime=60*60):
+		self.threads = threads
+		self.cache = Utils.Cache(maxCount=maxCount, maxTime=maxTime)
+		self.resolver = None
+		self._cond = Condition(Lock())
+		self._queue = deque()
+		## prefix -> ip, of lookups queued or in progress:
+		self._pending = {}
+		## prefix -> error of last failed lookup:
+		self._errors = {}
+		self._workers = 0
+
+	@staticmethod
+	def prefix(ip):
+		"""Cache key of the network, the IP belongs to"""
+		if ip.isIPv4:
+			return (ip.family, ip.addr & IPAddr.MASK4[24])
+		if ip.isIPv6:
+			return (ip.family, ip.addr & IPAddr.MASK6[48])
+		return (ip.family, str(ip))
+
+	def init(self, timeout=10):
+		"""Initializes resolver, returns error (as string) if not available"""
+		if self.resolver is None:
+			global dns
+			try:
+				import dns.exception
+				import dns.resolver
+			except ImportError as e: # pragma: no cover
+				logSys.error("dnspython package is required but could not be imported")
+				return repr(e)
+			self.resolver = dns.resolver.Resolver()
+		self.resolver.lifetime = timeout
+		self.resolver.timeout = timeout / 2
+		return None
+
+	def query(self, ip):
+		"""Returns list of (asn, country, rir) of the IP"""
+		# Reference: http://www.team-cymru.org/Services/ip-to-asn.html#dns
+		question = ip.getPTR(
+			"origin.asn.cymru.com" if ip.isIPv4
+			else "origin6.asn.cymru.com"
+		)
+		try:
+			answers = self.resolver.query(question, "TXT")
+		except dns.resolver.NXDOMAIN:
+			return [("nxdomain", "nxdomain", "nxdomain")]
+		if not answers:
+			raise ValueError("No data retrieved")
+		info = []
+		for rdata in answers:
+			asn, net, country, rir, changed =\
+				[answer.strip("'\" ") for answer in rdata.to_text().split("|")]
+			info.append(tuple(BanManager.handleBlankResult(v) for v in (asn, country, rir)))
+		return info
+
+	def submit(self, ips):
+		"""Queues lookup of not yet cached IPs (in background)"""
+		with self._cond:
+			for ip in ips:
+				key = self.prefix(ip)
+				if key in self._pending or self.cache.get(key) is not None:
+					continue
+				self._pending[key] = ip
+				self._errors.pop(key, None)
+				self._queue.append(key)
+			# start workers (up to threads count, they exit if queue is empty):
+			while self._workers < min(self.threads, len(self._queue)):
+				th = Thread(target=self._run, name="f2b/cymru-%d" % self._workers)
+				th.daemon = True
+				self._workers += 1
+				th.start()
+
+	def _run(self):
+		while True:
+			with self._cond:
+				if not self._queue:
+					self._workers -= 1
+					return
+				key = self._queue.popleft()
+				ip = self._pending[key]
+			info = error = None
+			try:
+				info = self.query(ip)
+			except Exception as e:
+				logSys.error("Exception %r querying Cymru for %s", e, ip)
+				if logSys.level <= logging.DEBUG:
+					logSys.exception(e)
+				error = repr(e)
+			with self._cond:
+				if info is not None:
+					self.cache.set(key, info)
+				else:
+					self._errors[key] = error
+				del self._pending[key]
+				self._cond.notify_all()
+
+	def get(self, ips, timeout=10, wait=None):
+		"""Returns Cymru info of the IPs (lists of asn, country and rir)
+
+		Not cached IPs will be resolved in background, the call waits for them at
+		most `wait` seconds (default `timeout`), so if not ready, the entries of them
+		are "pending" (wait=0 returns everything found in cache immediately).
+		"""
+		return_dict = {"asn": [], "country": [], "rir": []}
+		error = self.init(timeout)
+		if error:
+			return_dict["error"] = error
+			return_dict["asn"].append("error")
+			return_dict["country"].append("error")
+			return_dict["rir"].append("error")
+			return return_dict
+		self.submit(ips)
+		keys = [self.prefix(ip) for ip in ips]
+		if wait is None:
+			wait = timeout
+		# wait for pending lookups:
+		if wait > 0:
+			deadline = time.time() + wait
+			with self._cond:
+				while any(key in self._pending for key in keys):
+					wait = deadline - time.time()
+					if wait <= 0:
+						break
+					self._cond.wait(wait)
+		# collect results:
+		with self._cond:
+			for key in keys:
+				info = self.cache.get(key)
+				if info is None:
+					error = self._errors.get(key)
+					if error is not None:
+						return_dict["error"] = error
+						info = (("error", "error", "error"),)
+					else:
+						info = (("pending", "pending", "pending"),)
+				for asn, country, rir in info:
+					return_dict["asn"].append(asn)
+					return_dict["country"].append(country)
+					return_dict["rir"].append(rir)
+		return return_dict
+
+
+BanManager.cymru = CymruInfo()
@@ -24,8 +24,13 @@ __author__ = "Cyril Jaquier"
 __copyright__ = "Copyright (c) 2004 Cyril Jaquier"
 __license__ = "GPL"
 
+from array import array
+from collections import deque
 from threading import Lock
+import heapq
+import itertools
 import logging
+import random
 
 from .ticket import FailTicket
 from ..helpers import getLogger, BgService
@@ -40,9 +45,23 @@ class FailManager:
 	def __init__(self):
 		self.__lock = Lock()
 		self.__failList = dict()
+		## Expiry heap of (lastTime, seq, fid), lazy (entries are verified by cleanup):
+		self.__expHeap = []
+		self.__expSeq = itertools.count()
+		## Queue of failure-ids reached maxRetry (ready to ban), lazy (verified by toBan):
+		self.__readyQueue = deque()
+		self.__readySet = set()
 		self.__maxRetry = 3
 		self.__maxTime = 600
 		self.__failTotal = 0
+		## Max count of tracked failures (0 - unlimited), eviction policy and counter:
+		self.__maxCount = 0
+		self.__evictPolicy = 'retry'
+		self.__evictTotal = 0
+		## Eviction heap of (retry, lastTime, seq, fid) for policy "retry", lazy (verified by __evict):
+		self.__evictHeap = []
+		## Approximate counting (count-min sketch), None - exact counting:
+		self.__sketch = None
 		self.maxEntries = 50
 		self.__bgSvc = BgService()
 	
@@ -64,17 +83,140 @@ class FailManager:
 			return self.__failTotal
 
 	def setMaxRetry(self, value):
-		self.__maxRetry = value
+		with self.__lock:
+			self.__maxRetry = value
+			# rebuild queue of tickets ready to ban (new max retry):
+			self.__readyQueue.clear()
+			self.__readySet.clear()
+			for fid, fData in self.__failList.iteritems():
+				if fData.getRetry() >= value:
+					self.__readyQueue.append(fid)
+					self.__readySet.add(fid)
 	
 	def getMaxRetry(self):
 		return self.__maxRetry
 	
 	def setMaxTime(self, value):
 		self.__maxTime = value
+		if self.__sketch is not None:
+			self.__sketch.setPeriod(value)
 	
 	def getMaxTime(self):
 		return self.__maxTime
 
+	COUNT_MODES = ('exact', 'sketch')
+	## Ratio of maxRetry, the sketch estimate should reach to materialize a ticket:
+	sketchRatio = 0.8
+
+	def setCountMode(self, value):
+		"""Set counting mode of failures not yet tracked in fail list
+
+		  - exact  - each failure gets a ticket (default)
+		  - sketch - failures are counted approximately using decaying count-min sketch
+		             (constant memory), a ticket is created if estimate nears maxRetry
+		"""
+		value = value.lower()
+		if value not in FailManager.COUNT_MODES:
+			raise ValueError("unknown count mode %r, expected one of %r" % 
+				(value, FailManager.COUNT_MODES))
+		with self.__lock:
+			if value == 'exact':
+				self.__sketch = None
+			elif self.__sketch is None:
+				self.__sketch = FailSketch(self.__maxTime)
+
+	def getCountMode(self):
+		return 'exact' if self.__sketch is None else 'sketch'
+
+	EVICT_POLICIES = ('retry', 'oldest')
+
+	def setMaxCount(self, value):
+		"""Set max count of tracked failures (0 - unlimited)
+
+		If reached, a new failure evicts other one corresponding eviction policy.
+		"""
+		value = int(value)
+		if value < 0:
+			raise ValueError("max count of failures must be positive or 0 (unlimited)")
+		with self.__lock:
+			self.__maxCount = value
+			self.__rebuildEvictHeap()
+
+	def getMaxCount(self):
+		return self.__maxCount
+
+	def setEvictPolicy(self, value):
+		"""Set eviction policy, used if max count of tracked failures reached
+
+		  - retry  - evict the failure with lowest retry count (oldest first)
+		  - oldest - evict the failure with oldest last time
+		Failures reached max retry (ready to ban) will be never evicted.
+		"""
+		value = value.lower()
+		if value not in FailManager.EVICT_POLICIES:
+			raise ValueError("unknown eviction policy %r, expected one of %r" % 
+				(value, FailManager.EVICT_POLICIES))
+		with self.__lock:
+			self.__evictPolicy = value
+			self.__rebuildEvictHeap()
+
+	def getEvictPolicy(self):
+		return self.__evictPolicy
+
+	def setEvictTotal(self, value):
+		with self.__lock:
+			self.__evictTotal = value
+
+	def getEvictTotal(self):
+		with self.__lock:
+			return self.__evictTotal
+
+	def __rebuildEvictHeap(self):
+		if self.__maxCount and self.__evictPolicy == 'retry':
+			self.__evictHeap = [(fData.getRetry(), fData.getLastTime(), next(self.__expSeq), fid)
+				for fid, fData in self.__failList.iteritems()]
+			heapq.heapify(self.__evictHeap)
+		else:
+			self.__evictHeap = []
+
+	def __evict(self):
+		"""Evicts one failure corresponding eviction policy (called in lock)
+		"""
+		failList = self.__failList
+		maxRetry = self.__maxRetry
+		retryPolicy = self.__evictPolicy == 'retry'
+		heap = self.__evictHeap if retryPolicy else self.__expHeap
+		skipped = []
+		try:
+			while heap:
+				entry = heapq.heappop(heap)
+				fid = entry[-1]
+				fData = failList.get(fid)
+				if fData is None:
+					continue
+				# verify entry is actual, otherwise push it again with current key:
+				if retryPolicy:
+					if entry[0] != fData.getRetry() or entry[1] != fData.getLastTime():
+						heapq.heappush(heap, (fData.getRetry(), fData.getLastTime(), next(self.__expSeq), fid))
+						continue
+				elif entry[0] != fData.getLastTime():
+					heapq.heappush(heap, (fData.getLastTime(), next(self.__expSeq), fid))
+					continue
+				# don't evict failures ready to ban:
+				if fData.getRetry() >= maxRetry:
+					skipped.append(entry)
+					# all other have the same or larger retry count:
+					if retryPolicy:
+						break
+					continue
+				del failList[fid]
+				self.__evictTotal += 1
+				return True
+		finally:
+			for entry in skipped:
+				heapq.heappush(heap, entry)
+		return False
+
 	def addFailure(self, ticket, count=1, observed=False):
 		attempts = 1
 		with self.__lock:
@@ -105,6 +247,18 @@ class FailManager:
 				# not found - already banned - prevent to add failure if comes from observer:
 				if observed:
 					return
+				# approximate counting - create ticket only if estimate nears max retry:
+				if self.__sketch is not None:
+					attempts = self.__sketch.add(fid, ticket.getTime(), 
+						max(count, ticket.getAttempt(), 1))
+					if attempts < max(1, int(self.__maxRetry * self.sketchRatio)):
+						self.__failTotal += 1
+						return attempts
+					# estimate (upper bound if no colliding ids removed), so at least current attempts:
+					count = max(count, attempts)
+					# counted hereafter by ticket - remove from sketch (otherwise a repeat
+					# offender gets materialized again by the first failure after ban):
+					self.__sketch.remove(fid, attempts)
 				# if already FailTicket - add it direct, otherwise create (using copy all ticket data):
 				if isinstance(ticket, FailTicket):
 					fData = ticket;
@@ -112,10 +266,20 @@ class FailManager:
 					fData = FailTicket(ticket=ticket)
 				if count > ticket.getAttempt():
 					fData.setRetry(count)
+				# max count of tracked failures reached - evict (bounded memory):
+				if self.__maxCount and len(self.__failList) >= self.__maxCount:
+					self.__evict()
 				self.__failList[fid] = fData
+				heapq.heappush(self.__expHeap, (fData.getLastTime(), next(self.__expSeq), fid))
+				if self.__maxCount and self.__evictPolicy == 'retry':
+					heapq.heappush(self.__evictHeap, (fData.getRetry(), fData.getLastTime(), next(self.__expSeq), fid))
 
 			attempts = fData.getRetry()
 			self.__failTotal += 1
+			# reached max retry - ready to ban:
+			if attempts >= self.__maxRetry and fid not in self.__readySet:
+				self.__readyQueue.append(fid)
+				self.__readySet.add(fid)
 
 			if logSys.getEffectiveLevel() <= logLevel:
 				# yoh: Since composing this list might be somewhat time consuming
@@ -134,23 +298,38 @@ class FailManager:
 			return len(self.__failList)
 	
 	def cleanup(self, time):
+		"""Removes failures are not updated within maxTime (expired).
+
+		Uses expiry heap ordered by last time of failure, so only possible expired
+		entries will be touched. Entries of the heap are not updated by addFailure
+		(last time of failure can grow), so they are verified here and pushed again
+		if still alive. Entries of already removed failures are simply dropped.
+		"""
 		with self.__lock:
-			todelete = [fid for fid,item in self.__failList.iteritems() \
-				if item.getLastTime() + self.__maxTime <= time]
-			if len(todelete) == len(self.__failList):
-				# remove all:
+			heap = self.__expHeap
+			failList = self.__failList
+			maxTime = self.__maxTime
+			while heap and heap[0][0] + maxTime <= time:
+				lastTime, _, fid = heapq.heappop(heap)
+				fData = failList.get(fid)
+				if fData is None:
+					continue
+				# last time changed (newer failure) - still alive, push it again:
+				if fData.getLastTime() != lastTime:
+					if fData.getLastTime() + maxTime > time:
+						heapq.heappush(heap, (fData.getLastTime(), next(self.__expSeq), fid))
+						continue
+				del failList[fid]
+			# all removed - new dictionary (release memory):
+			if not failList and self.__failList is failList:
 				self.__failList = dict()
-			elif not len(todelete):
-				# nothing:
-				return
-			if len(todelete) / 2.0 <= len(self.__failList) / 3.0:
-				# few as 2/3 should be removed - remove particular items:
-				for fid in todelete:
-					del self.__failList[fid]
-			else:
-				# create new dictionary without items to be deleted:
-				self.__failList = dict((fid,item) for fid,item in self.__failList.iteritems() \
-					if item.getLastTime() + self.__maxTime > time)
+			# too many obsolete entries (removed via toBan, delFailure) - rebuild heap:
+			if len(heap) > 2 * len(failList) + 100:
+				self.__expHeap = [(fData.getLastTime(), next(self.__expSeq), fid)
+					for fid, fData in self.__failList.iteritems()]
+				heapq.heapify(self.__expHeap)
+			if len(self.__evictHeap) > 2 * len(self.__failList) + 100:
+				self.__rebuildEvictHeap()
 		self.__bgSvc.service()
 	
 	def delFailure(self, fid):
@@ -161,15 +340,114 @@ class FailManager:
 				pass
 	
 	def toBan(self, fid=None):
+		"""Returns a ticket reached max retry (and removes it from fail list)
+
+		If `fid` is given (and known) - checks this failure only, otherwise takes
+		the next failure from the queue of failures ready to ban (filled by addFailure),
+		so draining costs O(k) in the number of new bans, regardless of fail list size.
+		"""
 		with self.__lock:
-			for fid in ([fid] if fid != None and fid in self.__failList else self.__failList):
-				data = self.__failList[fid]
+			failList = self.__failList
+			if fid is not None and fid in failList:
+				data = failList[fid]
 				if data.getRetry() >= self.__maxRetry:
-					del self.__failList[fid]
+					del failList[fid]
 					return data
+			else:
+				queue = self.__readyQueue
+				while queue:
+					fid = queue.popleft()
+					self.__readySet.discard(fid)
+					# verify (could be already removed or reset after this was queued):
+					data = failList.get(fid)
+					if data is not None and data.getRetry() >= self.__maxRetry:
+						del failList[fid]
+						return data
 		self.__bgSvc.service()
 		raise FailManagerEmpty
 
 
+class FailSketch(object):
+	"""Decaying count-min sketch to estimate failure count per failure-id.
+
+	Memory is constant (`depth` rows of `width` counters in two generations),
+	regardless of count of distinct failure-ids. Each generation covers half of
+	`period` (find time), so the estimate covers failures of the last half up to
+	whole period. Without removals the estimate is never less than real count
+	within this window. Removal (see `remove`) decrements the counters shared
+	with colliding failure-ids too, so their estimate can be less than real
+	count afterwards (they need more failures to be materialized).
+	"""
+
+	_PRIME = (1 << 61) - 1
+
+	def __init__(self, period, width=8192, depth=4):
+		self._width = width
+		self._depth = depth
+		rnd = random.Random()
+		self._hashes = [(rnd.randint(1, self._PRIME - 1), rnd.randint(0, self._PRIME - 1))
+			for r in xrange(depth)]
+		self.setPeriod(period)
+		self._cur = self._newGen()
+		self._prev = self._newGen()
+		self._genEnd = None
+
+	def _newGen(self):
+		return [array('L', [0]) * self._width for r in xrange(self._depth)]
+
+	def setPeriod(self, period):
+		self._genPeriod = max(1, period / 2.0)
+
+	def _indexes(self, fid):
+		h = hash(fid)
+		return [((a * h + b) % self._PRIME) % self._width for a, b in self._hashes]
+
+	def _rotate(self, time):
+		if self._genEnd is None or time >= self._genEnd + self._genPeriod:
+			# first use or nothing within last generation - start from scratch:
+			self._prev = self._newGen()
+			self._cur = self._newGen()
+			self._genEnd = time + self._genPeriod
+		elif time >= self._genEnd:
+			self._prev = self._cur
+			self._cur = self._newGen()
+			self._genEnd += self._genPeriod
+
+	def add(self, fid, time, count=1):
+		"""Adds `count` failures of `fid` and returns new estimate of its failures
+		"""
+		if self._genEnd is None or time >= self._genEnd:
+			self._rotate(time)
+		cur = self._cur
+		prev = self._prev
+		est = None
+		for r, i in enumerate(self._indexes(fid)):
+			row = cur[r]
+			row[i] += count
+			v = row[i] + prev[r][i]
+			if est is None or v < est:
+				est = v
+		return est
+
+	def remove(self, fid, count):
+		"""Removes `count` failures of `fid` (e.g. moved to ticket), current generation first
+
+		Because `count` is an estimate, the failures of other failure-ids colliding in
+		the counters of `fid` are removed too (undercount of them is possible).
+		"""
+		cur = self._cur
+		prev = self._prev
+		for r, i in enumerate(self._indexes(fid)):
+			c = min(count, cur[r][i])
+			cur[r][i] -= c
+			c = min(count - c, prev[r][i])
+			prev[r][i] -= c
+
+	def estimate(self, fid):
+		cur = self._cur
+		prev = self._prev
+		return min(cur[r][i] + prev[r][i] for r, i in enumerate(self._indexes(fid)))
+
+
 class FailManagerEmpty(Exception):
 	pass
@@ -29,15 +29,17 @@ import os
 import re
 import sys
 import time
+from threading import Lock, Thread
 
 from .failmanager import FailManagerEmpty, FailManager
-from .ipdns import DNSUtils, IPAddr
+from .ipdns import DNSUtils, IPAddr, IPAddrSet
 from .observer import Observers
 from .ticket import FailTicket
 from .jailthread import JailThread
 from .datedetector import DateDetector
 from .datetemplate import DatePatternRegex, DateEpoch, DateTai64n
 from .mytime import MyTime
+from .utils import Utils
 from .failregex import FailRegex, Regex, RegexException
 from .action import CommandAction
 from ..helpers import getLogger, PREFER_ENC
@@ -77,6 +79,8 @@ class Filter(JailThread):
 		self.__findTime = 600
 		## The ignore IP list.
 		self.__ignoreIpList = []
+		## Set of ignored addresses/networks for fast lookup (see inIgnoreIPList):
+		self.__ignoreIpSet = IPAddrSet()
 		## Size of line buffer
 		self.__lineBufferSize = 1
 		## Line buffer
@@ -86,6 +90,17 @@ class Filter(JailThread):
 		self.__lastDate = None
 		## External command
 		self.__ignoreCommand = False
+		## Cache of ignore command verdicts (None - not cached), options and counters:
+		self.__ignoreCache = None
+		self.__ignoreCacheOpts = {'maxcount': 0, 'maxtime': 300, 'negtime': 60, 'async': False}
+		self.__ignoreCacheHits = 0
+		self.__ignoreCacheMisses = 0
+		## Lock of the counters (verdicts are requested by filter and ignore worker threads):
+		self.__ignoreCacheStatsLock = Lock()
+		## Failures parked until verdict of ignore command (async), ip -> [ticket]:
+		self.__ignorePending = {}
+		self.__ignorePendingLock = Lock()
+		self.__ignoreWorker = None
 		## Default or preferred encoding (to decode bytes from file or journal):
 		self.__encoding = PREFER_ENC
 		## Error counter (protected, so can be used in filter implementations)
@@ -307,6 +322,57 @@ class Filter(JailThread):
 	def getMaxRetry(self):
 		return self.failManager.getMaxRetry()
 
+	##
+	# Set the maximum count of tracked failures (0 - unlimited).
+	#
+	# @param value the max count of failures
+
+	def setMaxFailures(self, value):
+		self.failManager.setMaxCount(value)
+		logSys.info("  maxFailures: %s", value)
+
+	##
+	# Get the maximum count of tracked failures.
+	#
+	# @return the max count of failures
+
+	def getMaxFailures(self):
+		return self.failManager.getMaxCount()
+
+	##
+	# Set the eviction policy, used if max count of tracked failures reached.
+	#
+	# @param value the policy (retry or oldest)
+
+	def setEvictPolicy(self, value):
+		self.failManager.setEvictPolicy(value)
+		logSys.info("  evictPolicy: %s", value)
+
+	##
+	# Get the eviction policy.
+	#
+	# @return the policy
+
+	def getEvictPolicy(self):
+		return self.failManager.getEvictPolicy()
+
+	##
+	# Set the counting mode of failures (exact or sketch).
+	#
+	# @param value the count mode
+
+	def setCountMode(self, value):
+		self.failManager.setCountMode(value)
+		logSys.info("  countMode: %s", value)
+
+	##
+	# Get the counting mode of failures.
+	#
+	# @return the count mode
+
+	def getCountMode(self):
+		return self.failManager.getCountMode()
+
 	##
 	# Set the maximum line buffer size.
 	#
@@ -371,6 +437,117 @@ class Filter(JailThread):
 	def getIgnoreCommand(self):
 		return self.__ignoreCommand
 
+	##
+	# Set option of the cache for verdicts of ignore command.
+	#
+	# Options: maxcount (max count of cached IPs, 0 - no cache), maxtime (time
+	# to live of positive verdict, IP ignored), negtime (time to live of negative
+	# verdict) and async (execute command in background, failures of IP are
+	# parked until the verdict is known).
+
+	def setIgnoreCache(self, opt, value):
+		opts = self.__ignoreCacheOpts
+		if opt not in opts:
+			raise ValueError("unknown ignorecache option %r" % (opt,))
+		if opt == 'async':
+			if isinstance(value, basestring):
+				value = value.lower() in ("yes", "true", "on", "1")
+			value = bool(value)
+		elif opt == 'maxcount':
+			value = int(value)
+		else:
+			value = MyTime.str2seconds(value)
+		opts[opt] = value
+		logSys.info("  ignoreCache.%s: %s", opt, value)
+		# (re)create cache:
+		if opts['maxcount'] > 0:
+			self.__ignoreCache = Utils.Cache(maxCount=opts['maxcount'], maxTime=opts['maxtime'])
+		else:
+			self.__ignoreCache = None
+
+	def getIgnoreCache(self, opt):
+		return self.__ignoreCacheOpts.get(opt)
+
+	def getIgnoreCacheStats(self):
+		"""Returns hits and misses of the cache for verdicts of ignore command
+		"""
+		with self.__ignoreCacheStatsLock:
+			return self.__ignoreCacheHits, self.__ignoreCacheMisses
+
+	def _ignoreCommandVerdict(self, ip, execute=True):
+		"""Returns verdict of ignore command for `ip` (using cache if enabled)
+
+		If not cached and `execute` is False, returns None (verdict unknown).
+		"""
+		cache = self.__ignoreCache
+		if cache is not None:
+			ret = cache.get(ip)
+			with self.__ignoreCacheStatsLock:
+				if ret is not None:
+					self.__ignoreCacheHits += 1
+				else:
+					self.__ignoreCacheMisses += 1
+			if ret is not None:
+				return ret
+		if not execute:
+			return None
+		command = CommandAction.replaceTag(self.__ignoreCommand, { 'ip': ip } )
+		logSys.debug('ignore command: ' + command)
+		ret = CommandAction.executeCmd(command)
+		if cache is not None:
+			opts = self.__ignoreCacheOpts
+			cache.set(ip, ret, opts['maxtime'] if ret else opts['negtime'])
+		return ret
+
+	def _parkIgnorePending(self, ip, ticket):
+		"""Parks failure until verdict of ignore command (executed in background)
+		"""
+		with self.__ignorePendingLock:
+			pending = self.__ignorePending.get(ip)
+			if pending is not None:
+				pending.append(ticket)
+				return
+			self.__ignorePending[ip] = [ticket]
+			if self.__ignoreWorker is None:
+				th = self.__ignoreWorker = Thread(target=self._ignoreWorkerRun,
+					name="f2b/ignore-" + self.jailName)
+				th.daemon = True
+				th.start()
+
+	def _ignoreWorkerRun(self):
+		"""Executes ignore command for parked failures, exits if nothing pending
+		"""
+		while True:
+			with self.__ignorePendingLock:
+				if not self.__ignorePending:
+					self.__ignoreWorker = None
+					return
+				ip = next(iter(self.__ignorePending))
+			try:
+				ret = self._ignoreCommandVerdict(ip)
+			except Exception as e: # pragma: no cover
+				logSys.error("Ignore command failed for %s: %r", ip, e)
+				ret = False
+			with self.__ignorePendingLock:
+				tickets = self.__ignorePending.pop(ip, ())
+			if ret:
+				self.logIgnoreIp(ip, True, ignore_source="command")
+				continue
+			# not ignored - add parked failures and ban if max retry reached:
+			for tick in tickets:
+				self._addFailure(tick)
+			self._banReady(ip)
+
+	def _banReady(self, ip):
+		"""Bans `ip` if reached max retry (used for failures completed in background)
+		"""
+		try:
+			while True:
+				ticket = self.failManager.toBan(ip)
+				self.jail.putFailTicket(ticket)
+		except FailManagerEmpty:
+			pass
+
 	##
 	# Ban an IP - http://blogs.buanzo.com.ar/2009/04/fail2ban-patch-ban-ip-address-manually.html
 	# Arturo 'Buanzo' Busleiman <buanzo@buanzo.com.ar>
@@ -413,15 +590,20 @@ class Filter(JailThread):
 		# log and append to ignore list
 		logSys.debug("  Add %r to ignore list (%r)", ip, ipstr)
 		self.__ignoreIpList.append(ip)
+		self.__ignoreIpSet.add(ip)
 
 	def delIgnoreIP(self, ip=None):
 		# clear all:
 		if ip is None:
 			del self.__ignoreIpList[:]
+			self.__ignoreIpSet.clear()
 			return
 		# delete by ip:
 		logSys.debug("  Remove %r from ignore list", ip)
 		self.__ignoreIpList.remove(ip)
+		# the same ip may be added multiple times, remove from set if it was the last one:
+		if ip not in self.__ignoreIpList:
+			self.__ignoreIpSet.remove(ip)
 
 	def logIgnoreIp(self, ip, log_ignore, ignore_source="unknown source"):
 		if log_ignore:
@@ -438,26 +620,24 @@ class Filter(JailThread):
 	# @param ip IP address object
 	# @return True if IP address is in ignore list
 
-	def inIgnoreIPList(self, ip, log_ignore=False):
+	def inIgnoreIPList(self, ip, log_ignore=False, execute=True):
 		if not isinstance(ip, IPAddr):
 			ip = IPAddr(ip)
-		for net in self.__ignoreIpList:
-			# check if the IP is covered by ignore IP
-			if ip.isInNet(net):
-				self.logIgnoreIp(ip, log_ignore, ignore_source=("ip" if net.isValid else "dns"))
-				return True
+		# check if the IP is covered by ignore IP (prefix lookup):
+		source = self.__ignoreIpSet.find(ip)
+		if source is not None:
+			self.logIgnoreIp(ip, log_ignore, ignore_source=source)
+			return True
 
 		if self.__ignoreCommand:
-			command = CommandAction.replaceTag(self.__ignoreCommand, { 'ip': ip } )
-			logSys.debug('ignore command: ' + command)
-			ret_ignore = CommandAction.executeCmd(command)
+			ret_ignore = self._ignoreCommandVerdict(ip, execute)
 			self.logIgnoreIp(ip, log_ignore and ret_ignore, ignore_source="command")
 			return ret_ignore
 
 		return False
 
 	def processLine(self, line, date=None, returnRawHost=False,
-		checkAllRegex=False, checkFindTime=False):
+		checkAllRegex=False, checkFindTime=False, resolveAsync=False):
 		"""Split the time portion from log msg and return findFailures on them
 		"""
 		if date:
@@ -478,31 +658,15 @@ class Filter(JailThread):
 				tupleLine = (l, "", "", None)
 
 		return "".join(tupleLine[::2]), self.findFailure(
-			tupleLine, date, returnRawHost, checkAllRegex, checkFindTime)
+			tupleLine, date, returnRawHost, checkAllRegex, checkFindTime, resolveAsync)
 
 	def processLineAndAdd(self, line, date=None):
 		"""Processes the line for failures and populates failManager
 		"""
 		try:
-			for element in self.processLine(line, date, checkFindTime=True)[1]:
-				ip = element[1]
-				unixTime = element[2]
-				lines = element[3]
-				fail = {}
-				if len(element) > 4:
-					fail = element[4]
-				logSys.debug("Processing line with time:%s and ip:%s", 
-						unixTime, ip)
-				if self.inIgnoreIPList(ip, log_ignore=True):
-					continue
-				logSys.info(
-					"[%s] Found %s - %s", self.jailName, ip, datetime.datetime.fromtimestamp(unixTime).strftime("%Y-%m-%d %H:%M:%S")
-				)
-				tick = FailTicket(ip, unixTime, lines, data=fail)
-				self.failManager.addFailure(tick)
-				# report to observer - failure was found, for possibly increasing of it retry counter (asynchronous)
-				if Observers.Main is not None:
-					Observers.Main.add('failureFound', self.failManager, self.jail, tick)
+			for element in self.processLine(line, date, checkFindTime=True, 
+					resolveAsync=True)[1]:
+				self._processFailure(element)
 			# reset (halve) error counter (successfully processed line):
 			if self._errors:
 				self._errors //= 2
@@ -512,6 +676,45 @@ class Filter(JailThread):
 			# incr common error counter:
 			self.commonError()
 
+	def _processFailure(self, element):
+		"""Processes the found failure (check ignored, add to failManager)
+		"""
+		ip = element[1]
+		unixTime = element[2]
+		lines = element[3]
+		fail = {}
+		if len(element) > 4:
+			fail = element[4]
+		logSys.debug("Processing line with time:%s and ip:%s", 
+				unixTime, ip)
+		ignored = self.inIgnoreIPList(ip, log_ignore=True, 
+			execute=not self.__ignoreCacheOpts['async'])
+		if ignored:
+			return
+		logSys.info(
+			"[%s] Found %s - %s", self.jailName, ip, datetime.datetime.fromtimestamp(unixTime).strftime("%Y-%m-%d %H:%M:%S")
+		)
+		tick = FailTicket(ip, unixTime, lines, data=fail)
+		# verdict of ignore command unknown yet - park it (executed in background):
+		if ignored is None:
+			self._parkIgnorePending(ip, tick)
+			return
+		self._addFailure(tick)
+
+	def _processResolved(self, element, ips):
+		"""Completes the failure parked until its host was resolved (in background)
+		"""
+		for ip in ips:
+			self._processFailure([element[0], ip] + element[2:])
+		for ip in ips:
+			self._banReady(ip)
+
+	def _addFailure(self, tick):
+		self.failManager.addFailure(tick)
+		# report to observer - failure was found, for possibly increasing of it retry counter (asynchronous)
+		if Observers.Main is not None:
+			Observers.Main.add('failureFound', self.failManager, self.jail, tick)
+
 	def commonError(self):
 		# incr error counter, stop processing (going idle) after 100th error :
 		self._errors += 1
@@ -544,7 +747,7 @@ class Filter(JailThread):
 	# @return a dict with IP and timestamp.
 
 	def findFailure(self, tupleLine, date=None, returnRawHost=False,
-		checkAllRegex=False, checkFindTime=False):
+		checkAllRegex=False, checkFindTime=False, resolveAsync=False):
 		failList = list()
 
 		cidr = IPAddr.CIDR_UNSPEC
@@ -624,8 +827,15 @@ class Filter(JailThread):
 						fail = failRegex.getGroups()
 						# failure-id:
 						fid = fail.get('fid')
-						# ip-address or host:
-						host = fail.get('ip4') or fail.get('ip6')
+						# ip-address or host (already classified - use fast constructor):
+						fromIP = None
+						host = fail.get('ip4')
+						if host is not None:
+							fromIP = IPAddr.fromIPv4
+						else:
+							host = fail.get('ip6')
+							if host is not None:
+								fromIP = IPAddr.fromIPv6
 						if host is not None:
 							raw = True
 						else:
@@ -639,7 +849,10 @@ class Filter(JailThread):
 						# if raw - add single ip or failure-id,
 						# otherwise expand host to multiple ips using dns (or ignore it if not valid):
 						if raw:
-							ip = IPAddr(host, cidr)
+							if fromIP is not None and cidr == IPAddr.CIDR_UNSPEC:
+								ip = fromIP(host)
+							else:
+								ip = IPAddr(host, cidr)
 							# check host equal failure-id, if not - failure with complex id:
 							if fid is not None and fid != host:
 								ip = IPAddr(fid, IPAddr.CIDR_RAW)
@@ -648,8 +861,17 @@ class Filter(JailThread):
 							if not checkAllRegex:
 								break
 						else:
-							ips = DNSUtils.textToIp(host, self.__useDns)
-							if ips:
+							callback = None
+							if resolveAsync:
+								# if resolved in background - park failure, complete it in callback:
+								element = [failRegexIndex, None, date,
+									failRegex.getMatchedLines(), fail]
+								callback = lambda ips, element=element: self._processResolved(element, ips)
+							ips = DNSUtils.textToIp(host, self.__useDns, callback)
+							if ips is None:
+								if not checkAllRegex:
+									break
+							elif ips:
 								for ip in ips:
 									failList.append([failRegexIndex, ip, date,
 										failRegex.getMatchedLines(), fail])
@@ -664,6 +886,12 @@ class Filter(JailThread):
 		"""
 		ret = [("Currently failed", self.failManager.size()),
 		       ("Total failed", self.failManager.getFailTotal())]
+		if self.failManager.getMaxCount():
+			ret.append(("Evicted failures", self.failManager.getEvictTotal()))
+		if self.__ignoreCache is not None:
+			hits, misses = self.getIgnoreCacheStats()
+			ret.append(("Ignore cache hits", hits))
+			ret.append(("Ignore cache misses", misses))
 		return ret
 
 
@@ -21,9 +21,13 @@ __author__ = "Fail2Ban Developers, Alexander Koeppe, Serg G. Brester, Yaroslav H
 __copyright__ = "Copyright (c) 2004-2016 Fail2ban Developers"
 __license__ = "GPL"
 
+from threading import Lock, Thread, current_thread
+import Queue
+import logging
 import socket
 import struct
 import re
+import time
 
 from .utils import Utils
 from ..helpers import getLogger
@@ -50,9 +54,21 @@ def asip(ip):
 #
 class DNSUtils:
 
-	# todo: make configurable the expired time and max count of cache entries:
+	# max count and expired time of cache entries are configurable (see fail2ban.conf):
 	CACHE_nameToIp = Utils.Cache(maxCount=1000, maxTime=5*60)
 	CACHE_ipToName = Utils.Cache(maxCount=1000, maxTime=5*60)
+	# expired time of negative cache entries (name not resolved), None - the same as positive:
+	CACHE_negTime = None
+
+	# pool of resolver threads (None - resolve synchronously) and deadline of lookup in the pool:
+	pool = None
+	resolveTimeout = None
+
+	@staticmethod
+	def resolve(dns):
+		"""Returns the list of addresses (strings) of given DNS name (can be replaced in tests)
+		"""
+		return [result[4][0] for result in socket.getaddrinfo(dns, None, 0, 0, socket.IPPROTO_TCP)]
 
 	@staticmethod
 	def dnsToIp(dns):
@@ -66,17 +82,33 @@ class DNSUtils:
 		# retrieve ips
 		try:
 			ips = list()
-			for result in socket.getaddrinfo(dns, None, 0, 0, socket.IPPROTO_TCP):
-				ip = IPAddr(result[4][0])
+			for result in DNSUtils.resolve(dns):
+				ip = IPAddr(result)
 				if ip.isValid:
 					ips.append(ip)
 		except socket.error as e:
-			# todo: make configurable the expired time of cache entry:
 			logSys.warning("Unable to find a corresponding IP address for %s: %s", dns, e)
 			ips = list()
-		DNSUtils.CACHE_nameToIp.set(dns, ips)
+		DNSUtils.CACHE_nameToIp.set(dns, ips, None if ips else DNSUtils.CACHE_negTime)
 		return ips
 
+	@staticmethod
+	def setResolverPool(threads=0):
+		"""Set count of resolver threads (0 - resolve synchronously)
+		"""
+		pool = DNSUtils.pool
+		if pool is not None:
+			pool.stop()
+		DNSUtils.pool = DNSResolverPool(threads, DNSUtils.resolveTimeout) if threads > 0 else None
+
+	@staticmethod
+	def setResolveTimeout(timeout):
+		"""Set deadline of lookup in resolver pool (None - wait until resolved)
+		"""
+		DNSUtils.resolveTimeout = timeout
+		if DNSUtils.pool is not None:
+			DNSUtils.pool.timeout = timeout
+
 	@staticmethod
 	def ipToName(ip):
 		# cache, also prevent long wait during retrieving of name for wrong addresses, lazy dns:
@@ -93,8 +125,12 @@ class DNSUtils:
 		return v
 
 	@staticmethod
-	def textToIp(text, useDns):
+	def textToIp(text, useDns, callback=None):
 		""" Return the IP of DNS found in a given text.
+
+		If `callback` is given and resolver pool is used, a DNS name which is not
+		cached will be resolved in background: returns None, the `callback` will
+		be called with the list of IPs if resolved (or deadline exceeded).
 		"""
 		ipList = list()
 		# Search for plain IP
@@ -107,14 +143,25 @@ class DNSUtils:
 		# If we are allowed to resolve -- give it a try if nothing was found
 		if useDns in ("yes", "warn") and not ipList:
 			# Try to get IP from possible DNS
-			ip = DNSUtils.dnsToIp(text)
-			ipList.extend(ip)
-			if ip and useDns == "warn":
-				logSys.warning("Determined IP using DNS Lookup: %s = %s",
-					text, ipList)
+			pool = DNSUtils.pool
+			if callback is not None and pool is not None:
+				ip = pool.lookup(text, 
+					lambda ips: callback(DNSUtils.__resolved(text, ips, useDns)))
+				if ip is None:
+					return None
+			else:
+				ip = DNSUtils.dnsToIp(text)
+			ipList = DNSUtils.__resolved(text, ip, useDns)
 
 		return ipList
 
+	@staticmethod
+	def __resolved(text, ips, useDns):
+		if ips and useDns == "warn":
+			logSys.warning("Determined IP using DNS Lookup: %s = %s",
+				text, ips)
+		return list(ips)
+
 
 ##
 # Class for IP address handling.
@@ -133,9 +180,9 @@ class IPAddr(object):
 	IP6_4COMPAT = None
 
 	# object attributes
-	__slots__ = '_family','_addr','_plen','_maskplen','_raw'
+	__slots__ = '_family','_addr','_plen','_maskplen','_raw','_packed','_ntoa','_mask'
 
-	# todo: make configurable the expired time and max count of cache entries:
+	# max count and expired time of cache entries are configurable (see fail2ban.conf):
 	CACHE_OBJ = Utils.Cache(maxCount=1000, maxTime=5*60)
 
 	CIDR_RAW = -2
@@ -161,6 +208,60 @@ class IPAddr(object):
 		IPAddr.CACHE_OBJ.set(args, ip)
 		return ip
 
+	@classmethod
+	def fromIPv4(cls, ipstr):
+		"""Fast constructor of IPv4 address (already classified, e. g. by group `ip4` of failregex)
+
+		Skips the recognition of family and mask, falls back to default constructor if not valid.
+		"""
+		args = (ipstr, IPAddr.CIDR_UNSPEC)
+		ip = IPAddr.CACHE_OBJ.get(args)
+		if ip is not None:
+			return ip
+		try:
+			binary = socket.inet_pton(socket.AF_INET, ipstr)
+		except socket.error:
+			return IPAddr(ipstr)
+		ip = super(IPAddr, cls).__new__(cls)
+		ip.__initPacked(socket.AF_INET, struct.unpack("!L", binary)[0], 32, ipstr, binary)
+		IPAddr.CACHE_OBJ.set(args, ip)
+		return ip
+
+	@classmethod
+	def fromIPv6(cls, ipstr):
+		"""Fast constructor of IPv6 address (already classified, e. g. by group `ip6` of failregex)
+
+		Skips the recognition of family and mask, falls back to default constructor if not valid.
+		"""
+		args = (ipstr, IPAddr.CIDR_UNSPEC)
+		ip = IPAddr.CACHE_OBJ.get(args)
+		if ip is not None:
+			return ip
+		try:
+			binary = socket.inet_pton(socket.AF_INET6, ipstr)
+		except socket.error:
+			return IPAddr(ipstr)
+		hi, lo = struct.unpack("!QQ", binary)
+		addr = (hi << 64) | lo
+		ip = super(IPAddr, cls).__new__(cls)
+		# if IPv6 address is a IPv4-compatible, make instance a IPv4:
+		if (addr & IPAddr.MASK6[96]) == IPAddr.IP6_4COMPAT._addr:
+			ip.__initPacked(socket.AF_INET, lo & 0xFFFFFFFFL, 32, ipstr, binary[12:])
+		else:
+			ip.__initPacked(socket.AF_INET6, addr, 128, ipstr, binary)
+		IPAddr.CACHE_OBJ.set(args, ip)
+		return ip
+
+	def __initPacked(self, family, addr, plen, raw, packed):
+		self._family = family
+		self._addr = addr
+		self._plen = plen
+		self._maskplen = None
+		self._raw = raw
+		self._packed = packed
+		self._ntoa = None
+		self._mask = None
+
 	@staticmethod
 	def __wrap_ipstr(ipstr):
 		# because of standard spelling of IPv6 (with port) enclosed in brackets ([ipv6]:port),
@@ -187,6 +288,9 @@ class IPAddr(object):
 		self._addr = 0
 		self._plen = 0
 		self._maskplen = None
+		self._packed = None
+		self._ntoa = None
+		self._mask = None
 		# always save raw value (normally used if really raw or not valid only):
 		self._raw = ipstr
 		# if not raw - recognize family, set addr, etc.:
@@ -206,9 +310,10 @@ class IPAddr(object):
 
 				# mask out host portion if prefix length is supplied
 				if cidr is not None and cidr >= 0:
-					mask = ~(0xFFFFFFFFL >> cidr)
-					self._addr &= mask
+					self._addr &= IPAddr.MASK4[min(cidr, 32)]
 					self._plen = cidr
+				else:
+					self._packed = binary
 
 			elif self._family == socket.AF_INET6:
 				# convert host to network byte order
@@ -218,8 +323,7 @@ class IPAddr(object):
 
 				# mask out host portion if prefix length is supplied
 				if cidr is not None and cidr >= 0:
-					mask = ~(0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFL >> cidr)
-					self._addr &= mask
+					self._addr &= IPAddr.MASK6[min(cidr, 128)]
 					self._plen = cidr
 
 				# if IPv6 address is a IPv4-compatible, make instance a IPv4
@@ -227,6 +331,9 @@ class IPAddr(object):
 					self._addr = lo & 0xFFFFFFFFL
 					self._family = socket.AF_INET
 					self._plen = 32
+					self._packed = binary[12:]
+				else:
+					self._packed = binary
 		else:
 			self._family = IPAddr.CIDR_RAW
 
@@ -256,6 +363,36 @@ class IPAddr(object):
 	def plen(self):
 		return self._plen
 
+	@property
+	def packed(self):
+		"""The address in network byte order (bytes, 4 or 16 bytes), empty if not valid
+		"""
+		packed = self._packed
+		if packed is None:
+			if self.isIPv4:
+				packed = struct.pack("!L", self._addr)
+			elif self.isIPv6:
+				packed = struct.pack("!QQ", self._addr >> 64, self._addr & 0xFFFFFFFFFFFFFFFFL)
+			else:
+				packed = b''
+			self._packed = packed
+		return packed
+
+	@property
+	def mask(self):
+		"""The network mask (as integer), precalculated by prefix length
+		"""
+		mask = self._mask
+		if mask is None:
+			if self.isIPv4:
+				mask = IPAddr.MASK4[min(self._plen, 32)]
+			elif self.isIPv6:
+				mask = IPAddr.MASK6[min(self._plen, 128)]
+			else:
+				mask = 0
+			self._mask = mask
+		return mask
+
 	@property
 	def raw(self):
 		"""The raw address
@@ -322,29 +459,26 @@ class IPAddr(object):
 		else:
 			return ""
 
-	# TODO: could be lazily evaluated
 	@property
 	def ntoa(self):
 		""" represent IP object as text like the deprecated
 			C pendant inet.ntoa but address family independent
 		"""
+		ntoa = self._ntoa
+		if ntoa is not None:
+			return ntoa
 		add = ''
 		if self.isIPv4:
-			# convert network to host byte order
-			binary = struct.pack("!L", self._addr)
 			if self._plen and self._plen < 32:
 				add = "/%d" % self._plen
 		elif self.isIPv6:
-			# convert network to host byte order
-			hi = self._addr >> 64
-			lo = self._addr & 0xFFFFFFFFFFFFFFFFL
-			binary = struct.pack("!QQ", hi, lo)
 			if self._plen and self._plen < 128:
 				add = "/%d" % self._plen
 		else:
 			return self._raw
 		
-		return socket.inet_ntop(self._family, binary) + add
+		ntoa = self._ntoa = socket.inet_ntop(self._family, self.packed) + add
+		return ntoa
 
 	def getPTR(self, suffix=""):
 		""" return the DNS PTR string of the provided IP address object
@@ -389,14 +523,14 @@ class IPAddr(object):
 
 		if self.family != net.family:
 			return False
-		if self.isIPv4:
-			mask = ~(0xFFFFFFFFL >> net.plen)
-		elif self.isIPv6:
-			mask = ~(0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFL >> net.plen)
-		else:
+		if not (self.isIPv4 or self.isIPv6):
 			return False
 		
-		return (self.addr & mask) == net.addr
+		return (self.addr & net.mask) == net.addr
+
+	# Pre-calculated masks by prefix length (index):
+	MASK4 = [(0xFFFFFFFFL << (32 - i)) & 0xFFFFFFFFL for i in xrange(33)]
+	MASK6 = [((1L << 128) - 1 << (128 - i)) & ((1L << 128) - 1) for i in xrange(129)]
 
 	# Pre-calculated map: addr to maskplen
 	def __getMaskMap():
@@ -447,3 +581,257 @@ class IPAddr(object):
 
 # An IPv4 compatible IPv6 to be reused
 IPAddr.IP6_4COMPAT = IPAddr("::ffff:0:0", 96)
+
+
+##
+# Class for sets of IP addresses / networks.
+#
+# Used for fast lookups in large lists of networks (e. g. ignoreip).
+#
+class IPAddrSet(object):
+	"""Set of IP addresses, networks and DNS names with fast lookup
+
+	Networks are stored in hash-sets by address family and prefix length (with
+	pre-calculated masks), so a lookup costs at most one hash-lookup per distinct
+	prefix length (32 for IPv4, 128 for IPv6), independent from count of networks.
+	DNS names are resolved in background (by adding and if resolved addresses
+	are older than `dnsRefresh` seconds), lookups use the last resolved addresses
+	meanwhile (a name added but not yet resolved matches nothing).
+	"""
+
+	def __init__(self, dnsRefresh=5*60):
+		self.dnsRefresh = dnsRefresh
+		self._lock = Lock()
+		## running refresh thread (released by the thread self at end):
+		self._dnsThread = None
+		self.clear()
+
+	def clear(self):
+		with self._lock:
+			## family -> {plen: set(addr)}:
+			self._nets = {socket.AF_INET: {}, socket.AF_INET6: {}}
+			## family -> list of (plen, mask) sorted by plen (longest prefix first):
+			self._plens = {socket.AF_INET: [], socket.AF_INET6: []}
+			## dns name -> set of resolved IPAddr (None - not yet resolved):
+			self._dns = {}
+			self._dnsNextRefresh = 0
+
+	def __len__(self):
+		return sum(len(nets) for fnets in self._nets.itervalues() 
+			for nets in fnets.itervalues()) + len(self._dns)
+
+	def _updatePlens(self, family):
+		# prefix lengths having networks (empty sets remain in _nets, so concurrent lookups never miss them):
+		masks = IPAddr.MASK4 if family == socket.AF_INET else IPAddr.MASK6
+		self._plens[family] = sorted(((plen, masks[min(plen, len(masks)-1)]) 
+			for plen, nets in self._nets[family].iteritems() if nets), reverse=True)
+
+	def add(self, ip):
+		"""Adds IP address, network or DNS name (as IPAddr)
+
+		DNS names are registered only, resolved by the refresh thread.
+		"""
+		ip = asip(ip)
+		if ip.isValid:
+			with self._lock:
+				family = ip.family
+				fnets = self._nets[family]
+				nets = fnets.get(ip.plen)
+				if not nets:
+					if nets is None:
+						nets = fnets[ip.plen] = set()
+					nets.add(ip.addr)
+					self._updatePlens(family)
+				else:
+					nets.add(ip.addr)
+		elif ip.raw != "":
+			with self._lock:
+				if ip.raw in self._dns:
+					return
+				self._dns[ip.raw] = None
+			self.refreshDNS()
+
+	def remove(self, ip):
+		"""Removes IP address, network or DNS name (as IPAddr)
+		"""
+		ip = asip(ip)
+		with self._lock:
+			if ip.isValid:
+				family = ip.family
+				nets = self._nets[family].get(ip.plen)
+				if nets:
+					nets.discard(ip.addr)
+					if not nets:
+						self._updatePlens(family)
+			else:
+				self._dns.pop(ip.raw, None)
+
+	def _refreshDNS(self):
+		try:
+			names = self._dns.keys()
+			while True:
+				for dns in names:
+					ips = set(DNSUtils.dnsToIp(dns))
+					with self._lock:
+						if dns in self._dns:
+							self._dns[dns] = ips
+				with self._lock:
+					# names added during refresh are resolved by the same thread:
+					names = [dns for dns, ips in self._dns.iteritems() if ips is None]
+					if not names:
+						self._dnsNextRefresh = time.time() + self.dnsRefresh
+						self._dnsThread = None
+						return
+		finally:
+			# release the handle on error (released above if done):
+			with self._lock:
+				if self._dnsThread is current_thread():
+					self._dnsNextRefresh = time.time() + self.dnsRefresh
+					self._dnsThread = None
+
+	def refreshDNS(self, wait=False):
+		"""Starts refresh of resolved DNS names in background
+		"""
+		with self._lock:
+			th = self._dnsThread
+			if th is None:
+				th = self._dnsThread = Thread(target=self._refreshDNS, 
+					name="f2b/dns-refresh")
+				th.daemon = True
+				th.start()
+		if wait:
+			th.join()
+
+	def find(self, ip):
+		"""Returns source of match ("ip" or "dns") if `ip` is in the set, otherwise None
+		"""
+		ip = asip(ip)
+		family = ip.family
+		plens = self._plens.get(family)
+		if plens:
+			fnets = self._nets[family]
+			addr = ip.addr
+			for plen, mask in plens:
+				if (addr & mask) in fnets[plen]:
+					return "ip"
+		if self._dns:
+			if time.time() >= self._dnsNextRefresh and self._dnsThread is None:
+				self.refreshDNS()
+			for ips in self._dns.values():
+				if ips and ip in ips:
+					return "dns"
+		return None
+
+	def __contains__(self, ip):
+		return self.find(ip) is not None
+
+
+##
+# Pool of threads to resolve DNS names in background.
+#
+class DNSResolverPool(object):
+	"""Resolves DNS names (using DNSUtils.dnsToIp) in `threads` background threads
+
+	Concurrent lookups of the same name are resolved once. If the name is not resolved
+	within `timeout` seconds, the callbacks are notified with empty list and the name
+	is cached as not resolved (negative cache), so the waiting failures can be completed.
+	"""
+
+	def __init__(self, threads=4, timeout=None):
+		self.threads = threads
+		self.timeout = timeout
+		self._lock = Lock()
+		self._queue = Queue.Queue()
+		## name -> [deadline, [callbacks]]:
+		self._pending = {}
+		self._workers = []
+		self._watcher = None
+		self._active = True
+
+	def __len__(self):
+		return len(self._pending)
+
+	def lookup(self, dns, callback):
+		"""Returns cached list of IPs or None if resolved in background (callback will be called)
+		"""
+		ips = DNSUtils.CACHE_nameToIp.get(dns)
+		if ips is not None:
+			return ips
+		self.checkDeadlines()
+		with self._lock:
+			pending = self._pending.get(dns)
+			if pending is not None:
+				pending[1].append(callback)
+				return None
+			self._pending[dns] = [
+				(time.time() + self.timeout) if self.timeout else None, [callback]]
+			if len(self._workers) < self.threads:
+				th = Thread(target=self._run, name="f2b/dns-%d" % len(self._workers))
+				th.daemon = True
+				self._workers.append(th)
+				th.start()
+			# watch deadlines (also if all workers hang in resolving):
+			if self.timeout and self._watcher is None:
+				th = self._watcher = Thread(target=self._watch, name="f2b/dns-watch")
+				th.daemon = True
+				th.start()
+		self._queue.put(dns)
+		return None
+
+	def _watch(self):
+		while True:
+			with self._lock:
+				if not (self._active and self._pending and self.timeout):
+					self._watcher = None
+					return
+			time.sleep(min(self.timeout / 2.0, 1))
+			self.checkDeadlines()
+
+	def _notify(self, dns, ips):
+		with self._lock:
+			pending = self._pending.pop(dns, None)
+		if pending is None:
+			return
+		for callback in pending[1]:
+			try:
+				callback(ips)
+			except Exception as e: # pragma: no cover
+				logSys.error("Processing of resolved %s failed: %r", dns, e,
+					exc_info=logSys.getEffectiveLevel()<=logging.DEBUG)
+
+	def checkDeadlines(self):
+		"""Notifies waiting of names exceeded the deadline (not resolved)
+		"""
+		if not self.timeout or not self._pending:
+			return
+		t = time.time()
+		with self._lock:
+			expired = [dns for dns, pending in self._pending.iteritems() 
+				if pending[0] is not None and pending[0] <= t]
+		for dns in expired:
+			logSys.warning("Deadline exceeded by resolving of %s", dns)
+			DNSUtils.CACHE_nameToIp.set(dns, [], DNSUtils.CACHE_negTime)
+			self._notify(dns, [])
+
+	def _run(self):
+		while self._active:
+			try:
+				dns = self._queue.get(timeout=1)
+			except Queue.Empty:
+				continue
+			if dns is None:
+				break
+			# deadline already exceeded - nothing to do:
+			if dns not in self._pending:
+				continue
+			try:
+				ips = DNSUtils.dnsToIp(dns)
+			except Exception as e: # pragma: no cover
+				logSys.error("Resolving of %s failed: %r", dns, e)
+				ips = []
+			self._notify(dns, ips)
+
+	def stop(self):
+		self._active = False
+		for th in self._workers:
+			self._queue.put(None)
@@ -266,6 +266,8 @@ class Jail(object):
 
 	def restoreCurrentBans(self):
 		"""Restore any previous valid bans from the database.
+
+		The tickets are restored in bulk (see `Actions.restoreBans`).
 		"""
 		try:
 			if self.database is not None:
@@ -273,6 +275,7 @@ class Jail(object):
 				# use ban time as search time if we have not enabled a increasing:
 				if not self.getBanTimeExtra('increment'):
 					forbantime = self.actions.getBanTime()
+				tickets = []
 				for ticket in self.database.getCurrentBans(jail=self, forbantime=forbantime):
 					#logSys.debug('restored ticket: %s', ticket)
 					if not self.filter.inIgnoreIPList(ticket.getIP(), log_ignore=True):
@@ -286,7 +289,10 @@ class Jail(object):
 						# ignore obsolete tickets:
 						if btm != -1 and btm <= 0:
 							continue
-						self.putFailTicket(ticket)
+						tickets.append(ticket)
+				if tickets:
+					logSys.info("Jail %r: restore %s ban(s)", self.name, len(tickets))
+					self.actions.restoreBans(tickets)
 		except Exception as e: # pragma: no cover
 			logSys.error('%s', e, exc_info=logSys.getEffectiveLevel()<=logging.DEBUG)
 
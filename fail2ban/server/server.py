@@ -33,11 +33,14 @@ import signal
 import stat
 import sys
 
+from .action import CmdLock
 from .observer import Observers, ObserverThread
 from .jails import Jails
 from .filter import FileFilter, JournalFilter
 from .transmitter import Transmitter
 from .asyncserver import AsyncServer, AsyncServerException
+from .ipdns import DNSUtils, IPAddr
+from .mytime import MyTime
 from .. import version
 from ..helpers import getLogger, str2LogLevel, getVerbosityFormat, excepthook
 
@@ -390,6 +393,12 @@ class Server:
 	def getIgnoreCommand(self, name):
 		return self.__jails[name].filter.getIgnoreCommand()
 
+	def setIgnoreCache(self, name, opt, value):
+		self.__jails[name].filter.setIgnoreCache(opt, value)
+
+	def getIgnoreCache(self, name, opt):
+		return self.__jails[name].filter.getIgnoreCache(opt)
+
 	def addFailRegex(self, name, value, multiple=False):
 		flt = self.__jails[name].filter
 		if not multiple: value = (value,)
@@ -428,6 +437,24 @@ class Server:
 	def getMaxRetry(self, name):
 		return self.__jails[name].filter.getMaxRetry()
 	
+	def setMaxFailures(self, name, value):
+		self.__jails[name].filter.setMaxFailures(value)
+	
+	def getMaxFailures(self, name):
+		return self.__jails[name].filter.getMaxFailures()
+	
+	def setEvictPolicy(self, name, value):
+		self.__jails[name].filter.setEvictPolicy(value)
+	
+	def getEvictPolicy(self, name):
+		return self.__jails[name].filter.getEvictPolicy()
+	
+	def setCountMode(self, name, value):
+		self.__jails[name].filter.setCountMode(value)
+	
+	def getCountMode(self, name):
+		return self.__jails[name].filter.getCountMode()
+	
 	def setMaxLines(self, name, value):
 		self.__jails[name].filter.setMaxLines(value)
 	
@@ -478,6 +505,15 @@ class Server:
 
 	def getBanTimeExtra(self, name, opt):
 		return self.__jails[name].getBanTimeExtra(opt)
+
+	def setActionThreads(self, name, value):
+		self.__jails[name].actions.setActionThreads(value)
+
+	def getActionThreads(self, name):
+		return self.__jails[name].actions.getActionThreads()
+
+	def getActionStats(self, name):
+		return self.__jails[name].actions.getStats()
 	
 	def isStarted(self):
 		return self.__asyncServer is not None and self.__asyncServer.isActive()
@@ -692,6 +728,65 @@ class Server:
 	def getDatabase(self):
 		return self.__db
 
+	@staticmethod
+	def __getCache(name):
+		try:
+			return {
+				"ipaddr": IPAddr.CACHE_OBJ,
+				"dnstoip": DNSUtils.CACHE_nameToIp,
+				"iptodns": DNSUtils.CACHE_ipToName
+			}[name]
+		except KeyError:
+			raise ValueError("unknown cache %r" % (name,))
+
+	def setCacheOption(self, name, opt, value):
+		cache = Server.__getCache(name)
+		if opt == "maxcount":
+			value = int(value)
+			if value <= 0:
+				raise ValueError("max count of cache entries should be positive")
+			cache.setOptions(maxCount=value, maxTime=cache.maxTime)
+		elif opt == "maxtime":
+			cache.setOptions(maxCount=cache.maxCount, maxTime=MyTime.str2seconds(value))
+		else:
+			raise ValueError("unknown cache option %r" % (opt,))
+		logSys.info("Set cache.%s.%s = %s", name, opt, value)
+
+	def getCacheOption(self, name, opt):
+		cache = Server.__getCache(name)
+		if opt == "maxcount":
+			return cache.maxCount
+		elif opt == "maxtime":
+			return cache.maxTime
+		elif opt == "stats":
+			return list(cache.getStats())
+		raise ValueError("unknown cache option %r" % (opt,))
+
+	def setDNSOption(self, opt, value):
+		if opt == "threads":
+			DNSUtils.setResolverPool(int(value))
+		elif opt == "timeout":
+			DNSUtils.setResolveTimeout(
+				MyTime.str2seconds(value) if value not in ("", None) else None)
+		elif opt == "negtime":
+			DNSUtils.CACHE_negTime = MyTime.str2seconds(value) if value not in ("", None) else None
+		else:
+			raise ValueError("unknown dns option %r" % (opt,))
+		logSys.info("Set dns.%s = %s", opt, value)
+
+	def getDNSOption(self, opt):
+		if opt == "threads":
+			pool = DNSUtils.pool
+			return pool.threads if pool is not None else 0
+		elif opt == "timeout":
+			return DNSUtils.resolveTimeout
+		elif opt == "negtime":
+			return DNSUtils.CACHE_negTime
+		raise ValueError("unknown dns option %r" % (opt,))
+
+	def getCmdLocks(self):
+		return CmdLock.getStats()
+
 	def __createDaemon(self): # pragma: no cover
 		""" Detach a process from the controlling terminal and run it in the
 			background as a daemon.
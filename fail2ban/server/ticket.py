@@ -34,6 +34,9 @@ logSys = getLogger(__name__)
 
 class Ticket(object):
 
+	# object attributes (no __dict__, tickets can be held in large amounts by managers):
+	__slots__ = ('__ip', '_flags', '_banCount', '_banTime', '_time', '_data')
+
 	MAX_TIME = 0X7FFFFFFFFFFF ;# 4461763-th year
 	
 	RESTORED = 0x01
@@ -57,7 +60,26 @@ class Ticket(object):
 			self._data.update(data)
 		if ticket:
 			# ticket available - copy whole information from ticket:
-			self.__dict__.update(i for i in ticket.__dict__.iteritems() if i[0] in self.__dict__)
+			for n in Ticket._slotNames(self.__class__):
+				try:
+					setattr(self, n, getattr(ticket, n))
+				except AttributeError:
+					pass
+
+	@staticmethod
+	def _slotNames(cls, _cache={}):
+		"""Returns (mangled) names of all slot attributes of the ticket class (cached)
+		"""
+		names = _cache.get(cls)
+		if names is None:
+			names = []
+			for c in cls.__mro__:
+				for n in c.__dict__.get('__slots__', ()):
+					if n.startswith('__') and not n.endswith('__'):
+						n = '_%s%s' % (c.__name__.lstrip('_'), n)
+					names.append(n)
+			_cache[cls] = names
+		return names
 
 	def __str__(self):
 		return "%s: ip=%s time=%s bantime=%s bancount=%s #attempts=%d matches=%r" % \
@@ -199,6 +221,8 @@ class Ticket(object):
 
 class FailTicket(Ticket):
 
+	__slots__ = ('__retry', '__lastReset')
+
 	def __init__(self, ip=None, time=None, matches=None, data={}, ticket=None):
 		# this class variables:
 		self.__retry = 0
@@ -253,4 +277,5 @@ class FailTicket(Ticket):
 # This class extends the Ticket class. It is mainly used by the BanManager.
 
 class BanTicket(Ticket):
-	pass
+
+	__slots__ = ()
@@ -168,6 +168,15 @@ class Transmitter:
 			else:
 				db.purgeage = command[1]
 				return db.purgeage
+		# Caches
+		elif name.startswith("cache."):
+			cache, opt = name[len("cache."):].split(".", 1)
+			self.__server.setCacheOption(cache, opt, command[1])
+			return self.__server.getCacheOption(cache, opt)
+		elif name.startswith("dns."):
+			opt = name[len("dns."):]
+			self.__server.setDNSOption(opt, command[1])
+			return self.__server.getDNSOption(opt)
 		# Jail
 		elif command[1] == "idle":
 			if command[2] == "on":
@@ -190,6 +199,11 @@ class Transmitter:
 			value = command[2]
 			self.__server.setIgnoreCommand(name, value)
 			return self.__server.getIgnoreCommand(name)
+		elif command[1].startswith("ignorecache."):
+			value = command[2]
+			opt = command[1][len("ignorecache."):]
+			self.__server.setIgnoreCache(name, opt, value)
+			return self.__server.getIgnoreCache(name, opt)
 		elif command[1] == "addlogpath":
 			value = command[2]
 			tail = False
@@ -254,6 +268,18 @@ class Transmitter:
 			value = command[2]
 			self.__server.setMaxRetry(name, int(value))
 			return self.__server.getMaxRetry(name)
+		elif command[1] == "maxfailures":
+			value = command[2]
+			self.__server.setMaxFailures(name, int(value))
+			return self.__server.getMaxFailures(name)
+		elif command[1] == "evictpolicy":
+			value = command[2]
+			self.__server.setEvictPolicy(name, value)
+			return self.__server.getEvictPolicy(name)
+		elif command[1] == "countmode":
+			value = command[2]
+			self.__server.setCountMode(name, value)
+			return self.__server.getCountMode(name)
 		elif command[1] == "maxlines":
 			value = command[2]
 			self.__server.setMaxLines(name, int(value))
@@ -268,6 +294,10 @@ class Transmitter:
 			opt = command[1][len("bantime."):]
 			self.__server.setBanTimeExtra(name, opt, value)
 			return self.__server.getBanTimeExtra(name, opt)
+		elif command[1] == "actionthreads":
+			value = command[2]
+			self.__server.setActionThreads(name, int(value))
+			return self.__server.getActionThreads(name)
 		elif command[1] == "banip":
 			value = command[2]
 			return self.__server.setBanIP(name,value)
@@ -332,6 +362,16 @@ class Transmitter:
 				return None
 			else:
 				return db.purgeage
+		# Caches
+		elif name.startswith("cache."):
+			cache, opt = name[len("cache."):].split(".", 1)
+			return self.__server.getCacheOption(cache, opt)
+		elif name.startswith("dns."):
+			opt = name[len("dns."):]
+			return self.__server.getDNSOption(opt)
+		# Command locks
+		elif name == "cmdlocks":
+			return self.__server.getCmdLocks()
 		# Filter
 		elif command[1] == "logpath":
 			return self.__server.getLogPath(name)
@@ -343,6 +383,9 @@ class Transmitter:
 			return self.__server.getIgnoreIP(name)
 		elif command[1] == "ignorecommand":
 			return self.__server.getIgnoreCommand(name)
+		elif command[1].startswith("ignorecache."):
+			opt = command[1][len("ignorecache."):]
+			return self.__server.getIgnoreCache(name, opt)
 		elif command[1] == "failregex":
 			return self.__server.getFailRegex(name)
 		elif command[1] == "ignoreregex":
@@ -355,6 +398,12 @@ class Transmitter:
 			return self.__server.getDatePattern(name)
 		elif command[1] == "maxretry":
 			return self.__server.getMaxRetry(name)
+		elif command[1] == "maxfailures":
+			return self.__server.getMaxFailures(name)
+		elif command[1] == "evictpolicy":
+			return self.__server.getEvictPolicy(name)
+		elif command[1] == "countmode":
+			return self.__server.getCountMode(name)
 		elif command[1] == "maxlines":
 			return self.__server.getMaxLines(name)
 		# Action
@@ -363,6 +412,10 @@ class Transmitter:
 		elif command[1].startswith("bantime."):
 			opt = command[1][len("bantime."):]
 			return self.__server.getBanTimeExtra(name, opt)
+		elif command[1] == "actionthreads":
+			return self.__server.getActionThreads(name)
+		elif command[1] == "actionstats":
+			return self.__server.getActionStats(name)
 		elif command[1] == "actions":
 			return self.__server.getActions(name).keys()
 		elif command[1] == "action":
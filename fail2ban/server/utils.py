@@ -28,6 +28,7 @@ import signal
 import subprocess
 import sys
 import time
+from threading import Lock
 from ..helpers import getLogger, uni_decode
 
 if sys.version_info >= (3, 3):
@@ -63,40 +64,82 @@ class Utils():
 
 
 	class Cache(object):
-		"""A simple cache with a TTL and limit on size
+		"""A LRU cache with a TTL and limit on size
+
+		All operations are O(1): entries are kept in a circular doubly linked list
+		ordered by last use, so if max count is reached the least recently used
+		entry will be removed. Expired entries are removed by access (or by LRU).
 		"""
 
 		def __init__(self, *args, **kwargs):
 			self.setOptions(*args, **kwargs)
-			self._cache = {}
+			self._lock = Lock()
+			self.clear()
 
 		def setOptions(self, maxCount=1000, maxTime=60):
 			self.maxCount = maxCount
 			self.maxTime = maxTime
 
+		def clear(self):
+			self._cache = {}
+			# root of circular list of links [prev, next, key, value, expires]
+			# (root[1] - least, root[0] - most recently used entry):
+			root = self._root = []
+			root[:] = [root, root, None, None, None]
+			self.hits = self.misses = 0
+
 		def __len__(self):
 			return len(self._cache)
 
 		def get(self, k, defv=None):
-			v = self._cache.get(k)
-			if v: 
-				if v[1] > time.time():
-					return v[0]
-				del self._cache[k]
+			with self._lock:
+				link = self._cache.get(k)
+				if link is not None:
+					if link[4] > time.time():
+						# move to most recently used:
+						prev, nxt = link[0], link[1]
+						prev[1] = nxt; nxt[0] = prev
+						root = self._root
+						last = root[0]
+						last[1] = root[0] = link
+						link[0] = last; link[1] = root
+						self.hits += 1
+						return link[3]
+					self.__unlink(k, link)
+				self.misses += 1
 			return defv
-			
-		def set(self, k, v):
-			t = time.time()
-			cache = self._cache  # for shorter local access
-			# clean cache if max count reached:
-			if len(cache) >= self.maxCount:
-				for (ck, cv) in cache.items():
-					if cv[1] < t:
-						del cache[ck]
-				# if still max count - remove any one:
-				if len(cache) >= self.maxCount:
-					cache.popitem()
-			cache[k] = (v, t + self.maxTime)
+
+		def __unlink(self, k, link):
+			prev, nxt = link[0], link[1]
+			prev[1] = nxt; nxt[0] = prev
+			del self._cache[k]
+
+		def set(self, k, v, maxTime=None):
+			exp = time.time() + (self.maxTime if maxTime is None else maxTime)
+			with self._lock:
+				cache = self._cache  # for shorter local access
+				link = cache.get(k)
+				if link is not None:
+					self.__unlink(k, link)
+				# remove least recently used if max count reached:
+				while len(cache) >= self.maxCount and cache:
+					lru = self._root[1]
+					self.__unlink(lru[2], lru)
+				root = self._root
+				last = root[0]
+				link = [last, root, k, v, exp]
+				last[1] = root[0] = cache[k] = link
+
+		def unset(self, k):
+			with self._lock:
+				link = self._cache.get(k)
+				if link is not None:
+					self.__unlink(k, link)
+
+		def getStats(self):
+			"""Returns hits, misses and count of cached entries
+			"""
+			return self.hits, self.misses, len(self._cache)
 
 
 	@staticmethod
@@ -144,7 +187,8 @@ class Utils():
 		try:
 			popen = subprocess.Popen(
 				realCmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=shell,
-				preexec_fn=os.setsid  # so that killpg does not kill our process
+				preexec_fn=os.setsid, # so that killpg does not kill our process
+				close_fds=True # don't inherit pipes of commands executed concurrently
 			)
 			# wait with timeout for process has terminated:
 			retcode = popen.poll()
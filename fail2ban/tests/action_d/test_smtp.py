@@ -36,12 +36,14 @@ class TestSMTPServer(smtpd.SMTPServer):
 	def __init__(self, *args):
 		smtpd.SMTPServer.__init__(self, *args)
 		self.ready = False
+		self.messages = []
 
 	def process_message(self, peer, mailfrom, rcpttos, data):
 		self.peer = peer
 		self.mailfrom = mailfrom
 		self.rcpttos = rcpttos
 		self.data = data
+		self.messages.append(data)
 		self.ready = True
 
 
@@ -74,6 +76,7 @@ class SMTPActionTest(unittest.TestCase):
 
 	def tearDown(self):
 		"""Call after every test case."""
+		self.action._close()
 		self.smtpd.close()
 		self._active = False
 		self._loop_thread.join()
@@ -129,6 +132,99 @@ class SMTPActionTest(unittest.TestCase):
 		self._exec_and_wait(lambda: self.action.ban(aInfo))
 		self.assertIn(aInfo['ipmatches'], self.smtpd.data)
 
+	def testBanMany(self):
+		aInfos = [{
+			'ip': "127.0.0.%d" % i,
+			'failures': i,
+			'matches': "Test fail %d\n" % i,
+			} for i in (2, 3)]
+
+		self._exec_and_wait(lambda: self.action.ban_many(aInfos))
+		self.assertEqual(self.smtpd.rcpttos, ["root"])
+		subject = "Subject: [Fail2Ban] %s: banned 2 IPs" % self.jail.name
+		self.assertIn(subject, self.smtpd.data.replace("\n", ""))
+		self.assertIn("The IP 127.0.0.2 after 2 attempts", self.smtpd.data)
+		self.assertIn("The IP 127.0.0.3 after 3 attempts", self.smtpd.data)
+		self.assertNotIn("Test fail", self.smtpd.data)
+
+		self.action.matches = "matches"
+		self._exec_and_wait(lambda: self.action.ban_many(aInfos))
+		self.assertIn("Test fail 2", self.smtpd.data)
+		self.assertIn("Test fail 3", self.smtpd.data)
+
+	def testConnectionReuse(self):
+		self._exec_and_wait(self.action.start)
+		peer = self.smtpd.peer
+		self._exec_and_wait(self.action.start)
+		# the same connection (client port):
+		self.assertEqual(self.smtpd.peer, peer)
+		# connection lost (e.g. closed by server) - reconnect:
+		self.action._smtp.sock.close()
+		self._exec_and_wait(self.action.start)
+		self.assertEqual(len(self.smtpd.messages), 3)
+		self.assertNotEqual(self.smtpd.peer, peer)
+		# closed if idle:
+		self.action.idletimeout = 0.1
+		self._exec_and_wait(self.action.start)
+		self.assertTrue(self.action._smtp is not None)
+		self.assertTrue(Utils.wait_for(lambda: self.action._smtp is None, 3))
+		# no pooling:
+		self.action.idletimeout = 0
+		peer = self.smtpd.peer
+		self._exec_and_wait(self.action.start)
+		self.assertEqual(len(self.smtpd.messages), 5)
+		self.assertNotEqual(self.smtpd.peer, peer)
+		self.assertTrue(self.action._smtp is None)
+
+	def testDigest(self):
+		self.action.digest = 1
+		aInfos = [{
+			'ip': "127.0.0.%d" % i,
+			'failures': i,
+			'matches': "Test fail %d\n" % i,
+			} for i in (2, 3, 4)]
+		# single ban - common message:
+		self._exec_and_wait(lambda: self.action.ban(aInfos[0]))
+		self.assertEqual(len(self.smtpd.messages), 1)
+		subject = "Subject: [Fail2Ban] %s: banned 127.0.0.2" % self.jail.name
+		self.assertIn(subject, self.smtpd.data.replace("\n", ""))
+		# collected bans - single digest message:
+		self.action.ban(aInfos[0])
+		self.action.ban_many(aInfos[1:])
+		self.assertEqual(len(self.smtpd.messages), 1)
+		self._exec_and_wait(lambda: None)
+		self.assertEqual(len(self.smtpd.messages), 2)
+		subject = "Subject: [Fail2Ban] %s: banned 3 IPs" % self.jail.name
+		self.assertIn(subject, self.smtpd.data.replace("\n", ""))
+		for i in (2, 3, 4):
+			self.assertIn("The IP 127.0.0.%d after %d attempts" % (i, i), self.smtpd.data)
+		# stop sends collected bans before:
+		self.action.digest = 60
+		self.action.ban(aInfos[0])
+		self.action.ban(aInfos[1])
+		self.action.stop()
+		Utils.wait_for(lambda: len(self.smtpd.messages) >= 4, 3)
+		self.assertIn("banned 2 IPs", self.smtpd.messages[2].replace("\n", ""))
+		self.assertIn("stopped", self.smtpd.messages[3].replace("\n", ""))
+
+	def testDigestFailed(self):
+		self.action.digest = 60
+		self.action.ban({'ip': "127.0.0.2", 'failures': 2, 'matches': ""})
+		self.action.ban({'ip': "127.0.0.3", 'failures': 3, 'matches': ""})
+		# sending fails (server not available) - bans kept, timer rescheduled:
+		host, self.action.host = self.action.host, "127.0.0.1:1"
+		self.action._sendDigest()
+		self.assertEqual(len(self.action._digestBans), 2)
+		self.assertTrue(self.action._digestTimer is not None)
+		# sent by next digest (together with the bans collected meanwhile):
+		self.action.host = host
+		self.action.ban({'ip': "127.0.0.4", 'failures': 4, 'matches': ""})
+		self._exec_and_wait(self.action._sendDigest)
+		self.assertEqual(len(self.smtpd.messages), 1)
+		self.assertIn("banned 3 IPs", self.smtpd.data.replace("\n", ""))
+		self.assertEqual(self.action._digestBans, [])
+		self.assertTrue(self.action._digestTimer is None)
+
 	def testOptions(self):
 		self._exec_and_wait(self.action.start)
 		self.assertEqual(self.smtpd.mailfrom, "fail2ban")
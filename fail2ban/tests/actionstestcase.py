@@ -27,8 +27,10 @@ __license__ = "GPL"
 import time
 import os
 import tempfile
+import threading
 
-from ..server.actions import Actions
+from ..server.actions import Actions, ActionExecutor
+from ..server.mytime import MyTime
 from ..server.ticket import FailTicket
 from ..server.utils import Utils
 from .dummyjail import DummyJail
@@ -163,3 +165,262 @@ class ExecuteActions(LogCaptureTestCase):
 		self.assertNotLogged("Failed to execute unban")
 		self.assertLogged("action1 unban deleted aInfo IP")
 		self.assertLogged("action2 unban deleted aInfo IP")
+
+	def testBanActionsPythonMany(self):
+		# python action without batch methods (ActionBase defaults) - fallback to ban/unban per IP:
+		self.__actions.add(
+			"action1",
+			os.path.join(TEST_FILES_DIR, "action.d/action_modifyainfo.py"),
+			{})
+		action = self.__actions["action1"]
+		self.assertFalse(action.ban_many([{'ip': '192.0.2.1'}]))
+		self.assertFalse(action.unban_many([{'ip': '192.0.2.1'}]))
+		for i in xrange(1, 3):
+			self.__jail.putFailTicket(FailTicket("192.0.2.%d" % i))
+		self.assertEqual(self.__actions._Actions__checkBan(), 2)
+		self.assertNotLogged("Failed to execute ban")
+		self.assertEqual(self.getLog().count("action1 ban deleted aInfo IP"), 2)
+		self.assertEqual(self.__actions._Actions__flushBan(), 2)
+		self.assertNotLogged("Failed to execute unban")
+		self.assertLogged("action1 unban deleted aInfo IP")
+
+	def testBanActionsSharedAInfo(self):
+		self.__actions.add('a1')
+		self.__actions.add('a2')
+		self.__actions['a1'].actionban = 'echo a1 ban <ip>'
+		self.__actions['a2'].actionban = 'echo a2 ban <ip> <matches>'
+		self.__actions['a1'].actionunban = 'echo a1 unban <ip>'
+		self.__actions['a2'].actionunban = 'echo a2 unban <ip>'
+		seen = []
+		for name in ('a1', 'a2'):
+			for op in ('ban', 'unban'):
+				action = self.__actions[name]
+				setattr(action, op, lambda aInfo, f=getattr(action, op): (seen.append(aInfo), f(aInfo)))
+		self.__jail.putFailTicket(FailTicket("192.0.2.1", MyTime.time(), ["line1\n", "line2\n"]))
+		self.assertEqual(self.__actions._Actions__checkBan(), 1)
+		self.assertLogged("a1 ban 192.0.2.1", "a2 ban 192.0.2.1 line1", all=True)
+		# same (immutable) ban info for both actions, matches joined once (only used by a2):
+		self.assertEqual(len(seen), 2)
+		self.assertIs(seen[0], seen[1])
+		self.assertRaises(TypeError, seen[0].__delitem__, 'ip')
+		self.assertEqual(seen[0]._values, {'matches': "line1\n\nline2\n"})
+		# unban - shared, matches not used at all:
+		del seen[:]
+		self.__actions._Actions__flushBan()
+		self.assertLogged("a1 unban 192.0.2.1", "a2 unban 192.0.2.1", all=True)
+		self.assertEqual(len(seen), 2)
+		self.assertIs(seen[0], seen[1])
+		self.assertEqual(seen[0]._values, {})
+
+	def testBanActionsBatch(self):
+		self.defaultActions()
+		self.__ip.actioncheck = ''
+		self.__ip.actionban_batch = 'echo ip ban-batch <ips> >> "%s"' % self.__tmpfilename
+		for i in xrange(1, 4):
+			self.__jail.putFailTicket(FailTicket("192.0.2.%d" % i))
+		self.assertEqual(self.__actions._Actions__checkBan(), 3)
+		# single command for all tickets banned in this cycle:
+		with open(self.__tmpfilename) as f:
+			out = f.read().split()
+		self.assertEqual(out[:2], ["ip", "ban-batch"])
+		self.assertEqual(sorted(out[2:]), ["192.0.2.1", "192.0.2.2", "192.0.2.3"])
+		self.assertEqual(self.__actions.status()[0], ("Currently banned", 3))
+		# single ticket uses common ban:
+		self.__jail.putFailTicket(FailTicket("192.0.2.4"))
+		self.assertEqual(self.__actions._Actions__checkBan(), 1)
+		with open(self.__tmpfilename) as f:
+			self.assertEqual(f.read().split("\n")[1], "ip ban 192.0.2.4")
+		# failed batch:
+		self.__ip.actionban_batch = 'false <ips>'
+		for i in xrange(5, 7):
+			self.__jail.putFailTicket(FailTicket("192.0.2.%d" % i))
+		self.assertEqual(self.__actions._Actions__checkBan(), 2)
+		self.assertLogged("Failed to execute ban_many jail 'DummyJail #")
+
+	def testUnbanActionsBatch(self):
+		self.defaultActions()
+		self.__ip.actioncheck = ''
+		self.__ip.actionstart = ''
+		self.__ip.actionban = ''
+		self.__ip.actionunban_batch = 'echo ip unban-batch <ips> >> "%s"' % self.__tmpfilename
+		self.__actions.setBanTime(10)
+		MyTime.setTime(1000)
+		try:
+			for i in xrange(1, 4):
+				self.__jail.putFailTicket(FailTicket("192.0.2.%d" % i, 1000))
+			self.__jail.putFailTicket(FailTicket("192.0.2.4", 1005))
+			self.assertEqual(self.__actions._Actions__checkBan(), 4)
+			# co-expiring tickets unbanned by single command:
+			MyTime.setTime(1012)
+			self.assertEqual(self.__actions._Actions__checkUnBan(), 3)
+			with open(self.__tmpfilename) as f:
+				out = f.read().split()
+			self.assertEqual(out[:2], ["ip", "unban-batch"])
+			self.assertEqual(sorted(out[2:]), ["192.0.2.1", "192.0.2.2", "192.0.2.3"])
+			self.assertEqual(self.__actions.status()[0], ("Currently banned", 1))
+			# flush (stop/reload) uses batch also, single ticket - common unban:
+			self.__ip.actionunban = 'echo ip unban <ip> >> "%s"' % self.__tmpfilename
+			self.assertEqual(self.__actions._Actions__flushBan(), 1)
+			with open(self.__tmpfilename) as f:
+				self.assertEqual(f.read().splitlines()[1:], ["ip unban 192.0.2.4"])
+			for i in xrange(5, 8):
+				self.__jail.putFailTicket(FailTicket("192.0.2.%d" % i, 1012))
+			self.assertEqual(self.__actions._Actions__checkBan(), 3)
+			self.assertEqual(self.__actions._Actions__flushBan(), 3)
+			with open(self.__tmpfilename) as f:
+				out = f.read().splitlines()[2].split()
+			self.assertEqual(out[:2], ["ip", "unban-batch"])
+			self.assertEqual(sorted(out[2:]), ["192.0.2.5", "192.0.2.6", "192.0.2.7"])
+		finally:
+			MyTime.setTime(None)
+
+	def testBanActionsRetry(self):
+		self.defaultActions()
+		okfile = self.__tmpfilename + '.ok'
+		self.__ip.actioncheck = ''
+		self.__ip.actionban = '[ -e "%s" ] && echo ip ban <ip> >> "%s"' % (okfile, self.__tmpfilename)
+		self.__ip.actionunban = '[ -e "%s" ] && echo ip unban <ip> >> "%s"' % (okfile, self.__tmpfilename)
+		checkRetry = self.__actions._Actions__checkRetry
+		stats = lambda: dict(self.__actions.getStats())
+		MyTime.setTime(1000)
+		try:
+			self.__jail.putFailTicket(FailTicket("192.0.2.1", 1000))
+			self.assertEqual(self.__actions._Actions__checkBan(), 1)
+			self.assertLogged("Failed to execute ban jail")
+			self.assertEqual((stats()["Retry queue"], stats()["Failures"]), (1, (1, 0)))
+			# not yet due:
+			self.assertEqual(checkRetry(), 0)
+			# 1st retry fails also (next in 10 seconds - backoff):
+			MyTime.setTime(1005)
+			self.assertEqual(checkRetry(), 1)
+			self.assertLogged("action 'ip': retry 1 of ban 192.0.2.1 failed")
+			self.assertEqual((stats()["Retry queue"], stats()["Failures"]), (1, (2, 0)))
+			MyTime.setTime(1014)
+			self.assertEqual(checkRetry(), 0)
+			# firewall repaired - 2nd retry succeeds:
+			open(okfile, 'w').close()
+			MyTime.setTime(1015)
+			self.assertEqual(checkRetry(), 1)
+			self.assertLogged("action 'ip': ban 192.0.2.1 succeeded by retry 2")
+			self.assertEqual((stats()["Retry queue"], stats()["Failures"]), (0, (2, 0)))
+			with open(self.__tmpfilename) as f:
+				self.assertEqual(f.read().splitlines(), ["ip ban 192.0.2.1"])
+			# failed unban, retry is obsolete if banned again:
+			os.remove(okfile)
+			self.__actions.removeBannedIP("192.0.2.1")
+			self.assertLogged("Failed to execute unban jail")
+			self.assertEqual(stats()["Retry queue"], 1)
+			self.__jail.putFailTicket(FailTicket("192.0.2.1", 1015))
+			self.assertEqual(self.__actions._Actions__checkBan(), 1)
+			self.assertEqual(stats()["Retry queue"], 2)
+			# (the failed ban is retried):
+			MyTime.setTime(1020)
+			self.assertEqual(checkRetry(), 1)
+			self.assertLogged("action 'ip': drop obsolete retry of unban 192.0.2.1")
+			# bounded attempts:
+			self.__actions.retryAttempts = 2
+			MyTime.setTime(1030)
+			self.assertEqual(checkRetry(), 1)
+			self.assertLogged("action 'ip': ban of 192.0.2.1 failed, give up after 2 retries")
+			self.assertEqual((stats()["Retry queue"], stats()["Failures"]), (0, (6, 1)))
+		finally:
+			MyTime.setTime(None)
+			if os.path.exists(okfile):
+				os.remove(okfile)
+
+	def testRestoreBansBulk(self):
+		self.defaultActions()
+		self.__ip.actioncheck = ''
+		self.__ip.actionban_batch = 'echo ip ban-batch <ips> >> "%s"' % self.__tmpfilename
+		tickets = []
+		for i in xrange(150):
+			ticket = FailTicket("192.0.%d.%d" % divmod(i, 256))
+			ticket.restored = True
+			tickets.append(ticket)
+		self.__jail.putFailTicket(FailTicket("192.0.2.250"))
+		self.__actions.restoreBans(tickets)
+		# all restored tickets at once (not limited by count per cycle) with single command:
+		self.assertEqual(self.__actions._Actions__checkBan(), 150)
+		self.assertLogged("] Restore Ban 192.0.0.1")
+		with open(self.__tmpfilename) as f:
+			out = f.read().split("\n")
+		self.assertEqual(len(out[0].split()), 2 + 150)
+		self.assertEqual(out[1], "")
+		# new ticket in next cycle:
+		self.assertEqual(self.__actions._Actions__checkBan(), 1)
+		self.assertEqual(self.__actions.status()[0], ("Currently banned", 151))
+
+	def testActionExecutor(self):
+		executor = ActionExecutor('test', 1)
+		# record waits of the worker (idle worker blocks without polling):
+		waits = []
+		wait = executor._cond.wait
+		def _wait(timeout=None):
+			if threading.current_thread().name.startswith('f2b/a.test'):
+				waits.append(timeout)
+			return wait(timeout)
+		executor._cond.wait = _wait
+		ev = threading.Event()
+		order = []
+		executor.put('a', 1, ev.wait)
+		executor.put('a', 1, lambda: order.append('a1'))
+		executor.put('b', 0, lambda: order.append('b1'))
+		executor.put('b', 0, lambda: order.append('b2'))
+		self.assertEqual(len(executor), 4)
+		ev.set()
+		self.assertTrue(executor.wait_empty(5))
+		# lower priority value first, order within the queue of action preserved:
+		self.assertEqual(order, ['b1', 'b2', 'a1'])
+		self.assertEqual(len(executor), 0)
+		self.assertTrue(Utils.wait_for(lambda: waits, 5))
+		# woken up by new task:
+		executor.put('a', 1, lambda: order.append('a2'))
+		self.assertTrue(Utils.wait_for(lambda: order[-1:] == ['a2'], 5))
+		executor.stop()
+		self.assertEqual(set(waits), set([None]))
+		self.assertTrue(Utils.wait_for(lambda: not executor._workers, 5))
+
+	def testBanLatencyConcurrent(self):
+		# latency statistic updated by many threads of executor - no lost updates:
+		bansDone = self.__actions._Actions__bansDone
+		tm = MyTime.time()
+		bans = [(FailTicket("192.0.2.1", tm - 1), None) for i in xrange(2000)]
+		ths = [threading.Thread(target=bansDone, args=(bans,)) for i in xrange(4)]
+		for th in ths:
+			th.start()
+		for th in ths:
+			th.join()
+		cnt, avg, tmax = dict(self.__actions.getStats())["Ban latency"]
+		self.assertEqual(cnt, 8000)
+		self.assertTrue(tmax >= 1)
+
+	def testActionThreads(self):
+		self.assertEqual(self.__actions.getActionThreads(), 0)
+		self.assertRaises(ValueError, self.__actions.setActionThreads, -1)
+		self.__actions.add('mail')
+		self.__actions['mail'].actionban = 'sleep 0.5; echo mail ban <ip> >> "%s"' % self.__tmpfilename
+		self.__actions['mail'].actionunban = 'echo mail unban <ip> >> "%s"' % self.__tmpfilename
+		# firewall action (the tool is found in command):
+		self.__actions.add('fw')
+		self.__actions['fw'].actionban = 'echo ipset ban <ip> >> "%s"' % self.__tmpfilename
+		self.__actions['fw'].actionunban = 'echo ipset unban <ip> >> "%s"' % self.__tmpfilename
+		self.__actions.setActionThreads(2)
+		self.assertEqual(self.__actions.getActionThreads(), 2)
+		self.__jail.putFailTicket(FailTicket("192.0.2.1", MyTime.time()))
+		# doesn't wait for actions:
+		stime = time.time()
+		self.assertEqual(self.__actions._Actions__checkBan(), 1)
+		self.assertTrue(time.time() - stime < 0.5)
+		self.__actions.removeBannedIP("192.0.2.1")
+		with open(self.__tmpfilename) as f:
+			self.assertTrue(Utils.wait_for(lambda: f.seek(0) or len(f.read().splitlines()) >= 4, 5))
+			f.seek(0)
+			out = f.read().splitlines()
+		# firewall is not delayed by slow mail action, order of ban/unban preserved per action:
+		self.assertEqual(out, ["ipset ban 192.0.2.1", "ipset unban 192.0.2.1", 
+			"mail ban 192.0.2.1", "mail unban 192.0.2.1"])
+		self.assertTrue(Utils.wait_for(
+			lambda: dict(self.__actions.getStats())["Queued tasks"] == 0, 5))
+		self.assertEqual(dict(self.__actions.getStats())["Ban latency"][0], 1)
+		self.__actions.setActionThreads(0)
+		self.assertEqual(self.__actions.getActionThreads(), 0)
@@ -26,11 +26,14 @@ __license__ = "GPL"
 
 import os
 import tempfile
+import threading
 import time
 import unittest
 
-from ..server.action import CommandAction, CallingMap
+from ..server.action import CommandAction, CallingMap, BanInfo, CmdLock
 from ..server.actions import OrderedDict
+from ..server.ipdns import IPAddr
+from ..server.mytime import MyTime
 from ..server.utils import Utils
 
 from .utils import LogCaptureTestCase
@@ -196,6 +199,35 @@ class CommandActionTest(LogCaptureTestCase):
 			self.__action.replaceTag("abc",
 				CallingMap(matches=lambda: int("a"))), "abc")
 
+	def testCommandTemplate(self):
+		self.__action.actionban = "ban <ip> <F-USER> '<matches>' <STDIN> <sp>[<family>]"
+		self.__action.family = "inet4"
+		self.__action.family6 = "inet6"
+		setattr(self.__action, 'family?family=inet6', "<family6>")
+		tpl = self.__action._compileCmd('<actionban>', 'family=inet4')
+		# static tags replaced once, template cached:
+		self.assertEqual(tpl.cmd, "ban <ip> <F-USER> '<matches>' <STDIN>  [inet4]")
+		self.assertIs(self.__action._compileCmd('<actionban>', 'family=inet4'), tpl)
+		tpl6 = self.__action._compileCmd('<actionban>', 'family=inet6')
+		self.assertEqual(tpl6.cmd, "ban <ip> <F-USER> '<matches>' <STDIN>  [inet6]")
+		# render - escape only the values of escaped tags, missing tags unchanged,
+		# callables called only for the tags of command:
+		aInfo = CallingMap(ip='192.0.2.1', matches=lambda: "a;b", failures=lambda: int("a"))
+		self.assertEqual(tpl.render(aInfo),
+			"ban 192.0.2.1 <F-USER> 'a\\;b' <STDIN>  [inet4]")
+		aInfo['ip?family=inet6'] = '2001:db8::'
+		self.assertEqual(tpl6.render(aInfo),
+			"ban 2001:db8:: <F-USER> 'a\\;b' <STDIN>  [inet6]")
+		# embedded tags in (not escaped) values - fallback to recursive substitution:
+		del aInfo['failures']
+		aInfo['F-USER'] = '<ip>'
+		self.assertEqual(tpl.render(aInfo), None)
+		self.__action.actionban = "echo ban <F-USER> '<matches>'"
+		self.__action.ban(aInfo)
+		self.assertLogged("echo ban 192.0.2.1 'a\\;b'")
+		# parameter change resets the templates:
+		self.assertIsNot(self.__action._compileCmd('<actionban>', 'family=inet4'), tpl)
+
 	def testReplaceTagConditionalCached(self):
 		setattr(self.__action, 'abc', "123")
 		setattr(self.__action, 'abc?family=inet4', "345")
@@ -257,6 +289,66 @@ class CommandActionTest(LogCaptureTestCase):
 		self.assertLogged('Invariant check failed')
 		self.assertLogged('returned successfully')
 
+	def testExecuteActionBanMany(self):
+		self.__action.actionban = "echo -n ban <ip>"
+		self.__action.actionunban = "echo -n unban <ip>"
+		aInfos = [{'ip': IPAddr(ip)} for ip in ('192.0.2.1', '2001:db8::1', '192.0.2.2')]
+		# not supported - no batch commands:
+		self.assertFalse(self.__action.ban_many(aInfos))
+		self.assertFalse(self.__action.unban_many(aInfos))
+		self.assertNotLogged('returned')
+		# batch - one command per family:
+		self.__action.actionban_batch = "echo -n ban-batch <ips>"
+		self.__action.actionunban_batch = "echo -n unban-batch <ips>"
+		self.assertTrue(self.__action.ban_many(aInfos))
+		self.assertLogged('echo -n ban-batch 192.0.2.1 192.0.2.2', 
+			'echo -n ban-batch 2001:db8::1', all=True)
+		self.assertNotLogged('echo -n ban 192.0.2.1')
+		self.assertTrue(self.__action.unban_many(aInfos))
+		self.assertLogged('echo -n unban-batch 192.0.2.1 192.0.2.2')
+		# failed:
+		self.__action.actionban_batch = "false <ips>"
+		self.assertRaises(RuntimeError, self.__action.ban_many, aInfos)
+
+	def testCmdLock(self):
+		# resources by firewall tools used in command:
+		names = lambda cmd: [l.name for l in CmdLock.forCommand(cmd)]
+		self.assertEqual(names("iptables -w -I f2b-j -s 192.0.2.1 -j DROP"), ["iptables"])
+		self.assertEqual(names("printf 'add f2b-j %s\\n' 192.0.2.1 | ipset -exist restore"), ["ipset"])
+		self.assertEqual(names("ipset add f2b-j 192.0.2.1; /sbin/iptables-restore -n < f"), ["ipset", "iptables"])
+		self.assertEqual(names("echo iptablesx ipset-like; sendmail -t"), [])
+		# lock of the action:
+		self.assertEqual(self.__action._locks, None)
+		self.__action.lock = "none"
+		self.assertEqual(self.__action._locks, [])
+		self.__action.lock = "test-res2 test-res1"
+		self.__action.concurrency = 2
+		self.assertEqual([(l.name, l.limit) for l in self.__action._locks], 
+			[("test-res1", 2), ("test-res2", 2)])
+		self.assertTrue(self.__action.executeCmd("true", locks=self.__action._locks))
+		# limit is a property of resource - other action (last configured) does not overwrite it:
+		action2 = CommandAction(None, "Test2")
+		action2.lock = "test-res1"
+		action2.concurrency = 5
+		self.assertEqual([(l.name, l.limit) for l in action2._locks], [("test-res1", 2)])
+		self.assertLogged("Concurrency 5 for resource 'test-res1' ignored, it is already limited to 2")
+		self.assertEqual(CmdLock.get("test-res1").limit, 2)
+		# lock found by command (default limit) gets configured limit:
+		self.assertEqual(CmdLock.get("test-res4").limit, 1)
+		self.assertEqual(CmdLock.get("test-res4", 3).limit, 3)
+		# wait statistic:
+		lock = CmdLock.get("test-res3")
+		lock.acquire()
+		th = threading.Thread(target=CommandAction.executeCmd, args=("true",), kwargs={"locks": [lock]})
+		th.start()
+		time.sleep(0.1)
+		lock.release()
+		th.join()
+		self.assertEqual(lock.count, 2)
+		self.assertEqual(lock.waits, 1)
+		self.assertTrue(lock.maxWaitTime > 0)
+		self.assertIn(("test-res3", 1, 2, 1), [s[:4] for s in CmdLock.getStats()])
+
 	def testExecuteActionEmptyUnban(self):
 		self.__action.actionunban = ""
 		self.__action.unban({})
@@ -295,6 +387,46 @@ class CommandActionTest(LogCaptureTestCase):
 			"echo 'repair ...'", 
 			"Unable to restore environment", all=True)
 
+	def testExecuteActionCheckCached(self):
+		tmp = tempfile.mktemp()
+		try:
+			self.__action.actioncheck = "echo check >> '%s'" % tmp
+			self.__action.actionban = "[ ! -e '%s.fail' ]" % tmp
+			self.__action.actioncheck_interval = '10m'
+			self.assertEqual(self.__action.actioncheck_interval, '600')
+			def checkCount():
+				with open(tmp) as f:
+					return len(f.read().splitlines())
+			MyTime.setTime(1000)
+			# check executed once, cached for all next commands:
+			for i in xrange(5):
+				self.__action.ban({'ip': None})
+			self.assertEqual(checkCount(), 1)
+			# cache expired:
+			MyTime.setTime(1000 + 601)
+			self.__action.ban({'ip': None})
+			self.assertEqual(checkCount(), 2)
+			# failed command invalidates cache (not retried here, no check after failure):
+			open(tmp + '.fail', 'w').close()
+			self.assertRaises(RuntimeError, self.__action.ban, {'ip': None})
+			self.assertEqual(checkCount(), 2)
+			os.remove(tmp + '.fail')
+			# next command checks again:
+			self.__action.ban({'ip': None})
+			self.assertEqual(checkCount(), 3)
+			self.__action.ban({'ip': None})
+			self.assertEqual(checkCount(), 3)
+			# restart (or parameter change) invalidates cache:
+			self.__action.stop()
+			self.__action.start()
+			self.__action.ban({'ip': None})
+			self.assertEqual(checkCount(), 4)
+		finally:
+			MyTime.setTime(None)
+			for f in (tmp, tmp + '.fail'):
+				if os.path.exists(f):
+					os.remove(f)
+
 	def testExecuteActionChangeCtags(self):
 		self.assertRaises(AttributeError, getattr, self.__action, "ROST")
 		self.__action.ROST = "192.0.2.0"
@@ -412,3 +544,29 @@ class CommandActionTest(LogCaptureTestCase):
 			"10 okay string 17")
 		# Error will now trip, demonstrating delayed call
 		self.assertRaises(ValueError, lambda x: "%(error)i" % x, mymap)
+
+	def testBanInfo(self):
+		calls = []
+		def matches():
+			calls.append(1)
+			return "line1\nline2"
+		info = BanInfo(ip='192.0.2.1', matches=matches, error=lambda: int('a'))
+		# lazy, evaluated only once:
+		self.assertEqual(calls, [])
+		self.assertEqual(info['matches'], "line1\nline2")
+		self.assertEqual(info.get('matches'), "line1\nline2")
+		self.assertEqual(calls, [1])
+		self.assertRaises(ValueError, info.__getitem__, 'error')
+		# immutable:
+		self.assertRaises(TypeError, info.__setitem__, 'ip', '192.0.2.2')
+		self.assertRaises(TypeError, info.__delitem__, 'ip')
+		self.assertEqual(info['ip'], '192.0.2.1')
+		# copy is mutable and contains already evaluated values:
+		info2 = info.copy()
+		self.assertTrue(isinstance(info2, CallingMap))
+		self.assertFalse(isinstance(info2, BanInfo))
+		del info2['ip']
+		info2['ip'] = '192.0.2.2'
+		self.assertEqual(info2['matches'], "line1\nline2")
+		self.assertEqual(calls, [1])
+		self.assertEqual((info['ip'], info2['ip']), ('192.0.2.1', '192.0.2.2'))
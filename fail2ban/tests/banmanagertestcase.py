@@ -24,11 +24,13 @@ __author__ = "Cyril Jaquier"
 __copyright__ = "Copyright (c) 2004 Cyril Jaquier"
 __license__ = "GPL"
 
+import threading
 import unittest
 
 from .utils import setUpMyTime, tearDownMyTime
 
-from ..server.banmanager import BanManager
+from ..server.banmanager import BanManager, CymruInfo
+from ..server.utils import Utils
 from ..server.ticket import BanTicket
 
 class AddFailure(unittest.TestCase):
@@ -140,6 +142,31 @@ class AddFailure(unittest.TestCase):
 		self.assertEqual(len(self.__banManager.unBanList(stime + btime + 5*10 + 1)), 3)
 		self.assertEqual(self.__banManager.size(), 0)
 
+	def testUnbanLazyHeap(self):
+		btime = self.__banManager.getBanTime()
+		stime = self.__ticket.getTime()
+		tickets = []
+		for i in range(10):
+			ticket = BanTicket('192.0.2.%s' % i, stime + i)
+			self.assertTrue(self.__banManager.addBanTicket(ticket))
+			tickets.append(ticket)
+		# prolong ban time of stored ticket (as observer does it after ban):
+		tickets[0].setBanTime(btime + 100)
+		# remove one ticket manually (entry in heap gets obsolete):
+		self.assertEqual(self.__banManager.getTicketByID('192.0.2.1'), tickets[1])
+		# first 5 expired, but 0 was prolonged and 1 removed:
+		lst = self.__banManager.unBanList(stime + btime + 5)
+		self.assertEqual(sorted(str(t.getIP()) for t in lst), 
+			['192.0.2.2', '192.0.2.3', '192.0.2.4'])
+		self.assertEqual(self.__banManager.size(), 6)
+		# increase default ban time - affects all tickets without own ban time:
+		self.__banManager.setBanTime(btime + 200)
+		self.assertEqual(self.__banManager.unBanList(stime + btime + 50), [])
+		lst = self.__banManager.unBanList(stime + btime + 101)
+		self.assertEqual([str(t.getIP()) for t in lst], ['192.0.2.0'])
+		self.assertEqual(len(self.__banManager.unBanList(stime + btime + 300)), 5)
+		self.assertEqual(self.__banManager.size(), 0)
+
 	def testUnbanPermanent(self):
 		btime = self.__banManager.getBanTime()
 		self.__banManager.setBanTime(-1)
@@ -152,6 +179,90 @@ class AddFailure(unittest.TestCase):
 			self.__banManager.setBanTime(btime)
 
 
+class _FakeCymruInfo(CymruInfo):
+	"""Cymru info without DNS (answers from the first and second octet of IPv4)"""
+
+	def __init__(self, *args, **kwargs):
+		CymruInfo.__init__(self, *args, **kwargs)
+		self.queries = []
+		self.block = threading.Event()
+		self.block.set()
+
+	def init(self, timeout=10):
+		self.resolver = True
+
+	def query(self, ip):
+		self.queries.append(str(ip))
+		self.block.wait()
+		octets = str(ip).split('.')
+		if octets[0] == '0':
+			return [("nxdomain", "nxdomain", "nxdomain")]
+		if octets[0] == '1':
+			raise ValueError("No data retrieved")
+		return [(octets[0], "C" + octets[1], "rir")]
+
+
+class CymruInfoCache(unittest.TestCase):
+	def setUp(self):
+		"""Call before every test case."""
+		setUpMyTime()
+		self.__banManager = BanManager()
+		self.__banManager.cymru = self.cymru = _FakeCymruInfo(threads=4)
+
+	def tearDown(self):
+		"""Call after every test case."""
+		self.cymru.block.set()
+		tearDownMyTime()
+
+	def _ban(self, *ips):
+		for ip in ips:
+			self.assertTrue(self.__banManager.addBanTicket(BanTicket(ip, 1167605999.0)))
+
+	def testCachedPerPrefix(self):
+		self._ban("20.1.0.1", "20.1.0.2", "20.1.0.3", "30.2.0.1", "0.0.0.1")
+		cymru_info = self.__banManager.getBanListExtendedCymruInfo()
+		self.assertDictEqual(dict((k, sorted(v)) for k, v in cymru_info.iteritems()),
+			{"asn": sorted(["20", "20", "20", "30", "nxdomain"]),
+			 "country": sorted(["C1", "C1", "C1", "C2", "nxdomain"]),
+			 "rir": sorted(["rir", "rir", "rir", "rir", "nxdomain"])})
+		# one query per prefix:
+		self.assertEqual(len(self.cymru.queries), 3)
+		# repeated call served from cache:
+		self.__banManager.getBanListExtendedCymruInfo()
+		self.assertEqual(len(self.cymru.queries), 3)
+		# same network (/24) is not queried again:
+		self._ban("20.1.0.4")
+		self.assertEqual(len(self.__banManager.getBanListExtendedCymruInfo()["asn"]), 6)
+		self.assertEqual(len(self.cymru.queries), 3)
+
+	def testErrorNotCached(self):
+		self._ban("1.0.0.1")
+		cymru_info = self.__banManager.getBanListExtendedCymruInfo()
+		self.assertEqual(cymru_info["asn"], ["error"])
+		self.assertIn("No data retrieved", cymru_info["error"])
+		# repeated:
+		self.__banManager.getBanListExtendedCymruInfo()
+		self.assertEqual(len(self.cymru.queries), 2)
+
+	def testBackground(self):
+		self.cymru.block.clear()
+		self._ban(*("40.%d.0.1" % i for i in xrange(10)))
+		# doesn't wait - all entries pending:
+		cymru_info = self.__banManager.getBanListExtendedCymruInfo(wait=0)
+		self.assertEqual(cymru_info["asn"], ["pending"] * 10)
+		# bounded pool - queries in progress:
+		self.assertTrue(Utils.wait_for(lambda: len(self.cymru.queries) == 4, 5))
+		self.assertEqual(self.cymru._workers, 4)
+		# new banned IPs are resolved in background (after extended status was once requested):
+		self._ban("50.0.0.1")
+		self.cymru.block.set()
+		self.assertTrue(Utils.wait_for(lambda: not self.cymru._pending, 5))
+		self.assertEqual(len(self.cymru.queries), 11)
+		cymru_info = self.__banManager.getBanListExtendedCymruInfo(wait=0)
+		self.assertEqual(sorted(cymru_info["asn"]), ["40"] * 10 + ["50"])
+		self.assertTrue(Utils.wait_for(lambda: not self.cymru._workers, 5))
+
+
 class StatusExtendedCymruInfo(unittest.TestCase):
 	def setUp(self):
 		"""Call before every test case."""
@@ -135,6 +135,31 @@ class AddFailure(unittest.TestCase):
 		self.__failManager.cleanup(timestamp)
 		self.assertEqual(self.__failManager.size(), 2)
 	
+	def testCleanupExpiry(self):
+		self.__failManager.setMaxTime(100)
+		for i in xrange(10):
+			self.__failManager.addFailure(FailTicket('192.0.2.%s' % i, 1000 + i * 10))
+		# newer failure for .0 prolongs its life (last time is changed):
+		self.__failManager.addFailure(FailTicket('192.0.2.0', 1050))
+		self.__failManager.delFailure('192.0.2.1')
+		# nothing expired:
+		self.__failManager.cleanup(1099)
+		self.assertEqual(self.__failManager.size(), 9)
+		# .2 - .4 expired, .0 is still alive:
+		self.__failManager.cleanup(1140)
+		self.assertEqual(self.__failManager.size(), 6)
+		self.__failManager.setMaxRetry(2)
+		self.assertEqual(self.__failManager.toBan('192.0.2.0').getIP(), '192.0.2.0')
+		# all expired:
+		self.__failManager.cleanup(1190)
+		self.assertEqual(self.__failManager.size(), 0)
+		# ticket added again after expiration:
+		self.__failManager.addFailure(FailTicket('192.0.2.0', 1200))
+		self.__failManager.cleanup(1250)
+		self.assertEqual(self.__failManager.size(), 1)
+		self.__failManager.cleanup(1300)
+		self.assertEqual(self.__failManager.size(), 0)
+
 	def testbanOK(self):
 		self._addDefItems()
 		self.__failManager.setMaxRetry(5)
@@ -162,6 +187,147 @@ class AddFailure(unittest.TestCase):
 			str(ticket),
 			'FailTicket: ip=193.168.0.128 time=1000002000.0 bantime=None bancount=0 #attempts=5 matches=[]')
 	
+	def testbanReadyQueue(self):
+		self._addDefItems()
+		self.__failManager.setMaxRetry(5)
+		# the only one reached max retry:
+		self.assertEqual(self.__failManager.toBan().getIP(), "193.168.0.128")
+		self.assertRaises(FailManagerEmpty, self.__failManager.toBan)
+		# decrease max retry - ready queue rebuilt:
+		self.__failManager.setMaxRetry(3)
+		self.assertEqual(self.__failManager.toBan().getIP(), "87.142.124.10")
+		self.assertRaises(FailManagerEmpty, self.__failManager.toBan)
+		# queued, but removed hereafter - should be skipped:
+		for i in xrange(3):
+			self.__failManager.addFailure(FailTicket('192.0.2.1', 1167605999.0))
+			self.__failManager.addFailure(FailTicket('192.0.2.2', 1167605999.0))
+		self.__failManager.delFailure('192.0.2.1')
+		self.assertEqual(self.__failManager.toBan().getIP(), "192.0.2.2")
+		self.assertRaises(FailManagerEmpty, self.__failManager.toBan)
+		self.assertEqual(self.__failManager.size(), 1)
+
+	def testMaxCountEvict(self):
+		fm = self.__failManager
+		fm.setMaxRetry(3)
+		self.assertRaises(ValueError, fm.setMaxCount, -1)
+		self.assertRaises(ValueError, fm.setEvictPolicy, 'unknown')
+		fm.setMaxCount(3)
+		manFailList = fm._FailManager__failList
+		self.assertEqual(fm.getMaxCount(), 3)
+		self.assertEqual(fm.getEvictPolicy(), 'retry')
+		t = 1167605999.0
+		# repeat offender reached max retry - never evicted:
+		for i in xrange(3):
+			fm.addFailure(FailTicket('192.0.2.1', t))
+		fm.addFailure(FailTicket('192.0.2.2', t))
+		fm.addFailure(FailTicket('192.0.2.2', t + 1))
+		fm.addFailure(FailTicket('192.0.2.3', t + 2))
+		self.assertEqual(fm.size(), 3)
+		# lowest retry count evicted (192.0.2.3):
+		fm.addFailure(FailTicket('192.0.2.4', t + 3))
+		self.assertEqual(fm.size(), 3)
+		self.assertEqual(fm.getEvictTotal(), 1)
+		self.assertNotIn('192.0.2.3', manFailList)
+		# flood of unique addresses - memory is bounded, offender still banned:
+		for i in xrange(100):
+			fm.addFailure(FailTicket('198.51.100.%d' % i, t + 4))
+		self.assertEqual(fm.size(), 3)
+		self.assertEqual(fm.getEvictTotal(), 101)
+		self.assertEqual(fm.toBan().getIP(), '192.0.2.1')
+		# policy oldest - the entry with oldest last time evicted (192.0.2.2, although retry 2):
+		fm.setEvictPolicy('oldest')
+		fm.addFailure(FailTicket('198.51.100.1', t + 5))
+		fm.addFailure(FailTicket('203.0.113.1', t + 6))
+		self.assertEqual(fm.size(), 3)
+		self.assertNotIn('192.0.2.2', manFailList)
+		self.assertEqual(fm.getEvictTotal(), 102)
+		# unlimited:
+		fm.setMaxCount(0)
+		for i in xrange(10):
+			fm.addFailure(FailTicket('198.51.100.%d' % i, t + 7))
+		self.assertEqual(fm.getEvictTotal(), 102)
+		self.assertTrue(fm.size() > 3)
+
+	def testCountModeSketch(self):
+		fm = self.__failManager
+		self.assertRaises(ValueError, fm.setCountMode, 'unknown')
+		self.assertEqual(fm.getCountMode(), 'exact')
+		fm.setMaxTime(600)
+		fm.setMaxRetry(10)
+		fm.setCountMode('sketch')
+		self.assertEqual(fm.getCountMode(), 'sketch')
+		t = 1167605999.0
+		# flood of unique addresses - counted in sketch only, no tickets:
+		for i in xrange(300):
+			fm.addFailure(FailTicket('198.51.%d.%d' % (i // 256, i % 256), t))
+		self.assertEqual(fm.size(), 0)
+		self.assertEqual(fm.getFailTotal(), 300)
+		# repeat offender - ticket materialized as estimate nears max retry:
+		for i in xrange(7):
+			self.assertEqual(fm.addFailure(FailTicket('192.0.2.1', t + i)), i + 1)
+		self.assertEqual(fm.size(), 0)
+		fm.addFailure(FailTicket('192.0.2.1', t + 7))
+		self.assertEqual(fm.size(), 1)
+		self.assertRaises(FailManagerEmpty, fm.toBan)
+		fm.addFailure(FailTicket('192.0.2.1', t + 8))
+		fm.addFailure(FailTicket('192.0.2.1', t + 9))
+		ticket = fm.toBan()
+		self.assertEqual(ticket.getIP(), '192.0.2.1')
+		self.assertEqual(ticket.getRetry(), 10)
+		# failures after ban - counted from scratch (materialized count removed from sketch):
+		for i in xrange(7):
+			self.assertEqual(fm.addFailure(FailTicket('192.0.2.1', t + 10 + i)), i + 1)
+		self.assertEqual(fm.size(), 0)
+		self.assertEqual(fm.addFailure(FailTicket('192.0.2.1', t + 17)), 8)
+		self.assertEqual(fm.size(), 1)
+		self.assertRaises(FailManagerEmpty, fm.toBan)
+		fm.addFailure(FailTicket('192.0.2.1', t + 18))
+		fm.addFailure(FailTicket('192.0.2.1', t + 19))
+		self.assertEqual(fm.toBan().getRetry(), 10)
+		# decay - old failures forgotten after find time:
+		for i in xrange(5):
+			fm.addFailure(FailTicket('192.0.2.2', t + i))
+		self.assertEqual(fm.addFailure(FailTicket('192.0.2.2', t + 1200)), 1)
+		# back to exact mode:
+		fm.setCountMode('exact')
+		fm.addFailure(FailTicket('192.0.2.3', t + 1200))
+		self.assertEqual(fm.size(), 1)
+
+	def testFailSketch(self):
+		sk = failmanager.FailSketch(600, width=64, depth=3)
+		t = 1000
+		# estimate is never less than real count (without removals):
+		for i in xrange(500):
+			sk.add('192.0.2.%d' % (i % 50), t)
+		for i in xrange(50):
+			self.assertTrue(sk.estimate('192.0.2.%d' % i) >= 10)
+		# rotation of generations (half of period), counts of previous still used:
+		sk.add('192.0.2.1', t + 300)
+		self.assertTrue(sk.estimate('192.0.2.1') >= 11)
+		# after whole period without failures - empty:
+		sk.add('192.0.2.1', t + 1000)
+		self.assertTrue(sk.estimate('192.0.2.1') >= 1)
+		self.assertTrue(sk.estimate('192.0.2.2') <= 1)
+		# remove (moved to ticket) - from both generations:
+		sk = failmanager.FailSketch(600, width=8192, depth=3)
+		for i in xrange(4):
+			sk.add('192.0.2.1', t)
+		for i in xrange(2):
+			sk.add('192.0.2.1', t + 300)
+		self.assertEqual(sk.estimate('192.0.2.1'), 6)
+		sk.remove('192.0.2.1', 5)
+		self.assertEqual(sk.estimate('192.0.2.1'), 1)
+		sk.remove('192.0.2.1', 5)
+		self.assertEqual(sk.estimate('192.0.2.1'), 0)
+		# removal undercounts colliding ids (here all ids share the single counter):
+		sk = failmanager.FailSketch(600, width=1, depth=2)
+		for i in xrange(3):
+			sk.add('192.0.2.1', t)
+		self.assertEqual(sk.add('192.0.2.2', t, 2), 5)
+		sk.remove('192.0.2.2', 5)
+		self.assertEqual(sk.estimate('192.0.2.1'), 0)
+		self.assertEqual(sk.add('192.0.2.1', t), 1)
+
 	def testbanNOK(self):
 		self._addDefItems()
 		self.__failManager.setMaxRetry(10)
@@ -29,6 +29,7 @@ import os
 import sys
 import time, datetime
 import tempfile
+import threading
 import uuid
 
 try:
@@ -40,7 +41,7 @@ from ..server.jail import Jail
 from ..server.filterpoll import FilterPoll
 from ..server.filter import Filter, FileFilter, FileContainer
 from ..server.failmanager import FailManagerEmpty
-from ..server.ipdns import DNSUtils, IPAddr
+from ..server.ipdns import DNSUtils, IPAddr, IPAddrSet
 from ..server.mytime import MyTime
 from ..server.utils import Utils, uni_decode
 from .utils import setUpMyTime, tearDownMyTime, mtimesleep, LogCaptureTestCase
@@ -355,6 +356,89 @@ class IgnoreIP(LogCaptureTestCase):
 		self.assertFalse(self.filter.inIgnoreIPList('192.168.1.255'))
 		self.assertFalse(self.filter.inIgnoreIPList('192.168.0.255'))
 
+	def testIgnoreIPLargeList(self):
+		# many networks with different prefix length (incl. nested and IPv6):
+		for i in xrange(256):
+			self.filter.addIgnoreIP('10.%d.0.0/16' % i)
+			self.filter.addIgnoreIP('172.16.%d.0/24' % i)
+			self.filter.addIgnoreIP('2001:db8:%x::/48' % i)
+		self.filter.addIgnoreIP('192.0.2.0/25')
+		self.filter.addIgnoreIP('192.0.2.200')
+		self.filter.addIgnoreIP('0.0.0.0/0')
+		self.assertTrue(self.filter.inIgnoreIPList('10.255.1.1'))
+		self.assertTrue(self.filter.inIgnoreIPList('172.16.100.254'))
+		self.assertTrue(self.filter.inIgnoreIPList('2001:db8:ff:1::1'))
+		self.assertFalse(self.filter.inIgnoreIPList('2001:db8:100::1'))
+		self.assertTrue(self.filter.inIgnoreIPList('192.0.2.127'))
+		self.assertTrue(self.filter.inIgnoreIPList('192.0.2.200'))
+		# covered by 0.0.0.0/0 only, remove it:
+		self.assertTrue(self.filter.inIgnoreIPList('192.0.2.201'))
+		self.filter.delIgnoreIP('0.0.0.0/0')
+		self.assertFalse(self.filter.inIgnoreIPList('192.0.2.201'))
+		self.assertFalse(self.filter.inIgnoreIPList('192.0.2.128'))
+		self.assertFalse(self.filter.inIgnoreIPList('172.17.0.1'))
+		self.assertTrue(self.filter.inIgnoreIPList('10.0.0.1'))
+		self.assertEqual(len(self.filter.getIgnoreIP()), 256 * 3 + 2)
+		# added twice - remains ignored up to removal of last one:
+		self.filter.addIgnoreIP('192.0.2.201')
+		self.filter.addIgnoreIP('192.0.2.201')
+		self.filter.delIgnoreIP('192.0.2.201')
+		self.assertTrue(self.filter.inIgnoreIPList('192.0.2.201'))
+		self.filter.delIgnoreIP('192.0.2.201')
+		self.assertFalse(self.filter.inIgnoreIPList('192.0.2.201'))
+		self.assertTrue(self.filter.inIgnoreIPList('192.0.2.200'))
+		# clear all:
+		self.filter.delIgnoreIP()
+		self.assertFalse(self.filter.inIgnoreIPList('10.0.0.1'))
+
+	def testIgnoreIPSetDNS(self):
+		# precache dns (no network needed):
+		DNSUtils.CACHE_nameToIp.set('ignore.f2b-test.invalid', [IPAddr('192.0.2.7')])
+		ipSet = IPAddrSet(dnsRefresh=3600)
+		ipSet.add('ignore.f2b-test.invalid')
+		ipSet.refreshDNS(wait=True)
+		self.assertEqual(ipSet.find('192.0.2.7'), 'dns')
+		self.assertEqual(ipSet.find('192.0.2.8'), None)
+		# refresh in background (address changed):
+		DNSUtils.CACHE_nameToIp.set('ignore.f2b-test.invalid', [IPAddr('192.0.2.8')])
+		ipSet.refreshDNS(wait=True)
+		self.assertNotIn('192.0.2.7', ipSet)
+		self.assertIn('192.0.2.8', ipSet)
+		self.assertEqual(len(ipSet), 1)
+		ipSet.remove('ignore.f2b-test.invalid')
+		self.assertNotIn('192.0.2.8', ipSet)
+		self.assertEqual(len(ipSet), 0)
+
+	def testIgnoreIPSetDNSInBackground(self):
+		# resolving hangs up to release:
+		resolving, resolve = threading.Event(), threading.Event()
+		dnsToIp = DNSUtils.dnsToIp
+		def _dnsToIp(dns):
+			resolving.set()
+			resolve.wait(5)
+			return [IPAddr('192.0.2.9')]
+		DNSUtils.dnsToIp = staticmethod(_dnsToIp)
+		try:
+			ipSet = IPAddrSet(dnsRefresh=3600)
+			# adding does not wait for resolving, the name matches nothing yet:
+			ipSet.add('wait.f2b-test.invalid')
+			th = ipSet._dnsThread
+			self.assertTrue(resolving.wait(5))
+			self.assertTrue(th is not None and th.is_alive())
+			self.assertNotIn('192.0.2.9', ipSet)
+			# clear keeps handle of running refresh (no second thread started):
+			ipSet.clear()
+			ipSet.add('next.f2b-test.invalid')
+			self.assertIs(ipSet._dnsThread, th)
+			resolve.set()
+			ipSet.refreshDNS(wait=True)
+			self.assertTrue(Utils.wait_for(lambda: ipSet._dnsThread is None, 5))
+			# name added during refresh is resolved by the same thread, cleared one is gone:
+			self.assertEqual(ipSet._dns, {'next.f2b-test.invalid': set([IPAddr('192.0.2.9')])})
+			self.assertIn('192.0.2.9', ipSet)
+		finally:
+			DNSUtils.dnsToIp = staticmethod(dnsToIp)
+
 	def testWrongIPMask(self):
 		self.filter.addIgnoreIP('192.168.1.0/255.255.0.0')
 		self.assertRaises(ValueError, self.filter.addIgnoreIP, '192.168.1.0/255.255.0.128')
@@ -378,6 +462,52 @@ class IgnoreIP(LogCaptureTestCase):
 		self.assertTrue(self.filter.inIgnoreIPList("10.0.0.1"))
 		self.assertFalse(self.filter.inIgnoreIPList("10.0.0.0"))
 
+	def testIgnoreCommandCache(self):
+		self.filter.setIgnoreCommand(sys.executable + ' ' + os.path.join(TEST_FILES_DIR, "ignorecommand.py <ip>"))
+		self.filter.setIgnoreCache('maxcount', '10')
+		self.filter.setIgnoreCache('maxtime', '5m')
+		self.filter.setIgnoreCache('negtime', '1m')
+		self.assertEqual(self.filter.getIgnoreCache('maxtime'), 300)
+		self.assertRaises(ValueError, self.filter.setIgnoreCache, 'unknown', '1')
+		for i in xrange(3):
+			self.assertTrue(self.filter.inIgnoreIPList("10.0.0.1"))
+			self.assertFalse(self.filter.inIgnoreIPList("10.0.0.0"))
+		# command executed once per IP, other verdicts from cache:
+		self.assertEqual(len(self.getLog().split('ignore command: ')), 3)
+		self.assertEqual(self.filter.getIgnoreCacheStats(), (4, 2))
+		self.assertIn(("Ignore cache hits", 4), self.filter.status())
+		# counters updated by many threads - no lost updates:
+		verdict = self.filter._ignoreCommandVerdict
+		def _verdicts():
+			for i in xrange(2000):
+				verdict("10.0.0.1", False)
+				verdict("10.0.0.2", False)
+		ths = [threading.Thread(target=_verdicts) for i in xrange(4)]
+		for th in ths:
+			th.start()
+		for th in ths:
+			th.join()
+		self.assertEqual(self.filter.getIgnoreCacheStats(), (4 + 8000, 2 + 8000))
+
+	def testIgnoreCommandAsync(self):
+		self.filter.setIgnoreCommand(sys.executable + ' ' + os.path.join(TEST_FILES_DIR, "ignorecommand.py <ip>"))
+		self.filter.setIgnoreCache('maxcount', '10')
+		self.filter.setIgnoreCache('async', 'true')
+		self.filter.setMaxRetry(3)
+		self.filter.addFailRegex('<HOST>')
+		setUpMyTime()
+		try:
+			for i in xrange(3):
+				self.filter.processLineAndAdd('1387203300.222 10.0.0.1')
+				self.filter.processLineAndAdd('1387203300.222 10.0.0.0')
+		finally:
+			tearDownMyTime()
+		# failures are deferred, worker adds not ignored and bans:
+		self.assertTrue(Utils.wait_for(lambda: len(self.jail) == 1, 5))
+		self.assertEqual(self.jail.getFailTicket().getIP(), '10.0.0.0')
+		self.assertLogged('Ignore 10.0.0.1 by command')
+		self.assertEqual(self.filter.failManager.size(), 0)
+
 	def testIgnoreCauseOK(self):
 		ip = "93.184.216.34"
 		for ignore_source in ["dns", "ip", "command"]:
@@ -440,6 +570,71 @@ class IgnoreIPDNS(LogCaptureTestCase):
 
 
 
+class AsyncDNS(LogCaptureTestCase):
+
+	def setUp(self):
+		"""Call before every test case."""
+		LogCaptureTestCase.setUp(self)
+		self.jail = DummyJail()
+		self.filter = FileFilter(self.jail, useDns='yes')
+		self.filter.addFailRegex('failure from <HOST>$')
+		self.filter.setMaxRetry(2)
+		# fake resolver (no network), blocks until released:
+		self.released = threading.Event()
+		self.resolved = []
+		def _resolve(dns):
+			self.resolved.append(dns)
+			if dns.startswith('slow.'):
+				self.released.wait(5)
+			if dns.startswith('blackhole.'):
+				self.released.wait(5)
+				return ['192.0.2.99']
+			return {'host.f2b-test.invalid': ['192.0.2.10'], 
+				'slow.f2b-test.invalid': ['192.0.2.11', '2001:db8::11']}.get(dns, [])
+		self._resolve = DNSUtils.__dict__['resolve']
+		DNSUtils.resolve = staticmethod(_resolve)
+		DNSUtils.setResolverPool(2)
+		setUpMyTime()
+
+	def tearDown(self):
+		"""Call after every test case."""
+		tearDownMyTime()
+		self.released.set()
+		DNSUtils.setResolverPool(0)
+		DNSUtils.setResolveTimeout(None)
+		DNSUtils.resolve = self._resolve
+		for dns in ('host.f2b-test.invalid', 'slow.f2b-test.invalid', 'blackhole.f2b-test.invalid'):
+			DNSUtils.CACHE_nameToIp.unset(dns)
+		LogCaptureTestCase.tearDown(self)
+
+	def testParkedUntilResolved(self):
+		for i in xrange(2):
+			self.filter.processLineAndAdd('1387203300.222 failure from slow.f2b-test.invalid')
+		# reading of log doesn't wait, failures are parked:
+		self.assertEqual(self.filter.failManager.size(), 0)
+		self.assertEqual(len(self.jail), 0)
+		# resolved once (concurrent lookups of the same name):
+		self.released.set()
+		self.assertTrue(Utils.wait_for(lambda: len(self.jail) == 2, 5))
+		self.assertEqual(sorted(str(self.jail.getFailTicket().getIP()) for i in xrange(2)),
+			['192.0.2.11', '2001:db8::11'])
+		self.assertEqual(self.resolved, ['slow.f2b-test.invalid'])
+		# cached - no background lookup needed:
+		self.filter.processLineAndAdd('1387203300.222 failure from host.f2b-test.invalid')
+		self.assertTrue(Utils.wait_for(lambda: self.filter.failManager.size() == 1, 5))
+		self.filter.processLineAndAdd('1387203300.222 failure from host.f2b-test.invalid')
+		self.assertEqual(str(self.filter.failManager.toBan().getIP()), '192.0.2.10')
+
+	def testDeadline(self):
+		DNSUtils.setResolveTimeout(0.05)
+		self.filter.processLineAndAdd('1387203300.222 failure from blackhole.f2b-test.invalid')
+		self.assertTrue(Utils.wait_for(lambda: not len(DNSUtils.pool), 5))
+		self.assertLogged('Deadline exceeded by resolving of blackhole.f2b-test.invalid')
+		# negative cached:
+		self.assertEqual(DNSUtils.CACHE_nameToIp.get('blackhole.f2b-test.invalid'), [])
+		self.assertEqual(self.filter.failManager.size(), 0)
+
+
 class LogFile(LogCaptureTestCase):
 
 	MISSING = 'testcases/missingLogFile'
@@ -1508,6 +1703,48 @@ class DNSUtilsTests(unittest.TestCase):
 			c.set(i, 1)
 		self.assertEqual(len(c), 5)
 
+	def testCacheLRU(self):
+		c = Utils.Cache(maxCount=3, maxTime=60)
+		for i in xrange(3):
+			c.set(i, i)
+		# use 0 - 1 becomes least recently used and will be removed:
+		self.assertEqual(c.get(0), 0)
+		c.set(3, 3)
+		self.assertEqual(c.get(1), None)
+		self.assertEqual([c.get(i) for i in (0, 2, 3)], [0, 2, 3])
+		# overwrite doesn't remove other entries:
+		c.set(3, 4)
+		self.assertEqual(len(c), 3)
+		self.assertEqual(c.get(3), 4)
+		# per-entry time:
+		c.set(5, 5, maxTime=-1)
+		self.assertEqual(c.get(5), None)
+		c.unset(3)
+		self.assertEqual(c.get(3), None)
+		self.assertEqual(c.getStats(), (5, 3, 1))
+
+	def testIPAddr_FastConstructors(self):
+		for ipstr in ('192.0.2.1', '2001:db8::1', '::ffff:192.0.2.2', '2001:DB8:0::3'):
+			ip = (IPAddr.fromIPv4 if '.' in ipstr and ':' not in ipstr else IPAddr.fromIPv6)(ipstr)
+			IPAddr.CACHE_OBJ.unset((ipstr, IPAddr.CIDR_UNSPEC))
+			ip2 = IPAddr(ipstr)
+			self.assertEqual(ip, ip2)
+			self.assertEqual(ip.family, ip2.family)
+			self.assertEqual(ip.packed, ip2.packed)
+			self.assertEqual(ip.ntoa, ip2.ntoa)
+			self.assertEqual(hash(ip), hash(ip2))
+		self.assertTrue(IPAddr.fromIPv6('::ffff:192.0.2.2').isIPv4)
+		self.assertEqual(len(IPAddr.fromIPv6('2001:db8::1').packed), 16)
+		# invalid - falls back to default constructor:
+		self.assertFalse(IPAddr.fromIPv4('999.0.0.1').isValid)
+		self.assertFalse(IPAddr.fromIPv6('1:::2').isValid)
+		# precalculated network mask:
+		net = IPAddr('192.0.2.0/24')
+		self.assertEqual(net.mask, 0xFFFFFF00)
+		self.assertEqual(net.packed, '\xc0\x00\x02\x00')
+		self.assertTrue(IPAddr.fromIPv4('192.0.2.100').isInNet(net))
+		self.assertEqual(IPAddr('2001:db8::/32').mask, ((1 << 32) - 1) << 96)
+
 	def testCacheMaxTime(self):
 		# test max time (expired, timeout reached) :
 		c = Utils.Cache(maxCount=5, maxTime=0.0005)
@@ -427,16 +427,18 @@ class BanTimeIncrDB(unittest.TestCase):
 		for row in self.db.getBan(ip, overalljails=True):
 			self.assertEqual(row, (3, stime, 18000))
 			break
-		# test restoring bans from database:
+		# test restoring bans from database (in bulk, queued for actions):
 		jail1.restoreCurrentBans()
-		ticket = jail1.getFailTicket()
+		self.assertEqual(jail1.getFailTicket(), False)
+		self.assertEqual(len(jail1.actions._Actions__restored), 1)
+		ticket = jail1.actions._Actions__restored.popleft()
 		self.assertTrue(ticket.restored)
 		self.assertEqual(str(ticket), 
 			'FailTicket: ip=%s time=%s bantime=%s bancount=1 #attempts=0 matches=[]' % (ip, stime, 6000)
 		)
 		# jail2 does not restore any bans (because all ban tickets should be already expired: stime-6000):
 		jail2.restoreCurrentBans()
-		self.assertEqual(jail2.getFailTicket(), False)
+		self.assertEqual(len(jail2.actions._Actions__restored), 0)
 
 	def testObserver(self):
 		if Fail2BanDb is None: # pragma: no cover
@@ -34,7 +34,8 @@ import platform
 from ..server.failregex import Regex, FailRegex, RegexException
 from ..server import actions as _actions
 from ..server.server import Server
-from ..server.ipdns import IPAddr
+from ..server.action import CmdLock
+from ..server.ipdns import DNSUtils, IPAddr
 from ..server.jail import Jail
 from ..server.jailthread import JailThread
 from ..server.utils import Utils
@@ -223,6 +224,39 @@ class Transmitter(TransmitterBase):
 			os.close(tmp)
 			os.unlink(tmpFilename)
 
+	def testCacheOptions(self):
+		cache = IPAddr.CACHE_OBJ
+		maxCount, maxTime = cache.maxCount, cache.maxTime
+		try:
+			self.setGetTest("cache.ipaddr.maxcount", "10000", 10000)
+			self.setGetTest("cache.ipaddr.maxtime", "10m", 600)
+			self.setGetTestNOK("cache.ipaddr.maxcount", "0")
+			self.assertEqual(self.transm.proceed(["set", "cache.ipaddr.unknown", "1"])[0], 1)
+			self.assertEqual(self.transm.proceed(["get", "cache.unknown.maxcount"])[0], 1)
+			self.assertEqual(len(self.transm.proceed(["get", "cache.dnstoip.stats"])[1]), 3)
+		finally:
+			cache.setOptions(maxCount=maxCount, maxTime=maxTime)
+
+	def testDNSOptions(self):
+		try:
+			self.setGetTest("dns.timeout", "10", 10)
+			self.setGetTest("dns.threads", "2", 2)
+			self.assertEqual(DNSUtils.pool.timeout, 10)
+			self.setGetTest("dns.negtime", "1m", 60)
+			self.setGetTestNOK("dns.threads", "Duck")
+			self.assertEqual(self.transm.proceed(["set", "dns.unknown", "1"])[0], 1)
+		finally:
+			DNSUtils.setResolverPool(0)
+			DNSUtils.setResolveTimeout(None)
+			DNSUtils.CACHE_negTime = None
+
+	def testCmdLocks(self):
+		CmdLock.get("test-res").acquire()
+		CmdLock.get("test-res").release()
+		ret = self.transm.proceed(["get", "cmdlocks"])
+		self.assertEqual(ret[0], 0)
+		self.assertIn(("test-res", 1, 1, 0, 0, 0), ret[1])
+
 	def testAddJail(self):
 		jail2 = "TestJail2"
 		jail3 = "TestJail3"
@@ -344,6 +378,27 @@ class Transmitter(TransmitterBase):
 		self.setGetTest("maxretry", "-2", -2, jail=self.jailName)
 		self.setGetTestNOK("maxretry", "Duck", jail=self.jailName)
 
+	def testJailMaxFailures(self):
+		self.setGetTest("maxfailures", "1000", 1000, jail=self.jailName)
+		self.setGetTest("maxfailures", "0", 0, jail=self.jailName)
+		self.setGetTestNOK("maxfailures", "-1", jail=self.jailName)
+		self.setGetTestNOK("maxfailures", "Duck", jail=self.jailName)
+		self.setGetTest("evictpolicy", "oldest", "oldest", jail=self.jailName)
+		self.setGetTest("evictpolicy", "retry", "retry", jail=self.jailName)
+		self.setGetTestNOK("evictpolicy", "Duck", jail=self.jailName)
+		self.setGetTest("countmode", "sketch", "sketch", jail=self.jailName)
+		self.setGetTest("countmode", "exact", "exact", jail=self.jailName)
+		self.setGetTestNOK("countmode", "Duck", jail=self.jailName)
+
+	def testJailActionThreads(self):
+		self.setGetTest("actionthreads", "2", 2, jail=self.jailName)
+		self.setGetTestNOK("actionthreads", "-1", jail=self.jailName)
+		self.setGetTestNOK("actionthreads", "Duck", jail=self.jailName)
+		self.assertEqual(self.transm.proceed(["get", self.jailName, "actionstats"]),
+			(0, [("Ban latency", (0, 0, 0)), ("Queued tasks", 0),
+				("Retry queue", 0), ("Failures", (0, 0))]))
+		self.setGetTest("actionthreads", "0", 0, jail=self.jailName)
+
 	def testJailMaxLines(self):
 		self.setGetTest("maxlines", "5", 5, jail=self.jailName)
 		self.setGetTest("maxlines", "2", 2, jail=self.jailName)
@@ -446,6 +501,10 @@ class Transmitter(TransmitterBase):
 
 	def testJailIgnoreCommand(self):
 		self.setGetTest("ignorecommand", "bin ", jail=self.jailName)
+		self.setGetTest("ignorecache.maxcount", "100", 100, jail=self.jailName)
+		self.setGetTest("ignorecache.negtime", "2m", 120, jail=self.jailName)
+		self.setGetTest("ignorecache.async", "yes", True, jail=self.jailName)
+		self.setGetTestNOK("ignorecache.unknown", "1", jail=self.jailName)
 
 	def testJailRegex(self):
 		self.jailAddDelRegexTest("failregex",
@@ -686,7 +745,7 @@ class Transmitter(TransmitterBase):
 		self.assertEqual(
 			sorted(self.transm.proceed(["get", self.jailName, "actionmethods",
 				action])[1]),
-			['ban', 'start', 'stop', 'testmethod', 'unban'])
+			['ban', 'ban_many', 'start', 'stop', 'testmethod', 'unban', 'unban_many'])
 		self.assertEqual(
 			self.transm.proceed(["set", self.jailName, "action", action,
 				"testmethod", '{"text": "world!"}']),
@@ -1042,7 +1101,7 @@ class ServerConfigReaderTests(LogCaptureTestCase):
 		"""Call after every test case."""
 		super(ServerConfigReaderTests, self).tearDown()
 
-	def _executeCmd(self, realCmd, timeout=60):
+	def _executeCmd(self, realCmd, timeout=60, **kwargs):
 		for l in realCmd.split('\n'):
 			if not l.startswith('#'):
 				logSys.debug('exec-cmd: `%s`', l)
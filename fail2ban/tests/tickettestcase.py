@@ -192,3 +192,24 @@ class TicketTests(unittest.TestCase):
     t.setData({})
     self.assertEqual(t.getData(), {})
     self.assertEqual(t.getData('anything', 'default'), 'default')
+
+  def testTicketSlots(self):
+    # compact tickets - no instance dictionary:
+    for t in (Ticket('192.0.2.1', 0), FailTicket('192.0.2.1', 0), BanTicket('192.0.2.1', 0)):
+      self.assertFalse(hasattr(t, '__dict__'))
+      self.assertRaises(AttributeError, setattr, t, 'unknown', 1)
+    # copy between ticket types (only known attributes are copied):
+    ft = FailTicket('192.0.2.1', 1000, ['line'])
+    ft.setRetry(5)
+    ft.setBanTime(60)
+    bt = BanTicket(ticket=ft)
+    self.assertEqual(bt.getIP(), '192.0.2.1')
+    self.assertEqual(bt.getTime(), 1000)
+    self.assertEqual(bt.getBanTime(), 60)
+    self.assertEqual(bt.getMatches(), ['line'])
+    ft2 = FailTicket(ticket=bt)
+    self.assertEqual(ft2.getRetry(), 1)
+    self.assertEqual(ft2.getLastReset(), None)
+    ft2 = FailTicket(ticket=ft)
+    self.assertEqual(ft2.getRetry(), 5)
+    self.assertEqual(ft2.getLastReset(), 1000)
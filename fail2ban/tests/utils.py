@@ -362,6 +362,7 @@ def gatherTests(regexps=None, opts=None):
 	tests.addTest(unittest.makeSuite(failmanagertestcase.FailmanagerComplex))
 	# BanManager
 	tests.addTest(unittest.makeSuite(banmanagertestcase.AddFailure))
+	tests.addTest(unittest.makeSuite(banmanagertestcase.CymruInfoCache))
 	try:
 		import dns
 		tests.addTest(unittest.makeSuite(banmanagertestcase.StatusExtendedCymruInfo))
@@ -401,6 +402,7 @@ def gatherTests(regexps=None, opts=None):
 	tests.addTest(unittest.makeSuite(filtertestcase.LogFileFilterPoll))
 	# each test case class self will check no network, and skip it (we see it in log)
 	tests.addTest(unittest.makeSuite(filtertestcase.IgnoreIPDNS))
+	tests.addTest(unittest.makeSuite(filtertestcase.AsyncDNS))
 	tests.addTest(unittest.makeSuite(filtertestcase.GetFailures))
 	tests.addTest(unittest.makeSuite(filtertestcase.DNSUtilsTests))
 	tests.addTest(unittest.makeSuite(filtertestcase.DNSUtilsNetworkTests))